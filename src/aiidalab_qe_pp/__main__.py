@@ -6,6 +6,8 @@ import click
 from pathlib import Path
 import shutil
 import os
+import statistics
+import sys
 
 """
 Automatic installation of Python code for python3@localhost.
@@ -140,5 +142,73 @@ def post_install():
         print("Code critic2@localhost is already installed! Nothing to do here.")
 
 
+IMPORT_MARKER = "aiidalab-qe-pp-import-start"
+
+
+def measure_import_time(module, baseline):
+    """Import `module` in a fresh interpreter after `baseline` and return
+    ({module: (self, cumulative)}, total) in milliseconds, for the modules
+    imported by `module` only."""
+    code = (
+        f"import {baseline}; import sys; "
+        f"sys.stderr.write('{IMPORT_MARKER}\\n'); import {module}"
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    lines = process.stderr.split(IMPORT_MARKER, 1)[-1].splitlines()
+    modules = {}
+    total = 0.0
+    for line in lines:
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:") :].split("|")
+        self_time, cumulative = int(self_time) / 1000, int(cumulative) / 1000
+        if not name[1:].startswith(" "):
+            # Only the top-level imports, the nested ones are in their cumulative
+            total += cumulative
+        modules[name.strip()] = (self_time, cumulative)
+    return modules, total
+
+
+@cli.command(help="Measure the import time the plugin adds to the app startup.")
+@click.option(
+    "--module", default="aiidalab_qe_pp.app", help="Module loaded by the app."
+)
+@click.option(
+    "--baseline",
+    default="aiidalab_qe.common.panel",
+    help="Module already imported by the app before the plugins.",
+)
+@click.option("--repeat", default=5, help="Number of fresh interpreters.")
+@click.option("--top", default=10, help="Number of slowest modules listed.")
+@click.option(
+    "--max-ms",
+    type=float,
+    default=None,
+    help="Exit with an error if the median import time is larger.",
+)
+def import_time(module, baseline, repeat, top, max_ms):
+    totals = []
+    for _ in range(repeat):
+        modules, total = measure_import_time(module, baseline)
+        totals.append(total)
+    median = statistics.median(totals)
+
+    click.echo(f"Importing {module} after {baseline}: {median:.1f} ms (median)")
+    click.echo(f"{'self [ms]':>10} {'cumulative [ms]':>16}  module")
+    slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)
+    for name, (self_time, cumulative) in slowest[:top]:
+        click.echo(f"{self_time:10.1f} {cumulative:16.1f}  {name}")
+
+    if max_ms is not None and median > max_ms:
+        raise click.ClickException(
+            f"The import time {median:.1f} ms is larger than {max_ms} ms."
+        )
+
+
 if __name__ == "__main__":
     cli()
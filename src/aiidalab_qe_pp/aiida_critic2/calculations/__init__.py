@@ -84,6 +84,11 @@ class Critic2Calculation(CalcJob):
             "ERROR_MISSING_OUTPUT_FILE",
             message="The output file was not found",
         )
+        spec.exit_code(
+            102,
+            "ERROR_READING_OUTPUT_FILE",
+            message="The STM data file could not be read",
+        )
 
     def prepare_for_submission(self, folder):
         # Prepare the input parameters
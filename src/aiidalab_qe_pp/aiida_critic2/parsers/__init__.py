@@ -31,50 +31,53 @@ class Critic2Parser(Parser):
             self.logger.error(f"Output file {output_file} not found")
             return self.exit_codes.ERROR_MISSING_OUTPUT_FILE
 
-        finished = False
+        # Stream the stdout instead of loading it at once, it can be long
         with out_folder.open(output_file) as file:
-            for line in file.readlines():
-                if "CRITIC2 ended successfully" in line:
-                    finished = True
+            finished = any("CRITIC2 ended successfully" in line for line in file)
 
         if not finished:
             raise OutputParsingError("Calculation did not finish correctly")
 
-        xcryst, ycryst, xcart, ycart, fstm = read_stm_file(out_folder, data_file)
+        try:
+            data = read_stm_file(out_folder, data_file)
+        except ValueError as e:
+            self.logger.error(f"Could not read {data_file}: {e}")
+            return self.exit_codes.ERROR_READING_OUTPUT_FILE
+        if data.size == 0:
+            self.logger.error(f"No STM data in {data_file}")
+            return self.exit_codes.ERROR_READING_OUTPUT_FILE
+        xcryst, ycryst, xcart, ycart, fstm = data.T
 
         stm_data = ArrayData()
-        stm_data.set_array("xcryst", np.array(xcryst))
-        stm_data.set_array("ycryst", np.array(ycryst))
-        stm_data.set_array("xcart", np.array(xcart))
-        stm_data.set_array("ycart", np.array(ycart))
-        stm_data.set_array("fstm", np.array(fstm))
+        stm_data.set_array("xcryst", xcryst)
+        stm_data.set_array("ycryst", ycryst)
+        stm_data.set_array("xcart", xcart)
+        stm_data.set_array("ycart", ycart)
+        stm_data.set_array("fstm", fstm)
         self.out("stm_data", stm_data)
 
         return ExitCode(0)
 
-        return ExitCode(0)
-
 
 def read_stm_file(out_folder, data_file):
-    xcryst = []
-    ycryst = []
-    xcart = []
-    ycart = []
-    fstm = []
+    """Read the STM data file of critic2 into an array of five columns
+    (xcryst, ycryst, xcart, ycart, fstm), with no rows if it has no data.
+
+    The data block is parsed at once by NumPy, lines starting with ``#`` are
+    comments and blank lines (between scan lines) are skipped. If some line
+    does not have five columns the file is read again line by line, keeping
+    only the lines that do. Raises `ValueError` if a value is not a number.
+    """
+    with out_folder.open(data_file) as file:
+        try:
+            return np.loadtxt(file, comments="#", usecols=range(5), ndmin=2)
+        except ValueError:
+            pass
 
     with out_folder.open(data_file) as file:
-        for line in file:
-            # Skip lines that start with ##
-            if line.startswith("##"):
-                continue
-
-            # Split the line into columns and convert to float
-            columns = line.split()
-            if len(columns) == 5:
-                xcryst.append(float(columns[0]))
-                ycryst.append(float(columns[1]))
-                xcart.append(float(columns[2]))
-                ycart.append(float(columns[3]))
-                fstm.append(float(columns[4]))
-
-    return xcryst, ycryst, xcart, ycart, fstm
+        rows = [
+            [float(column) for column in columns]
+            for columns in (line.split() for line in file if not line.startswith("#"))
+            if len(columns) == 5
+        ]
+    return np.array(rows, dtype=float).reshape(-1, 5)
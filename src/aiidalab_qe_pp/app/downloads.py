@@ -0,0 +1,401 @@
+"""Background download of the original files from the remote folders of the PP calculations."""
+
+import os
+import queue
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import traitlets as tl
+from tornado.ioloop import IOLoop
+
+from aiidalab_qe_pp.app.remote import get_remote_access, transport_pool
+from aiidalab_qe_pp.app.utils import (
+    DOWNLOADS_DIR,
+    JUPYTER_DIR,
+    cleanup_downloads,
+    format_size,
+    get_jupyter_file_url,
+)
+
+MAX_PENDING_DOWNLOADS = 8
+# Files of an archive handled at the same time. The transfers from one computer
+# share its single transport (one after the other), the computers overlap.
+MAX_ARCHIVE_TRANSFERS = 4
+PROGRESS_INTERVAL = 0.25  # Seconds between two progress updates
+
+
+class DownloadCancelled(Exception):
+    """Raised within a transfer when its download has been cancelled."""
+
+
+class DownloadJob:
+    """A file of a `RemoteData` to be copied to DOWNLOADS_DIR.
+
+    `filename` is either the name of the file or a callable selecting it from the
+    list of files of the remote folder (returning None if there is no match).
+    `on_progress(transferred, total)` and `on_finish(file_path, error)` are called
+    from the download thread. The job is created in the thread owning the node,
+    the download thread only uses its remote path and `RemoteAccess`.
+    """
+
+    def __init__(
+        self, remote_folder, filename, local_name, on_progress=None, on_finish=None
+    ):
+        if remote_folder is not None:
+            self.remote_path = remote_folder.get_remote_path()
+            self.access = get_remote_access(remote_folder)
+        self.filename = filename
+        self.local_name = local_name
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self._cancelled = threading.Event()
+        self._last_report = 0.0
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def report(self, transferred, total):
+        """Progress callback of the transfer, it aborts the transfer once cancelled."""
+        if self.cancelled:
+            raise DownloadCancelled()
+        now = time.monotonic()
+        if self.on_progress and (
+            transferred == total or now - self._last_report > PROGRESS_INTERVAL
+        ):
+            self._last_report = now
+            self.on_progress(transferred, total)
+
+    def finish(self, file_path, error=None):
+        if self.on_finish:
+            self.on_finish(file_path, error)
+
+
+class ArchiveJob(DownloadJob):
+    """Several files of `RemoteData` folders to be copied into one zip archive.
+
+    `entries` is a list of (remote_folder, filename, name in the archive), the
+    filenames are given as for `DownloadJob`. Files that are not available are
+    skipped and listed in `skipped`.
+    """
+
+    def __init__(self, entries, local_name, on_progress=None, on_finish=None):
+        super().__init__(None, None, local_name, on_progress, on_finish)
+        accesses = {}
+        self.entries = []
+        for remote_folder, filename, arcname in entries:
+            pk = remote_folder.pk
+            if pk not in accesses:
+                accesses[pk] = (
+                    get_remote_access(remote_folder),
+                    remote_folder.get_remote_path(),
+                )
+            self.entries.append((*accesses[pk], filename, arcname))
+        self.skipped = []
+        self._lock = threading.Lock()
+
+    def report(self, transferred, total):
+        # Called from the concurrent transfers
+        with self._lock:
+            super().report(transferred, total)
+
+
+def _select_file(files, filename):
+    filename = filename(files) if callable(filename) else filename
+    return filename if filename in files else None
+
+
+def getfile(transport, source, destination, total, callback):
+    """Copy a remote file calling `callback(transferred, total)` along the way.
+
+    The progress is reported (and the transfer can be cancelled by raising
+    from `callback`) during the copy for the SSH and local transports. With
+    any other transport the file is copied in one call of `getfile`, and
+    `callback` is only called once it has arrived.
+    """
+    from aiida.transports.plugins.local import LocalTransport
+    from aiida.transports.plugins.ssh import SshTransport
+
+    if isinstance(transport, SshTransport):
+        # paramiko reports the progress of the SFTP transfer
+        transport.sftp.get(source, destination, callback=callback)
+    elif isinstance(transport, LocalTransport):
+        transferred = 0
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            while chunk := src.read(1024**2):
+                dst.write(chunk)
+                transferred += len(chunk)
+                callback(transferred, total)
+    else:
+        transport.getfile(source, destination)
+        callback(total, total)
+
+
+class DownloadManager:
+    """Download remote files one after the other in a single background thread.
+
+    At most `max_pending` jobs can wait in the queue. Before each transfer the
+    DOWNLOADS_DIR is cleaned so that the new file fits in the disk quota.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_DOWNLOADS):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue a job, raises `queue.Full` if too many downloads are pending."""
+        self._queue.put_nowait(job)
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        return job
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._download(job)
+            finally:
+                self._queue.task_done()
+
+    def _download(self, job):
+        if isinstance(job, ArchiveJob):
+            self._download_archive(job)
+            return
+        partial_path = os.path.join(DOWNLOADS_DIR, f"{job.local_name}.part")
+        try:
+            if job.cancelled:
+                raise DownloadCancelled()
+            remote_path = job.remote_path
+            files = transport_pool.listdir(job.access, remote_path)
+            if not files:
+                raise FileNotFoundError("the remote folder is empty.")
+            filename = _select_file(files, job.filename)
+            if filename is None:
+                raise FileNotFoundError(
+                    "the file is not available in the remote folder."
+                )
+            try:
+                with transport_pool.transport(job.access) as transport:
+                    source = os.path.join(remote_path, filename)
+                    total = transport.get_attribute(source).st_size
+                    cleanup_downloads(reserve=total)
+                    getfile(transport, source, partial_path, total, job.report)
+            except FileNotFoundError:
+                # The folder changed since it was listed (e.g. it was cleaned)
+                transport_pool.forget_listing(job.access, remote_path)
+                raise
+
+            file_path = os.path.join(DOWNLOADS_DIR, job.local_name)
+            os.replace(partial_path, file_path)
+        except DownloadCancelled:
+            job.finish(None, "Download cancelled.")
+        except Exception as e:
+            job.finish(None, f"Download failed: {e}")
+        else:
+            job.finish(file_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def _download_archive(self, job):
+        """Transfer the files of `job`, each one being added to the
+        (compressed) archive as soon as it has arrived, while the next one is
+        transferred."""
+        partial_path = os.path.join(DOWNLOADS_DIR, f"{job.local_name}.part")
+        executor = ThreadPoolExecutor(max_workers=MAX_ARCHIVE_TRANSFERS)
+        transfers = []
+        try:
+            # Sizes first, for the progress and the disk quota
+            stats = executor.map(lambda entry: self._stat(job, *entry), job.entries)
+            sources = [source for source in stats if source is not None]
+            if job.cancelled:
+                raise DownloadCancelled()
+            if not sources:
+                raise FileNotFoundError("none of the files is available.")
+            total = sum(source[3] for source in sources)
+            cleanup_downloads(reserve=2 * total)
+
+            transferred = [0] * len(sources)
+            arrived = queue.Queue()
+
+            def transfer(index, access, source, arcname, size):
+                def report(done, _):
+                    transferred[index] = done
+                    job.report(sum(transferred), total)
+
+                destination = f"{partial_path}.{index}"
+                transfers.append(destination)
+                if job.cancelled:
+                    raise DownloadCancelled()
+                with transport_pool.transport(access) as transport:
+                    getfile(transport, source, destination, size, report)
+                return destination, arcname
+
+            def transfer_all(group):
+                # The files of a computer are transferred one after the other,
+                # so that none of them waits for its transport meanwhile
+                try:
+                    for index, source in group:
+                        arrived.put(transfer(index, *source))
+                except BaseException as e:
+                    arrived.put(e)
+
+            groups = defaultdict(list)
+            for index, source in enumerate(sources):
+                groups[source[0].key].append((index, source))
+            for group in groups.values():
+                executor.submit(transfer_all, group)
+            with zipfile.ZipFile(partial_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                for _ in sources:
+                    result = arrived.get()
+                    if isinstance(result, BaseException):
+                        raise result
+                    destination, arcname = result
+                    archive.write(destination, arcname)
+                    os.remove(destination)
+
+            file_path = os.path.join(DOWNLOADS_DIR, job.local_name)
+            os.replace(partial_path, file_path)
+        except DownloadCancelled:
+            job.cancel()
+            job.finish(None, "Download cancelled.")
+        except Exception as e:
+            job.cancel()
+            job.finish(None, f"Download failed: {e}")
+        else:
+            job.finish(file_path)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for path in [partial_path, *transfers]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    @staticmethod
+    def _stat(job, access, remote_path, filename, arcname):
+        """Return (access, path, name in the archive, size) of a file of the
+        archive, or None if it is not available."""
+        if job.cancelled:
+            return None
+        try:
+            filename = _select_file(
+                transport_pool.listdir(access, remote_path), filename
+            )
+            if filename is None:
+                raise FileNotFoundError(filename)
+            source = os.path.join(remote_path, filename)
+            with transport_pool.transport(access) as transport:
+                size = transport.get_attribute(source).st_size
+        except FileNotFoundError:
+            transport_pool.forget_listing(access, remote_path)
+            job.skipped.append(arcname)
+            return None
+        return access, source, arcname, size
+
+
+download_manager = DownloadManager()
+
+
+class HasSourceDownload(tl.HasTraits):
+    """Download of an original (source) file of the remote folder, with progress."""
+
+    downloading = tl.Bool(False)
+    download_progress = tl.Float(0.0)
+    download_status = tl.Unicode("")
+
+    _download_job = None
+
+    def submit_source_download(self, remote_folder, filename, local_name):
+        if self.downloading:
+            return
+        try:
+            job = DownloadJob(
+                remote_folder,
+                filename,
+                local_name,
+                on_progress=self._on_ioloop(self._on_download_progress),
+                on_finish=self._on_ioloop(self._on_download_finish),
+            )
+        except Exception as e:
+            # e.g. the computer is not configured for the current user
+            self.set_download_error(f"Download failed: {e}")
+            return
+        self._submit_download(job)
+
+    def submit_archive_download(self, entries, local_name):
+        """Download several source files (see `ArchiveJob`) as one zip archive."""
+        if self.downloading:
+            return
+        try:
+            job = ArchiveJob(
+                entries,
+                local_name,
+                on_progress=self._on_ioloop(self._on_download_progress),
+                on_finish=self._on_ioloop(self._on_download_finish),
+            )
+        except Exception as e:
+            self.set_download_error(f"Download failed: {e}")
+            return
+        self._submit_download(job)
+
+    @staticmethod
+    def _on_ioloop(method):
+        """Return a callback for the download thread, calling `method` on the
+        kernel IOLoop, which owns the traits."""
+        ioloop = IOLoop.current()
+        return lambda *args: ioloop.add_callback(method, *args)
+
+    def _submit_download(self, job):
+        self._download_job = job
+        self.downloading = True
+        self.download_progress = 0.0
+        self.download_status = "Waiting for the connection to the computer..."
+        try:
+            download_manager.submit(job)
+        except queue.Full:
+            self._download_job = None
+            self.downloading = False
+            self.set_download_error(
+                "Too many downloads are pending, please try again later."
+            )
+
+    def cancel_download(self, _=None):
+        if self._download_job is not None:
+            self._download_job.cancel()
+
+    def set_download_error(self, message):
+        self.download_status = (
+            f'<div style="color: red; font-weight: bold;">{message}</div>'
+        )
+
+    def _on_download_progress(self, transferred, total):
+        self.download_progress = transferred / total if total else 1.0
+        self.download_status = f"{format_size(transferred)} / {format_size(total)}"
+
+    def _on_download_finish(self, file_path, error):
+        job = self._download_job
+        self._download_job = None
+        self.downloading = False
+        if error:
+            self.set_download_error(error)
+            return
+        file_name = os.path.basename(file_path)
+        url = get_jupyter_file_url(os.path.relpath(file_path, JUPYTER_DIR))
+        self.download_status = (
+            f'<a href="{url}" download="{file_name}"><b>Download {file_name} '
+            f"({format_size(os.path.getsize(file_path))})</b></a>"
+        )
+        skipped = getattr(job, "skipped", [])
+        if skipped:
+            self.download_status += (
+                f"<br>{len(skipped)} file(s) not available anymore: "
+                + ", ".join(skipped)
+            )
@@ -2,15 +2,27 @@ import traitlets as tl
 from aiida import orm
 from aiidalab_qe.common.panel import ConfigurationSettingsModel
 from aiidalab_qe.common.mixins import HasInputStructure
-from aiida_quantumespresso.workflows.pw.bands import PwBandsWorkChain
-from aiida_quantumespresso.workflows.pw.base import PwBaseWorkChain
-from aiida_quantumespresso.calculations.pw import PwCalculation
-from paramiko.ssh_exception import SSHException
-from aiidalab_qe.plugins.bands.bands_workchain import BandsWorkChain
-from aiida_wannier90_workflows.workflows import ProjwfcBandsWorkChain
-from aiida_quantumespresso.data.hubbard_structure import HubbardStructureData
-from aiida.common.exceptions import NotExistent
 import numpy as np
+import threading
+import math
+from tornado.ioloop import IOLoop
+
+from aiidalab_qe_pp.app.remote import (
+    ALIVE,
+    REMOTE_CHECK_TTL,
+    UNREACHABLE,
+    check_folder_groups,
+    get_remote_folders_status,
+    read_remote_status,
+    refresh_remote_status,
+    resolve_remote_folders,
+    store_remote_status,
+)
+from aiidalab_qe_pp.app.planning import format_plan, plan_pp_calculations
+from aiidalab_qe_pp.parameters import (
+    DEFAULT_STS_SETPOINT_BIAS,
+    parse_sts_parameters,
+)
 
 
 class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure):
@@ -25,6 +37,9 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
 
     no_avail_cals = tl.Unicode("")
 
+    discovering = tl.Bool(False)
+    discovery_message = tl.Unicode("")
+
     pwcalc_type_options = tl.List(
         trait=tl.List(tl.Unicode()),
         default_value=[("Bands", "bands"), ("Nscf", "nscf")],
@@ -36,6 +51,8 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
     )
     pwcalc_avail = tl.Int(None, allow_none=True)
     computer = tl.Unicode("")
+    # Seconds the stored check of a remote folder is trusted
+    remote_check_ttl = tl.Int(REMOTE_CHECK_TTL)
 
     reduce_cube_files = tl.Bool(False)
 
@@ -46,6 +63,7 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
     calc_stm = tl.Bool(False)
     calc_potential = tl.Bool(False)
     calc_ldos_grid = tl.Bool(False)
+    calc_sts = tl.Bool(False)
 
     disable_calc_charge_dens = tl.Bool(False)
     disable_calc_spin_dens = tl.Bool(False)
@@ -72,6 +90,7 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
     pwcalc_avail_displayed = tl.Unicode("block")
     wfn_options_displayed = tl.Unicode("none")
     ldos_options_displayed = tl.Unicode("none")
+    sts_options_displayed = tl.Unicode("none")
 
     ldos_emin = tl.Float(0)
     ldos_emax = tl.Float(0)
@@ -91,9 +110,43 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
     ildos_stm_heights = tl.Unicode("2.0")
     ildos_stm_currents = tl.Unicode("0.1")
 
+    sts_heights = tl.Unicode("2.0")
+    sts_currents = tl.Unicode("")
+    sts_setpoint_bias = tl.Float(DEFAULT_STS_SETPOINT_BIAS)
+    sts_points = tl.Unicode("")
+    sts_broadening = tl.Float(0.0)
+    sts_warning = tl.Unicode("")
+
     stm_sample_bias = tl.Unicode("0.0")
     stm_heights = tl.Unicode("2.0")
     stm_currents = tl.Unicode("0.1")
+    stm_engine_options = tl.List(
+        trait=tl.List(tl.Unicode()),
+        default_value=[
+            ("Built-in (NumPy)", "numpy"),
+            ("critic2", "critic2"),
+        ],
+    )
+    stm_engine = tl.Unicode("numpy")
+    stm_source_options = tl.List(
+        trait=tl.List(tl.Unicode()),
+        default_value=[
+            ("One pp.x run per bias", "pp"),
+            ("LDOS grid", "ldos_grid"),
+        ],
+    )
+    stm_source = tl.Unicode("pp")
+    stm_ldos_weighting_options = tl.List(
+        trait=tl.List(tl.Unicode()),
+        default_value=[
+            ("Trapezoidal", "trapezoid"),
+            ("Gaussian", "gaussian"),
+        ],
+    )
+    stm_ldos_weighting = tl.Unicode("trapezoid")
+    stm_ldos_broadening = tl.Float(0.0)
+    stm_ldos_options_displayed = tl.Unicode("none")
+    stm_ldos_warning = tl.Unicode("")
 
     bands_calc_list = []
     nscf_calc_list = []
@@ -103,8 +156,47 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
 
     kbands_info = tl.Unicode("")
     kpoints_table = tl.Unicode("")
+    kpoints_search = tl.Unicode("")
+    kpoints_page = tl.Int(1)
+    kpoints_pages = tl.Int(1)
+    kpoints_page_info = tl.Unicode("")
+    kpoints_per_page = 50
     number_of_kpoints = tl.Int(1)
 
+    cost_plan = tl.Unicode("")
+    # Traits the cost of the workchain depends on
+    cost_dependencies = [
+        "reduce_cube_files",
+        "calc_charge_dens",
+        "calc_spin_dens",
+        "calc_potential",
+        "calc_wfn",
+        "calc_ildos",
+        "calc_ildos_stm",
+        "calc_stm",
+        "calc_ldos_grid",
+        "calc_sts",
+        "sts_heights",
+        "sts_currents",
+        "ldos_emin",
+        "ldos_emax",
+        "ldos_delta_e",
+        "ildos_stm_heights",
+        "ildos_stm_currents",
+        "stm_sample_bias",
+        "stm_heights",
+        "stm_currents",
+        "stm_engine",
+        "stm_source",
+        "sel_orbital",
+    ]
+    _parent_cost = None
+
+    # The k-points (rounded crystal coordinates) of each calculation, shared
+    # between instances since the nodes are immutable
+    _kpoints_cache = {}
+    _kpoints = np.zeros((0, 3))
+
     sel_orbital = tl.List(
         trait=tl.List(tl.Union([tl.Unicode(), tl.Int()])),
         default_value=[],
@@ -112,12 +204,137 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
 
     lsign = tl.Bool(False)
 
+    _discovery_id = 0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Guards `_discovery_id`
+        self._discovery_lock = threading.Lock()
+
     def fetch_data(self):
         self.bands_calc_list = self.get_available_pwcalcs(self.input_structure, "bands")
         self.nscf_calc_list = self.get_available_pwcalcs(self.input_structure, "nscf")
 
+    def fetch_data_in_background(self):
+        """Discover the available parent calculations without blocking the app.
+
+        The calculations are queried and the stored checks of their remote
+        folders are read here. Only the checks of the other folders run in the
+        background thread, which uses the transports but not the ORM: the
+        statuses are stored and the options of the selected calculation type
+        are filled on the kernel IOLoop, as the folders are confirmed. The
+        result is dropped if another discovery was started (or the structure
+        changed) in the meantime.
+        """
+        with self._discovery_lock:
+            self._discovery_id += 1
+            discovery_id = self._discovery_id
+        if not self.input_structure:
+            self.discovering = False
+            self.discovery_message = ""
+            return
+        self.bands_calc_list = []
+        self.nscf_calc_list = []
+        self.pwcalc_avail_options = []
+        self.no_avail_cals = ""
+        self.discovering = True
+        self.discovery_message = """<div style="line-height: 140%; padding-top: 0px; padding-bottom: 10px;">
+            <i class="fa fa-spinner fa-spin"></i> Searching for pw.x calculations of the selected structure...
+            </div>"""
+
+        found = {}
+        try:
+            for wc_type in ("bands", "nscf"):
+                found[wc_type] = self._query_pwcalcs(self.input_structure, wc_type)
+            remote_folders = {
+                remote_folder.pk: remote_folder
+                for _, folders in found.values()
+                for remote_folder in folders
+            }
+            statuses, unknown, stale = read_remote_status(
+                remote_folders.values(), ttl=self.remote_check_ttl
+            )
+            refresh_remote_status(stale)
+            groups, unconfigured = resolve_remote_folders(unknown)
+        except Exception as e:
+            self._on_discovery_done(
+                discovery_id,
+                {},
+                {},
+                f"""<div style="line-height: 140%; padding-top: 0px; padding-bottom: 10px; color: red;">
+            Failed to search for pw.x calculations: {e}
+            </div>""",
+            )
+            return
+
+        def on_checked(remote_pk, status):
+            store_remote_status(remote_folders[remote_pk], status)
+            statuses[remote_pk] = status
+            self._on_discovered(discovery_id, found, remote_pk, status)
+
+        for remote_pk in unconfigured:
+            on_checked(remote_pk, UNREACHABLE)
+        for remote_pk, status in list(statuses.items()):
+            self._on_discovered(discovery_id, found, remote_pk, status)
+
+        ioloop = IOLoop.current()
+
+        def check():
+            try:
+                check_folder_groups(
+                    groups,
+                    on_result=lambda remote_pk, status: ioloop.add_callback(
+                        on_checked, remote_pk, status
+                    ),
+                )
+            finally:
+                ioloop.add_callback(
+                    self._on_discovery_done, discovery_id, found, statuses, ""
+                )
+
+        threading.Thread(target=check, daemon=True).start()
+
+    def _is_current_discovery(self, discovery_id):
+        with self._discovery_lock:
+            return discovery_id == self._discovery_id
+
+    def _on_discovered(self, discovery_id, found, remote_pk, status):
+        """Add a confirmed calculation to the options (on the IOLoop)."""
+        if (
+            status != ALIVE
+            or not self._is_current_discovery(discovery_id)
+            or remote_pk not in found[self.pwcalc_type][0]
+        ):
+            return
+        description, pk, _ = found[self.pwcalc_type][0][remote_pk]
+        self.pwcalc_avail_options = [
+            *self.pwcalc_avail_options,
+            (description, pk),
+        ]
+
+    def _on_discovery_done(self, discovery_id, found, statuses, message):
+        """Apply the result of the discovery (on the IOLoop)."""
+        if not self._is_current_discovery(discovery_id):
+            return
+        self.discovery_message = message
+        calc_lists = {"bands": [], "nscf": []}
+        for wc_type, (descriptions, _) in found.items():
+            calc_lists[wc_type], computer = self._select_available_pwcalcs(
+                descriptions, statuses
+            )
+            if computer:
+                self.computer = computer
+        self.bands_calc_list = calc_lists["bands"]
+        self.nscf_calc_list = calc_lists["nscf"]
+        self.discovering = False
+        self.update_pwcalc_avail_options()
+
     def update_pwcalc_avail_options(self, _=None):
         """Update the available PW calculations based on the selected calculation type."""
+        if self.discovering:
+            # Options of the newly selected type are added as they are discovered
+            self.pwcalc_avail_options = []
+            return
         calc_list = (
             self.bands_calc_list if self.pwcalc_type == "bands" else self.nscf_calc_list
         )
@@ -140,6 +357,10 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
             self.pwcalc_avail_displayed = "none"
 
     def on_input_structure_change(self, _=None):
+        # Drop the result of a discovery for the previous structure
+        with self._discovery_lock:
+            self._discovery_id += 1
+        self.discovering = False
         if self.input_structure:
             self.structure_selected = """<div style="line-height: 140%; padding-top: 0px; padding-bottom: 10px; color: green;">
             Structure selected PK: {}.
@@ -151,6 +372,7 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
 
     def on_pwcalc_avail_change(self, _=None):
         if not self.pwcalc_avail:
+            self.cost_plan = ""
             return
         calc = orm.load_node(self.pwcalc_avail)
         self.current_calc_lsda = calc.outputs.output_parameters["lsda"]
@@ -160,9 +382,12 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
         number_of_bands = calc.outputs.output_parameters["number_of_bands"]
         self.kbands_info = f"<strong>Number of electrons:</strong> {number_of_electrons}<br> <strong>Number of bands:</strong>  {number_of_bands}"
 
-        kpoints = calc.outputs.output_band.get_kpoints()
-        self.kpoints_table = self.update_kpoints_info(kpoints)
+        self._kpoints = self.get_kpoints(calc)
+        self.kpoints_search = ""
+        self.kpoints_page = 1
+        self.update_kpoints_table()
         self.number_of_kpoints = calc.outputs.output_parameters["number_of_k_points"]
+        self._parent_cost = self.get_parent_cost(calc)
 
         self.enable_all_calcs()
         if self.current_calc_lsda:
@@ -190,6 +415,8 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
         else:
             self.disable_calc_ldos_grid = False
 
+        self.update_cost_plan()
+
     def _get_default(self, trait):
         return self._defaults.get(trait, self.traits()[trait].default_value)
 
@@ -205,12 +432,111 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
         else:
             self.ldos_options_displayed = "none"
 
+    def on_change_calc_sts(self, _=None):
+        if self.calc_sts:
+            self.sts_options_displayed = "block"
+        else:
+            self.sts_options_displayed = "none"
+
+    def select_ldos_grid_for_sts(self):
+        """Select the LDOS grid, which the maps and spectra are read from, with
+        an energy range covering the states of the setpoint bias."""
+        if not self.calc_sts or self.disable_calc_ldos_grid:
+            return
+        self.calc_ldos_grid = True
+        # The states of a bias V are between the Fermi level and -V
+        self.ldos_emin = min(self.ldos_emin, 0.0, -self.sts_setpoint_bias)
+        self.ldos_emax = max(self.ldos_emax, 0.0, -self.sts_setpoint_bias)
+        # At least two energies, for the spectra
+        self.ldos_emax = max(self.ldos_emax, self.ldos_emin + self.ldos_delta_e)
+
+    def update_sts_warning(self, _=None):
+        """Warn when the STS maps and spectra can not be computed."""
+        self.sts_warning = ""
+        if not self.calc_sts:
+            return
+        try:
+            sts = parse_sts_parameters(
+                {
+                    "heights": self.sts_heights,
+                    "currents": self.sts_currents,
+                    "setpoint_bias": self.sts_setpoint_bias,
+                    "points": self.sts_points,
+                }
+            )
+        except ValueError as e:
+            message = f"{e}."
+        else:
+            lower, upper = sts["setpoint"]
+            if not self.calc_ldos_grid:
+                message = "The LDOS grid calculation has to be selected."
+            elif self.ldos_emax - self.ldos_emin < self.ldos_delta_e - 1e-6:
+                message = "The spectra need at least two energies in the LDOS grid."
+            elif sts["currents"] and (lower < self.ldos_emin or upper > self.ldos_emax):
+                message = (
+                    "The energy range of the LDOS grid does not cover the states "
+                    f"of the setpoint bias ({lower} to {upper} eV), needed by the "
+                    "constant current maps."
+                )
+            else:
+                return
+        self.sts_warning = f"""<div style="line-height: 140%; padding-top: 0px; padding-bottom: 10px; color: red;">
+            {message}
+            </div>"""
+
     def on_change_calc_stm(self, _=None):
         if self.calc_stm:
             self.stm_options_displayed = "block"
         else:
             self.stm_options_displayed = "none"
 
+    def on_change_stm_source(self, _=None):
+        if self.stm_source == "ldos_grid":
+            self.stm_ldos_options_displayed = "block"
+        else:
+            self.stm_ldos_options_displayed = "none"
+
+    def select_ldos_grid_for_stm(self):
+        """Select the LDOS grid with an energy range covering the sample biases."""
+        if self.stm_source != "ldos_grid" or self.disable_calc_ldos_grid:
+            return
+        self.calc_ldos_grid = True
+        try:
+            biases = [float(value) for value in self.stm_sample_bias.split()]
+        except ValueError:
+            return
+        # The states of a bias V are between the Fermi level and -V
+        self.ldos_emin = min(self.ldos_emin, 0.0, *(-bias for bias in biases))
+        self.ldos_emax = max(self.ldos_emax, 0.0, *(-bias for bias in biases))
+
+    def update_stm_ldos_warning(self, _=None):
+        """Warn when the LDOS grid can not give the STM images of all the biases."""
+        self.stm_ldos_warning = ""
+        if not self.calc_stm or self.stm_source != "ldos_grid":
+            return
+        if not self.calc_ldos_grid:
+            message = "The LDOS grid calculation has to be selected."
+        else:
+            try:
+                biases = [float(value) for value in self.stm_sample_bias.split()]
+            except ValueError:
+                return
+            uncovered = [
+                bias
+                for bias in biases
+                if min(0.0, -bias) < self.ldos_emin or max(0.0, -bias) > self.ldos_emax
+            ]
+            if not uncovered:
+                return
+            message = (
+                "The energy range of the LDOS grid does not cover the states of "
+                f"the biases {' '.join(str(bias) for bias in uncovered)} eV, only "
+                "the states inside the range are integrated."
+            )
+        self.stm_ldos_warning = f"""<div style="line-height: 140%; padding-top: 0px; padding-bottom: 10px; color: red;">
+            {message}
+            </div>"""
+
     def on_change_calc_wfn(self, _=None):
         if self.calc_wfn:
             self.wfn_options_displayed = "block"
@@ -251,127 +577,234 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
         self.disable_calc_potential = False
         self.disable_calc_ldos_grid = False
 
-    def update_kpoints_info(self, list_kpoints):
+    def get_parent_cost(self, calc):
+        """Return what the cost plan needs to know about the parent calculation."""
+        output_parameters = calc.outputs.output_parameters.get_dict()
+        resources = calc.get_option("resources") or {}
+        cores = resources.get("tot_num_mpiprocs") or (
+            resources.get("num_machines", 1)
+            * (resources.get("num_mpiprocs_per_machine") or 1)
+        )
+        wall_time = output_parameters.get("wall_time_seconds")
+        return {
+            "output_parameters": output_parameters,
+            "number_of_atoms": len(calc.inputs.structure.sites),
+            "parent_core_hours": None
+            if wall_time is None
+            else cores * wall_time / 3600,
+        }
+
+    def update_cost_plan(self, _=None):
+        """Update the estimated cost of the workchain for the current settings."""
+        if not self.pwcalc_avail or self._parent_cost is None:
+            self.cost_plan = ""
+            return
+        plan = plan_pp_calculations(
+            self._parent_cost["output_parameters"],
+            self.get_model_state(),
+            number_of_atoms=self._parent_cost["number_of_atoms"],
+            parent_core_hours=self._parent_cost["parent_core_hours"],
+        )
+        self.cost_plan = format_plan(plan)
+
+    def get_kpoints(self, calc):
+        """Return the rounded k-points of `calc`, loaded only once per calculation."""
+        if calc.pk not in self._kpoints_cache:
+            self._kpoints_cache[calc.pk] = np.round(
+                calc.outputs.output_band.get_kpoints(), 4
+            )
+        return self._kpoints_cache[calc.pk]
+
+    def filter_kpoints(self):
+        """Return the indices of the k-points matching `kpoints_search`.
+
+        The search is either a k-point index (starting at 1) or up to three
+        crystal coordinates, e.g. "0.5 0 0".
+        """
+        text = self.kpoints_search.replace(",", " ").strip()
+        number_of_kpoints = len(self._kpoints)
+        if not text:
+            return np.arange(number_of_kpoints)
+        try:
+            values = [float(value) for value in text.split()]
+        except ValueError:
+            return np.array([], dtype=int)
+
+        if len(values) == 1 and text.isdigit():
+            index = int(text) - 1
+            if 0 <= index < number_of_kpoints:
+                return np.array([index])
+            return np.array([], dtype=int)
+        if len(values) > 3:
+            return np.array([], dtype=int)
+
+        mask = np.all(
+            np.isclose(self._kpoints[:, : len(values)], values, atol=1e-3), axis=1
+        )
+        return np.nonzero(mask)[0]
+
+    def update_kpoints_table(self, _=None):
+        """Render the rows of the current page of the (searched) k-points only."""
+        indices = self.filter_kpoints()
+        self.kpoints_pages = max(1, math.ceil(len(indices) / self.kpoints_per_page))
+        page = min(max(self.kpoints_page, 1), self.kpoints_pages)
+        start = (page - 1) * self.kpoints_per_page
+        rows = indices[start : start + self.kpoints_per_page]
+        self.kpoints_table = self.update_kpoints_info(self._kpoints[rows], rows)
+        self.kpoints_page_info = f"{len(indices)} of {len(self._kpoints)} k-points, page {page} of {self.kpoints_pages}"
+
+    def update_kpoints_info(self, list_kpoints, indices=None):
         """Update table with the kpoints. Number - (kx,ky,kz).  list_kpoints"""
-        rounded_kpoints = np.round(list_kpoints, 4).tolist()
-        table_data = [
-            (index + 1, kpoint) for index, kpoint in enumerate(rounded_kpoints)
-        ]
-        table_html = "<table>"
-        table_html += "<tr><th style='text-align:center; width: 100px;'>Kpoint</th><th style='text-align:center;'>Crystal</th></tr>"
-        table_html += "<tr><th style='text-align:center; width: 100px;'>Index</th><th style='text-align:center;'>coord</th></tr>"
-        for row in table_data:
-            table_html += "<tr>"
-            for cell in row:
-                table_html += "<td style='text-align:center;'>{}</td>".format(cell)
-            table_html += "</tr>"
-        table_html += "</table>"
-
-        return table_html
-
-    def get_available_pwcalcs(self, structure, wc_type):
+        if indices is None:
+            indices = range(len(list_kpoints))
+        rows = "".join(
+            "<tr><td style='text-align:center;'>{}</td><td style='text-align:center;'>{}</td></tr>".format(
+                index + 1, kpoint
+            )
+            for index, kpoint in zip(indices, np.asarray(list_kpoints).tolist())
+        )
+        return (
+            "<table>"
+            "<tr><th style='text-align:center; width: 100px;'>Kpoint</th><th style='text-align:center;'>Crystal</th></tr>"
+            "<tr><th style='text-align:center; width: 100px;'>Index</th><th style='text-align:center;'>coord</th></tr>"
+            f"{rows}"
+            "</table>"
+        )
+
+    def get_available_pwcalcs(self, structure, wc_type, on_available=None):
+        """Return the (description, pk) of the `wc_type` calculations of `structure`
+        whose remote folder is still accessible and not empty.
+
+        `on_available(description, pk)` is called as soon as one is confirmed.
+        """
+        descriptions, remote_folders = self._query_pwcalcs(structure, wc_type)
+
+        def on_result(remote_pk, status):
+            if status == ALIVE and on_available:
+                description, pk, _ = descriptions[remote_pk]
+                on_available(description, pk)
+
+        statuses = get_remote_folders_status(
+            remote_folders, ttl=self.remote_check_ttl, on_result=on_result
+        )
+        avail_list, computer = self._select_available_pwcalcs(descriptions, statuses)
+        if computer:
+            self.computer = computer
+        return avail_list
+
+    @staticmethod
+    def _select_available_pwcalcs(descriptions, statuses):
+        """Return the (description, pk) of the calculations whose remote folder
+        is alive, and the label of the computer of the last one (or None)."""
         avail_list = []
+        computer = None
+        for remote_pk, (description, pk, label) in descriptions.items():
+            if statuses.get(remote_pk) == ALIVE:
+                avail_list.append((description, pk))
+                computer = label
+        return avail_list, computer
+
+    def _query_pwcalcs(self, structure, wc_type):
+        """Query the `wc_type` calculations of `structure`.
+
+        Returns the descriptions {remote folder pk: (description, pk, computer)}
+        and the `RemoteData` folders of the calculations.
+        """
+        # Importing the workflows is slow, it is deferred until the first search
+        from aiida_quantumespresso.workflows.pw.bands import PwBandsWorkChain
+        from aiida_quantumespresso.workflows.pw.base import PwBaseWorkChain
+        from aiida_quantumespresso.calculations.pw import PwCalculation
+        from aiidalab_qe.plugins.bands.bands_workchain import BandsWorkChain
+        from aiida_wannier90_workflows.workflows import ProjwfcBandsWorkChain
+        from aiida_quantumespresso.data.hubbard_structure import HubbardStructureData
+
+        qb = orm.QueryBuilder().append(
+            (orm.StructureData, HubbardStructureData),
+            filters={"id": structure.pk},
+            tag="structure",
+        )
         if wc_type == "bands":
-            calc_list = (
-                orm.QueryBuilder()
-                .append(
-                    (orm.StructureData, HubbardStructureData),
-                    filters={"id": structure.pk},
-                    tag="structure",
-                )
-                .append(
-                    BandsWorkChain,
-                    filters={
-                        "attributes.exit_status": 0,
-                    },
-                    with_incoming="structure",
-                    tag="bands_wc_qe",
-                )
-                .append(
-                    (PwBandsWorkChain, ProjwfcBandsWorkChain),
-                    filters={
-                        "attributes.exit_status": 0,
-                    },
-                    with_incoming="bands_wc_qe",
-                    tag="bands_wc",
-                )
-                .append(
-                    PwBaseWorkChain,
-                    filters={
-                        "attributes.exit_status": 0,
-                    },
-                    with_incoming="bands_wc",
-                    tag="base",
-                )
-                .append(
-                    PwCalculation,
-                    filters={
-                        "attributes.exit_status": 0,
-                    },
-                    project=["*"],
-                    with_incoming="base",
-                    tag="calc",
-                )
-                .all(flat=True)
+            qb.append(
+                BandsWorkChain,
+                filters={
+                    "attributes.exit_status": 0,
+                },
+                with_incoming="structure",
+                tag="bands_wc_qe",
+            ).append(
+                (PwBandsWorkChain, ProjwfcBandsWorkChain),
+                filters={
+                    "attributes.exit_status": 0,
+                },
+                with_incoming="bands_wc_qe",
+                tag="bands_wc",
+            ).append(
+                PwBaseWorkChain,
+                filters={
+                    "attributes.exit_status": 0,
+                },
+                with_incoming="bands_wc",
+                tag="base",
             )
 
         elif wc_type == "nscf":
-            calc_list = (
-                orm.QueryBuilder()
-                .append(
-                    (orm.StructureData, HubbardStructureData),
-                    filters={"id": structure.pk},
-                    tag="structure",
-                )
-                .append(
-                    PwBaseWorkChain,
-                    filters={
-                        "attributes.exit_status": 0,
-                    },
-                    with_incoming="structure",
-                    tag="base",
-                )
-                .append(
-                    PwCalculation,
-                    filters={
-                        "attributes.exit_status": 0,
-                    },
-                    project=["*"],
-                    with_incoming="base",
-                    tag="calc",
-                )
-                .all(flat=True)
+            qb.append(
+                PwBaseWorkChain,
+                filters={
+                    "attributes.exit_status": 0,
+                },
+                with_incoming="structure",
+                tag="base",
             )
 
-        calc_list = [
-            calc
-            for calc in calc_list
-            if calc.inputs.parameters["CONTROL"]["calculation"] == wc_type
-        ]
-
-        for calc in calc_list:
-            try:
-                self.computer = calc.computer.label
-                calc.outputs.remote_folder.listdir()
-                description = "PK: {} LSDA: {} SOC: {} Computer: {}".format(
-                    calc.pk,
-                    calc.outputs.output_parameters["lsda"],
-                    calc.outputs.output_parameters["spin_orbit_calculation"],
-                    self.computer,
-                )
+        # Filter on the type of calculation and project only what is needed,
+        # in the same query
+        qb.append(
+            PwCalculation,
+            filters={
+                "attributes.exit_status": 0,
+            },
+            project=["id"],
+            with_incoming="base",
+            tag="calc",
+        ).append(
+            orm.Dict,
+            filters={"attributes.CONTROL.calculation": wc_type},
+            edge_filters={"label": "parameters"},
+            with_outgoing="calc",
+            tag="parameters",
+        ).append(
+            orm.Dict,
+            edge_filters={"label": "output_parameters"},
+            project=["attributes.lsda", "attributes.spin_orbit_calculation"],
+            with_incoming="calc",
+            tag="output_parameters",
+        ).append(
+            orm.Computer,
+            project=["label"],
+            with_node="calc",
+            tag="computer",
+        ).append(
+            orm.RemoteData,
+            edge_filters={"label": "remote_folder"},
+            project=["*"],
+            with_incoming="calc",
+            tag="remote_folder",
+        )
 
-                avail_list.append((description, calc.pk))
-            except OSError:
-                # If OSError occurs, skip this iteration
-                continue
-            # Fix this in future
-            except SSHException:
-                continue
-            # Skip calculations without necessary information
-            except NotExistent:
+        descriptions = {}
+        remote_folders = []
+        for pk, lsda, soc, computer, remote_folder in qb.all():
+            if remote_folder.pk in descriptions:
                 continue
+            descriptions[remote_folder.pk] = (
+                f"PK: {pk} LSDA: {lsda} SOC: {soc} Computer: {computer}",
+                pk,
+                computer,
+            )
+            remote_folders.append(remote_folder)
 
-        return avail_list
+        return descriptions, remote_folders
 
     def get_model_state(self):
         return {
@@ -385,6 +818,12 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
             "calc_ildos": self.calc_ildos,
             "calc_stm": self.calc_stm,
             "calc_ldos_grid": self.calc_ldos_grid,
+            "calc_sts": self.calc_sts,
+            "sts_heights": self.sts_heights,
+            "sts_currents": self.sts_currents,
+            "sts_setpoint_bias": self.sts_setpoint_bias,
+            "sts_points": self.sts_points,
+            "sts_broadening": self.sts_broadening,
             "ldos_emin": self.ldos_emin,
             "ldos_emax": self.ldos_emax,
             "ldos_delta_e": self.ldos_delta_e,
@@ -400,6 +839,10 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
             "stm_sample_bias": self.stm_sample_bias,
             "stm_heights": self.stm_heights,
             "stm_currents": self.stm_currents,
+            "stm_engine": self.stm_engine,
+            "stm_source": self.stm_source,
+            "stm_ldos_weighting": self.stm_ldos_weighting,
+            "stm_ldos_broadening": self.stm_ldos_broadening,
             "sel_orbital": self.sel_orbital,
             "pwcalc_type": self.pwcalc_type,
             "lsign": self.lsign,
@@ -417,6 +860,14 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
         self.calc_ildos = parameters.get("calc_ildos", False)
         self.calc_stm = parameters.get("calc_stm", False)
         self.calc_ldos_grid = parameters.get("calc_ldos_grid", False)
+        self.calc_sts = parameters.get("calc_sts", False)
+        self.sts_heights = parameters.get("sts_heights", "2.0")
+        self.sts_currents = parameters.get("sts_currents", "")
+        self.sts_setpoint_bias = parameters.get(
+            "sts_setpoint_bias", DEFAULT_STS_SETPOINT_BIAS
+        )
+        self.sts_points = parameters.get("sts_points", "")
+        self.sts_broadening = parameters.get("sts_broadening", 0.0)
         self.ldos_emin = parameters.get("ldos_emin", 0)
         self.ldos_emax = parameters.get("ldos_emax", 0)
         self.ldos_delta_e = parameters.get("ldos_delta_e", 0.1)
@@ -429,6 +880,11 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
         self.stm_sample_bias = parameters.get("stm_sample_bias", "0.0")
         self.stm_heights = parameters.get("stm_heights", "2.0")
         self.stm_currents = parameters.get("stm_currents", "0.00005")
+        # Older runs only used critic2
+        self.stm_engine = parameters.get("stm_engine", "critic2")
+        self.stm_source = parameters.get("stm_source", "pp")
+        self.stm_ldos_weighting = parameters.get("stm_ldos_weighting", "trapezoid")
+        self.stm_ldos_broadening = parameters.get("stm_ldos_broadening", 0.0)
         self.calc_ildos_stm = parameters.get("calc_ildos_stm", False)
         self.ildos_stm_heights = parameters.get("ildos_stm_heights", "2.0")
         self.ildos_stm_currents = parameters.get("ildos_stm_currents", "0.1")
@@ -451,3 +907,5 @@ class PpConfigurationSettingsModel(ConfigurationSettingsModel, HasInputStructure
         self.on_change_calc_ildos()
         self.on_change_calc_ildos_stm()
         self.on_change_calc_ldos_grid()
+        self.on_change_stm_source()
+        self.on_change_calc_sts()
@@ -0,0 +1,241 @@
+"""Estimate the cost of a PP workchain before it is submitted.
+
+The estimates are built from the `output_parameters` of the parent pw.x
+calculation (FFT grid, bands and k-points) and are only meant as an order
+of magnitude.
+"""
+
+from aiidalab_qe_pp.app.utils import format_size
+from aiidalab_qe_pp.app.workchain import parse_list_of_tuples
+
+CUBE_VALUE_BYTES = 13 + 1 / 6  # "%13.5E" values, 6 per line
+CUBE_ATOM_BYTES = 60  # One line per atom in the cube header
+FILPLOT_VALUE_BYTES = 8  # pp.x also keeps the binary `filplot`
+ARRAY_VALUE_BYTES = 8  # Parsed data are stored as float64
+CRITIC2_COLUMNS = 5  # x y z (cartesian) and the STM value, per point of the map
+CRITIC2_VALUE_BYTES = 20
+
+# Fraction of the core time of the parent pw.x that one pp.x run takes
+WAVEFUNCTION_PASS_FRACTION = 0.1  # A pass over the wavefunctions (plot_num 3, 5, 7, 10)
+DENSITY_PASS_FRACTION = 0.01  # Charge/spin density and potential are only read
+CRITIC2_SECONDS_PER_POINT = 1e-6  # critic2 runs serially on the cube
+
+SCRATCH_WARNING = 10 * 1024**3  # Bytes written above which the plan is highlighted
+
+PROPERTY_LABELS = {
+    "calc_charge_dens": "Charge density",
+    "calc_spin_dens": "Spin density",
+    "calc_potential": "Potential",
+    "calc_wfn": "Orbitals",
+    "calc_ildos": "ILDOS",
+    "calc_ildos_stm": "ILDOS STM",
+    "calc_stm": "STM",
+    "calc_ldos_grid": "LDOS grid",
+    "calc_sts": "STS",
+}
+
+
+def _count_values(text):
+    try:
+        return len([float(value) for value in text.split()])
+    except ValueError:
+        return 0
+
+
+def _number_of_energies(emin, emax, delta_e):
+    if delta_e <= 0 or emax < emin:
+        return 0
+    return int((emax - emin) / delta_e + 1e-8) + 1
+
+
+def plan_pp_calculations(
+    output_parameters, settings, number_of_atoms=0, parent_core_hours=None
+):
+    """Predict the child calculations of a PP workchain and their cost.
+
+    `settings` is the state of the PP settings model (see
+    `PpConfigurationSettingsModel.get_model_state`). Returns a dict
+    {property: estimate} with the number of pp.x, critic2 and Python
+    (reduction and STM maps, see `stm_engine`) calculations, the number of
+    cube files, the bytes written on the remote scratch, the bytes retrieved
+    into the repository and the core-hours (None if the cost of the parent is
+    unknown), plus a "total" entry summing all the properties.
+    """
+    fft_grid = output_parameters.get("fft_grid")
+    if not fft_grid:
+        return {}
+    points = fft_grid[0] * fft_grid[1] * fft_grid[2]
+    map_points = fft_grid[0] * fft_grid[1]
+    cube_bytes = points * CUBE_VALUE_BYTES + number_of_atoms * CUBE_ATOM_BYTES
+    written_per_file = cube_bytes + points * FILPLOT_VALUE_BYTES
+    array_bytes = points * ARRAY_VALUE_BYTES
+    critic2_bytes = map_points * CRITIC2_COLUMNS * CRITIC2_VALUE_BYTES
+    reduce = settings.get("reduce_cube_files", False)
+    # STM maps computed in Python, one job for all the heights and currents
+    python_maps = settings.get("stm_engine", "critic2") == "numpy"
+
+    def estimate(
+        pp=0, files=0, critic2=0, parsed=True, pass_fraction=0.0, python=0, maps=None
+    ):
+        maps = critic2 if maps is None else maps
+        core_hours = None
+        if parent_core_hours is not None:
+            core_hours = pp * pass_fraction * parent_core_hours
+            core_hours += maps * map_points * CRITIC2_SECONDS_PER_POINT / 3600
+        return {
+            "pp": pp,
+            "critic2": critic2,
+            "python": (pp if reduce and parsed else 0) + python,
+            "files": files,
+            "written": files * written_per_file + maps * critic2_bytes,
+            # With `reduce_cube_files` the reduced arrays are at most as large
+            "retrieved": (files * array_bytes if parsed else 0) + maps * critic2_bytes,
+            "core_hours": core_hours,
+        }
+
+    def estimate_maps(heights, currents, calculations=1):
+        """Maps of `calculations` cube files, for each of them."""
+        if python_maps:
+            return {
+                "critic2": 0,
+                "python": calculations if heights or currents else 0,
+                "maps": calculations * (heights + currents),
+            }
+        return {"critic2": calculations * (heights + currents)}
+
+    plan = {}
+    if settings.get("calc_charge_dens"):
+        plan["calc_charge_dens"] = estimate(1, 1, pass_fraction=DENSITY_PASS_FRACTION)
+    if settings.get("calc_spin_dens"):
+        plan["calc_spin_dens"] = estimate(1, 1, pass_fraction=DENSITY_PASS_FRACTION)
+    if settings.get("calc_potential"):
+        plan["calc_potential"] = estimate(1, 1, pass_fraction=DENSITY_PASS_FRACTION)
+    if settings.get("calc_wfn"):
+        orbitals = parse_list_of_tuples(
+            settings.get("sel_orbital", []),
+            settings.get("current_calc_lsda", False),
+            output_parameters.get("number_of_k_points", 1),
+        )
+        files = sum(
+            orbital.get("kband(2)", orbital["kband(1)"]) - orbital["kband(1)"] + 1
+            for orbital in orbitals
+        )
+        plan["calc_wfn"] = estimate(
+            len(orbitals), files, pass_fraction=WAVEFUNCTION_PASS_FRACTION
+        )
+    if settings.get("calc_ildos"):
+        plan["calc_ildos"] = estimate(1, 1, pass_fraction=WAVEFUNCTION_PASS_FRACTION)
+        if settings.get("calc_ildos_stm"):
+            plan["calc_ildos_stm"] = estimate(
+                **estimate_maps(
+                    _count_values(settings.get("ildos_stm_heights", "")),
+                    _count_values(settings.get("ildos_stm_currents", "")),
+                )
+            )
+    if settings.get("calc_stm"):
+        biases = _count_values(settings.get("stm_sample_bias", ""))
+        if settings.get("stm_source", "pp") == "ldos_grid":
+            # One Python job integrating the LDOS grid (planned on its own)
+            maps = biases * (
+                _count_values(settings.get("stm_heights", ""))
+                + _count_values(settings.get("stm_currents", ""))
+            )
+            plan["calc_stm"] = estimate(python=1 if maps else 0, maps=maps)
+        else:
+            plan["calc_stm"] = estimate(
+                biases,
+                biases,
+                parsed=False,
+                pass_fraction=WAVEFUNCTION_PASS_FRACTION,
+                **estimate_maps(
+                    _count_values(settings.get("stm_heights", "")),
+                    _count_values(settings.get("stm_currents", "")),
+                    biases,
+                ),
+            )
+    if settings.get("calc_ldos_grid"):
+        energies = _number_of_energies(
+            settings.get("ldos_emin", 0),
+            settings.get("ldos_emax", 0),
+            settings.get("ldos_delta_e", 0.1),
+        )
+        plan["calc_ldos_grid"] = estimate(
+            1, energies, pass_fraction=WAVEFUNCTION_PASS_FRACTION * max(energies, 1)
+        )
+        if settings.get("calc_sts"):
+            # One Python job reading the LDOS grid, the maps have all the energies
+            maps = _count_values(settings.get("sts_heights", "")) + _count_values(
+                settings.get("sts_currents", "")
+            )
+            plan["calc_sts"] = estimate(python=1)
+            plan["calc_sts"]["retrieved"] = (
+                maps * energies * map_points * ARRAY_VALUE_BYTES
+            )
+
+    if plan:
+        total = {key: 0 for key in next(iter(plan.values()))}
+        for values in plan.values():
+            for key, value in values.items():
+                if key == "core_hours" and value is None:
+                    total[key] = None
+                elif total[key] is not None:
+                    total[key] += value
+        plan["total"] = total
+    return plan
+
+
+def format_plan(plan):
+    """Return an HTML table summarizing the result of `plan_pp_calculations`."""
+    if not plan:
+        return ""
+
+    def row(cells, tag="td"):
+        return "<tr>{}</tr>".format(
+            "".join(
+                f"<{tag} style='text-align:center; padding: 0 6px;'>{cell}</{tag}>"
+                for cell in cells
+            )
+        )
+
+    def values_row(label, values):
+        core_hours = values["core_hours"]
+        return row(
+            [
+                label,
+                values["pp"],
+                values["critic2"],
+                values["python"],
+                values["files"],
+                format_size(values["written"]),
+                format_size(values["retrieved"]),
+                "-" if core_hours is None else f"{core_hours:.2f}",
+            ]
+        )
+
+    header = row(
+        [
+            "Property",
+            "pp.x",
+            "critic2",
+            "Python",
+            "Cube files",
+            "Scratch",
+            "Retrieved",
+            "Core-hours",
+        ],
+        tag="th",
+    )
+    rows = "".join(
+        values_row(PROPERTY_LABELS[key], values)
+        for key, values in plan.items()
+        if key != "total"
+    )
+    total = plan["total"]
+    color = "red" if total["written"] > SCRATCH_WARNING else "#2c3e50"
+    return (
+        f"<div style='color: {color}; line-height: 140%;'>"
+        f"<b>Estimated cost:</b> {total['pp'] + total['critic2'] + total['python']} "
+        f"calculations, {format_size(total['written'])} written on the remote scratch."
+        "</div>"
+        f"<table>{header}{rows}{values_row('<b>Total</b>', total)}</table>"
+    )
@@ -0,0 +1,392 @@
+"""Helpers to access the remote folders of the calculations.
+
+All the remote operations of the app go through `transport_pool`, which keeps
+one transport per computer open for a short while, so that successive
+operations do not each pay for a new connection.
+
+AiiDA's ORM is not thread-safe: the nodes are only accessed in the calling
+thread, which resolves a `RemoteAccess` (plain values) for the worker threads.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from aiida.common.exceptions import NotExistent
+from tornado.ioloop import IOLoop
+
+REMOTE_CHECK_TIMEOUT = 30  # Seconds
+REMOTE_CHECK_TTL = 24 * 3600  # Seconds a stored check is trusted
+REMOTE_UNREACHABLE_TTL = 10 * 60  # Seconds a failed check is trusted
+REMOTE_CHECK_EXTRA = "aiidalab_qe_pp_remote_check"
+MAX_CHECK_WORKERS = 8
+
+TRANSPORT_IDLE_TIMEOUT = 120  # Seconds an unused transport is kept open
+TRANSPORT_WAIT_TIMEOUT = 120  # Seconds to wait for the transport of a busy computer
+LISTING_TTL = 60  # Seconds a listing of a remote folder is reused
+
+# Status of a remote folder
+ALIVE = "alive"
+EMPTY = "empty"
+MISSING = "missing"  # The folder does not exist anymore
+UNREACHABLE = "unreachable"  # The computer did not answer, may be temporary
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+class RemoteAccess:
+    """How to reach the computer of a `RemoteData`, without the ORM.
+
+    `key` identifies the computer (the pk of the `AuthInfo`) in the
+    `transport_pool` and `transport` is a new, not yet opened, transport to
+    it, used if no transport of the computer is open already.
+    """
+
+    def __init__(self, key, transport):
+        self.key = key
+        self.transport = transport
+
+
+def get_remote_access(remote_folder):
+    """Return the `RemoteAccess` of a `RemoteData`, to be called from the thread
+    that loaded the node. Raises `NotExistent` if the computer is not
+    configured for the current user."""
+    authinfo = remote_folder.get_authinfo()
+    return RemoteAccess(authinfo.pk, authinfo.get_transport())
+
+
+class TransportPool:
+    """Open transport of each computer (`AuthInfo`), reused between the
+    remote operations.
+
+    The computers are given as `RemoteAccess`. A single transport, i.e. one
+    authenticated connection (and one password or 2FA prompt), is opened per
+    computer and the operations on it are serialized: the other threads wait
+    until it is released, at most `wait_timeout` seconds (e.g. if the thread
+    using it was abandoned on a computer that stopped answering) before
+    `TimeoutError` is raised. The transports unused for `idle_timeout` seconds
+    are closed. The listings of the remote folders are kept for `listing_ttl`
+    seconds.
+    """
+
+    def __init__(
+        self,
+        idle_timeout=TRANSPORT_IDLE_TIMEOUT,
+        listing_ttl=LISTING_TTL,
+        wait_timeout=TRANSPORT_WAIT_TIMEOUT,
+    ):
+        self.idle_timeout = idle_timeout
+        self.listing_ttl = listing_ttl
+        self.wait_timeout = wait_timeout
+        self._transports = {}  # authinfo pk -> open transport
+        self._released = {}  # authinfo pk -> time the transport was released
+        self._busy = set()  # authinfo pk of the transports in use
+        self._condition = threading.Condition()
+        self._listings = {}  # (authinfo pk, path) -> (listed at, files)
+        self._reaper = None
+
+    @contextmanager
+    def transport(self, access):
+        """Yield the open transport of the computer of `access`."""
+        transport = self._acquire(access)
+        try:
+            yield transport
+        except FileNotFoundError:
+            # The computer answered, the transport can be used again
+            self._release(access.key)
+            raise
+        except BaseException:
+            # The connection may be broken, it is not reused
+            self._discard(access.key)
+            raise
+        else:
+            self._release(access.key)
+
+    def _acquire(self, access):
+        key = access.key
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: key not in self._busy, timeout=self.wait_timeout
+            ):
+                raise TimeoutError(
+                    f"the computer was busy for more than {self.wait_timeout} seconds"
+                )
+            self._busy.add(key)
+            transport = self._transports.get(key)
+            if transport is not None and transport.is_open:
+                return transport
+            self._transports.pop(key, None)
+        # The connection is opened outside of the lock, it can take a while.
+        # The computer stays busy meanwhile, so that it is opened only once.
+        try:
+            transport = access.transport
+            transport.open()
+        except BaseException:
+            with self._condition:
+                self._busy.discard(key)
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self._transports[key] = transport
+        return transport
+
+    def _release(self, key):
+        with self._condition:
+            self._busy.discard(key)
+            self._released[key] = time.monotonic()
+            self._condition.notify_all()
+            if self._reaper is None or not self._reaper.is_alive():
+                self._reaper = threading.Thread(target=self._close_idle, daemon=True)
+                self._reaper.start()
+
+    def _discard(self, key):
+        with self._condition:
+            transport = self._transports.pop(key, None)
+            self._busy.discard(key)
+            self._condition.notify_all()
+        if transport is not None:
+            self._close(transport)
+
+    @staticmethod
+    def _close(transport):
+        try:
+            transport.close()
+        except Exception:
+            pass
+
+    def _close_idle(self):
+        """Close the idle transports once they expire, until none is left open."""
+        while True:
+            time.sleep(min(self.idle_timeout, 10))
+            expired = []
+            with self._condition:
+                now = time.monotonic()
+                for key in list(self._transports):
+                    if (
+                        key not in self._busy
+                        and now - self._released.get(key, now) > self.idle_timeout
+                    ):
+                        expired.append(self._transports.pop(key))
+                remaining = bool(self._transports)
+                if not remaining:
+                    self._reaper = None
+            for transport in expired:
+                self._close(transport)
+            if not remaining:
+                return
+
+    def listdir(self, access, path, refresh=False):
+        """Return the files of the remote `path`, reusing a recent listing."""
+        key = (access.key, path)
+        with self._condition:
+            listing = self._listings.get(key)
+        if (
+            not refresh
+            and listing is not None
+            and time.monotonic() - listing[0] < self.listing_ttl
+        ):
+            return list(listing[1])
+        with self.transport(access) as transport:
+            files = transport.listdir(path)
+        with self._condition:
+            self._listings[key] = (time.monotonic(), files)
+        return list(files)
+
+    def forget_listing(self, access, path):
+        with self._condition:
+            self._listings.pop((access.key, path), None)
+
+    def close_all(self):
+        """Close the transports that are not in use."""
+        with self._condition:
+            idle = [
+                self._transports.pop(key)
+                for key in list(self._transports)
+                if key not in self._busy
+            ]
+        for transport in idle:
+            self._close(transport)
+
+
+transport_pool = TransportPool()
+
+
+def _check_folders(access, folders, on_result=None):
+    """List the `folders` (pk, path) through the transports of `access`."""
+    results = {}
+    try:
+        for pk, path in folders:
+            try:
+                files = transport_pool.listdir(access, path, refresh=True)
+                results[pk] = ALIVE if files else EMPTY
+            except FileNotFoundError:
+                results[pk] = MISSING
+            except TimeoutError:
+                # The computer is busy, the other folders would wait as well
+                raise
+            except OSError:
+                results[pk] = UNREACHABLE
+            if on_result:
+                on_result(pk, results[pk])
+    except Exception:
+        # The computer cannot be reached, none of the remaining folders is available
+        for pk, _ in folders:
+            if pk not in results:
+                results[pk] = UNREACHABLE
+                if on_result:
+                    on_result(pk, UNREACHABLE)
+    return results
+
+
+def resolve_remote_folders(remote_folders):
+    """Return the `RemoteData` folders to check, as plain values for the
+    worker threads: {authinfo pk: (access, [(pk, path), ...])}, and the pks of
+    the folders whose computer is not configured for the current user."""
+    groups = {}
+    unconfigured = []
+    for remote_folder in remote_folders:
+        try:
+            access = get_remote_access(remote_folder)
+        except NotExistent:
+            unconfigured.append(remote_folder.pk)
+            continue
+        groups.setdefault(access.key, (access, []))[1].append(
+            (remote_folder.pk, remote_folder.get_remote_path())
+        )
+    return groups, unconfigured
+
+
+def check_folder_groups(groups, timeout=REMOTE_CHECK_TIMEOUT, on_result=None):
+    """Check the folders of `resolve_remote_folders`, without the ORM.
+
+    Each group shares the open transport of its computer, and the groups are
+    checked concurrently. `on_result(pk, status)` is called (from the worker
+    threads) as soon as a folder has been checked. Returns a dict
+    {pk: status}, folders whose computer did not answer within `timeout`
+    seconds are missing from it.
+    """
+    if not groups:
+        return {}
+
+    executor = ThreadPoolExecutor(max_workers=min(MAX_CHECK_WORKERS, len(groups)))
+    futures = [
+        executor.submit(_check_folders, access, folders, on_result)
+        for access, folders in groups.values()
+    ]
+    done, _ = wait(futures, timeout=timeout)
+    # Do not wait for the computers that did not answer in time
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = {}
+    for future in done:
+        results.update(future.result())
+    return results
+
+
+def check_remote_folders(remote_folders, timeout=REMOTE_CHECK_TIMEOUT, on_result=None):
+    """Check the status (see ALIVE, EMPTY, MISSING and UNREACHABLE) of
+    `RemoteData` folders, blocking until done (see `check_folder_groups`)."""
+    groups, unconfigured = resolve_remote_folders(remote_folders)
+    results = dict.fromkeys(unconfigured, UNREACHABLE)
+    results.update(check_folder_groups(groups, timeout, on_result))
+    return results
+
+
+def store_remote_status(remote_folder, status):
+    """Store the result of a check as an extra of the `RemoteData`."""
+    remote_folder.base.extras.set(
+        REMOTE_CHECK_EXTRA, {"status": status, "timestamp": time.time()}
+    )
+
+
+def read_remote_status(remote_folders, ttl=REMOTE_CHECK_TTL):
+    """Return the stored checks of `RemoteData` folders.
+
+    Returns the dict {pk: status} of the stored checks, the folders to check
+    now and the folders whose check is older than `ttl` seconds. A failed
+    check (UNREACHABLE) is only trusted for `REMOTE_UNREACHABLE_TTL` seconds,
+    the computer may be back by then.
+    """
+    results = {}
+    unknown = []
+    stale = []
+    now = time.time()
+    for remote_folder in remote_folders:
+        stored = remote_folder.base.extras.get(REMOTE_CHECK_EXTRA, None)
+        age = None if stored is None else now - stored["timestamp"]
+        if age is None or (
+            stored["status"] == UNREACHABLE and age > min(ttl, REMOTE_UNREACHABLE_TTL)
+        ):
+            unknown.append(remote_folder)
+            continue
+        results[remote_folder.pk] = stored["status"]
+        if age > ttl:
+            stale.append(remote_folder)
+    return results, unknown, stale
+
+
+def refresh_remote_status(remote_folders):
+    """Check again `RemoteData` folders in a background thread.
+
+    The folders are resolved here and the results are stored from the IOLoop
+    of the calling thread, only the transports are used in the background.
+    """
+    with _refreshing_lock:
+        remote_folders = {
+            remote_folder.pk: remote_folder
+            for remote_folder in remote_folders
+            if remote_folder.pk not in _refreshing
+        }
+        _refreshing.update(remote_folders)
+    if not remote_folders:
+        return
+
+    groups, unconfigured = resolve_remote_folders(remote_folders.values())
+    for pk in unconfigured:
+        store_remote_status(remote_folders[pk], UNREACHABLE)
+    ioloop = IOLoop.current()
+
+    def store(statuses):
+        try:
+            for pk, status in statuses.items():
+                store_remote_status(remote_folders[pk], status)
+        finally:
+            with _refreshing_lock:
+                _refreshing.difference_update(remote_folders)
+
+    def refresh():
+        statuses = {}
+        try:
+            statuses = check_folder_groups(groups)
+        finally:
+            ioloop.add_callback(store, statuses)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_remote_folders_status(remote_folders, ttl=REMOTE_CHECK_TTL, on_result=None):
+    """Return the status {pk: status} of `RemoteData` folders, using the stored checks.
+
+    A stored check is trusted within `ttl` seconds (see `read_remote_status`).
+    Older ones are still used, but refreshed in the background for the next
+    time. The other folders are checked now (see `check_remote_folders`,
+    `on_result` is called from its worker threads) and their status is stored.
+    """
+    results, unknown, stale = read_remote_status(remote_folders, ttl)
+    if on_result:
+        for pk, status in results.items():
+            on_result(pk, status)
+
+    if unknown:
+        statuses = check_remote_folders(unknown, on_result=on_result)
+        for remote_folder in unknown:
+            if remote_folder.pk in statuses:
+                store_remote_status(remote_folder, statuses[remote_folder.pk])
+        results.update(statuses)
+
+    if stale:
+        refresh_remote_status(stale)
+
+    return results
@@ -1,5 +1,15 @@
 from aiidalab_qe.common.panel import ResultsModel
 import traitlets as tl
+import os
+import threading
+from tornado.ioloop import IOLoop
+
+from aiidalab_qe_pp.app.utils import (
+    DOWNLOADS_DIR,
+    JUPYTER_DIR,
+    cleanup_downloads,
+    get_jupyter_file_url,
+)
 
 
 class PpResultsModel(ResultsModel):
@@ -10,6 +20,9 @@ class PpResultsModel(ResultsModel):
 
     tab_titles = tl.List([])
 
+    exporting = tl.Bool(False)
+    export_status = tl.Unicode("")
+
     def get_pp_node(self):
         return self._get_child_outputs()
 
@@ -35,7 +48,7 @@ class PpResultsModel(ResultsModel):
 
     def needs_stm_tab(self):
         node = self.get_pp_node()
-        return "stm" in node
+        return "stm" in node or "sts" in node
 
     def needs_ldos_tab(self):
         node = self.get_pp_node()
@@ -44,3 +57,45 @@ class PpResultsModel(ResultsModel):
     def needs_ildos_stm_tab(self):
         node = self.get_pp_node()
         return "ildos_stm" in node
+
+    def export_hdf5(self, _=None):
+        """Export all the results into one HDF5 file in the background."""
+        if self.exporting:
+            return
+        self.exporting = True
+        self.export_status = "Preparing the export..."
+        threading.Thread(
+            target=self._export_hdf5,
+            args=(self.fetch_child_process_node().pk, IOLoop.current()),
+            daemon=True,
+        ).start()
+
+    def _export_hdf5(self, pk, ioloop):
+        """Write the HDF5 file (in the background thread), the traits are
+        updated on the kernel IOLoop."""
+        from aiidalab_qe_pp.export import export_hdf5
+
+        def update(**traits):
+            ioloop.add_callback(self.trait_set, **traits)
+
+        def on_progress(done, total):
+            update(export_status=f"Written {done} of {total} datasets...")
+
+        file_name = f"pp_results_{pk}.h5"
+        file_path = os.path.join(DOWNLOADS_DIR, file_name)
+        partial_path = f"{file_path}.part"
+        try:
+            cleanup_downloads()
+            # The node is loaded within this thread, which has its own storage session
+            export_hdf5(pk, partial_path, on_progress=on_progress)
+            os.replace(partial_path, file_path)
+            url = get_jupyter_file_url(os.path.relpath(file_path, JUPYTER_DIR))
+            status = f'<a href="{url}" download="{file_name}"><b>Download {file_name}</b></a>'
+        except Exception as e:
+            status = (
+                f'<div style="color: red; font-weight: bold;">Export failed: {e}</div>'
+            )
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        update(export_status=status, exporting=False)
@@ -4,27 +4,42 @@ from aiidalab_qe.common.panel import ResultsPanel
 from aiidalab_qe_pp.app.result.model import PpResultsModel
 import ipywidgets as ipw
 
-from aiidalab_qe_pp.app.result.widgets.cubevisualmodel import CubeVisualModel
-from aiidalab_qe_pp.app.result.widgets.cubevisualwidget import CubeVisualWidget
-from aiidalab_qe_pp.app.result.widgets.stmvisualmodel import STMVisualModel
-from aiidalab_qe_pp.app.result.widgets.stmvisualwidget import STMVisualWidget
-
-from aiidalab_qe_pp.app.result.widgets.wfnvisualwidget import WfnVisualWidget
-from aiidalab_qe_pp.app.result.widgets.wfnvisualmodel import WfnVisualModel
-
-from aiidalab_qe_pp.app.result.widgets.ldos3dvisualwidget import Ldos3DVisualWidget
-from aiidalab_qe_pp.app.result.widgets.ldos3dvisualmodel import Ldos3DVisualModel
-
 
 class PpResultsPanel(ResultsPanel[PpResultsModel]):
     title = "Post-processing"
     identifier = "pp"
     workchain_labels = ["pp"]
+    viewer_pool_size = 2
 
     def render(self):
         if self.rendered:
             return
 
+        # The visualization widgets pull in plotly, scipy, pymatgen and weas,
+        # they are only imported once the results are shown
+        from aiidalab_qe_pp.app.result.widgets.cubevisualmodel import CubeVisualModel
+        from aiidalab_qe_pp.app.result.widgets.cubevisualwidget import CubeVisualWidget
+        from aiidalab_qe_pp.app.result.widgets.stmvisualmodel import STMVisualModel
+        from aiidalab_qe_pp.app.result.widgets.stmvisualwidget import (
+            STMTabWidget,
+            STMVisualWidget,
+        )
+        from aiidalab_qe_pp.app.result.widgets.stsvisualmodel import STSVisualModel
+        from aiidalab_qe_pp.app.result.widgets.stsvisualwidget import STSVisualWidget
+        from aiidalab_qe_pp.app.result.widgets.wfnvisualwidget import WfnVisualWidget
+        from aiidalab_qe_pp.app.result.widgets.wfnvisualmodel import WfnVisualModel
+        from aiidalab_qe_pp.app.result.widgets.ldos3dvisualwidget import (
+            Ldos3DVisualWidget,
+        )
+        from aiidalab_qe_pp.app.result.widgets.ldos3dvisualmodel import (
+            Ldos3DVisualModel,
+        )
+        from aiidalab_qe_pp.app.result.widgets.viewerpool import WeasViewerPool
+        from aiidalab_qe_pp.cache import get_array
+
+        # The 3D viewers are shared by the tabs, only the last ones shown keep theirs
+        viewer_pool = WeasViewerPool(keep=self.viewer_pool_size)
+
         self.tabs = ipw.Tab(
             layout=ipw.Layout(min_height="250px"),
             selected_index=None,
@@ -41,22 +56,30 @@ class PpResultsPanel(ResultsPanel[PpResultsModel]):
 
         if needs_charge_dens:
             node = self._model.fetch_child_process_node()
-            cube_data = pp_node.charge_dens.output_data.get_array("data")
+            cube_data = get_array(pp_node.charge_dens.output_data)
             plot_num = "charge_dens"
             cube_visual_model = CubeVisualModel()
             cube_visual_widget = CubeVisualWidget(
-                cube_visual_model, node, cube_data, plot_num
+                cube_visual_model,
+                node,
+                cube_data,
+                plot_num,
+                viewer_pool=viewer_pool,
             )
             tab_data.append(("Charge density", cube_visual_widget))
 
         needs_spin_dens = self._model.needs_spin_dens_tab()
         if needs_spin_dens:
             node = self._model.fetch_child_process_node()
-            cube_data = pp_node.spin_dens.output_data.get_array("data")
+            cube_data = get_array(pp_node.spin_dens.output_data)
             plot_num = "spin_dens"
             cube_visual_model = CubeVisualModel()
             cube_visual_widget = CubeVisualWidget(
-                cube_visual_model, node, cube_data, plot_num
+                cube_visual_model,
+                node,
+                cube_data,
+                plot_num,
+                viewer_pool=viewer_pool,
             )
 
             tab_data.append(("Spin density", cube_visual_widget))
@@ -64,11 +87,15 @@ class PpResultsPanel(ResultsPanel[PpResultsModel]):
         needs_potential = self._model.needs_potential_tab()
         if needs_potential:
             node = self._model.fetch_child_process_node()
-            cube_data = pp_node.potential.output_data.get_array("data")
+            cube_data = get_array(pp_node.potential.output_data)
             plot_num = "potential"
             cube_visual_model = CubeVisualModel()
             cube_visual_widget = CubeVisualWidget(
-                cube_visual_model, node, cube_data, plot_num
+                cube_visual_model,
+                node,
+                cube_data,
+                plot_num,
+                viewer_pool=viewer_pool,
             )
             tab_data.append(("Potential", cube_visual_widget))
 
@@ -79,17 +106,22 @@ class PpResultsPanel(ResultsPanel[PpResultsModel]):
             wfn_visual_widget = WfnVisualWidget(
                 wfn_visual_model,
                 node,
+                viewer_pool=viewer_pool,
             )
             tab_data.append(("Orbitals", wfn_visual_widget))
 
         needs_ildos = self._model.needs_ildos_tab()
         if needs_ildos:
             node = self._model.fetch_child_process_node()
-            cube_data = pp_node.ildos.output_data.get_array("data")
+            cube_data = get_array(pp_node.ildos.output_data)
             plot_num = "ildos"
             cube_visual_model = CubeVisualModel()
             cube_visual_widget = CubeVisualWidget(
-                cube_visual_model, node, cube_data, plot_num
+                cube_visual_model,
+                node,
+                cube_data,
+                plot_num,
+                viewer_pool=viewer_pool,
             )
             tab_data.append(("ILDOS", cube_visual_widget))
 
@@ -103,9 +135,19 @@ class PpResultsPanel(ResultsPanel[PpResultsModel]):
 
         needs_stm = self._model.needs_stm_tab()
         if needs_stm:
-            stm_visual_model = STMVisualModel()
-            stm_visual_widget = STMVisualWidget(stm_visual_model, pp_node["stm"])
-            tab_data.append(("STM", stm_visual_widget))
+            stm_tabs = []
+            if "stm" in pp_node:
+                stm_visual_model = STMVisualModel()
+                stm_visual_widget = STMVisualWidget(stm_visual_model, pp_node["stm"])
+                stm_tabs.append(("Images", stm_visual_widget))
+            if "sts" in pp_node:
+                sts_visual_model = STSVisualModel()
+                sts_visual_widget = STSVisualWidget(sts_visual_model, pp_node["sts"])
+                stm_tabs.append(("dI/dV (STS)", sts_visual_widget))
+            if len(stm_tabs) == 1:
+                tab_data.append(("STM", stm_tabs[0][1]))
+            else:
+                tab_data.append(("STM", STMTabWidget(stm_tabs, selected_index=0)))
 
         needs_ldos = self._model.needs_ldos_tab()
         if needs_ldos:
@@ -114,6 +156,7 @@ class PpResultsPanel(ResultsPanel[PpResultsModel]):
             cube_visual_widget = Ldos3DVisualWidget(
                 cube_visual_model,
                 node,
+                viewer_pool=viewer_pool,
             )
             tab_data.append(("LDOS", cube_visual_widget))
 
@@ -122,11 +165,29 @@ class PpResultsPanel(ResultsPanel[PpResultsModel]):
         for index, (title, _) in enumerate(tab_data):
             self.tabs.set_title(index, title)
 
-        self.children = [self.tabs]
+        self.export_button = ipw.Button(
+            description="Export all (HDF5)",
+            button_style="primary",
+            tooltip="Export all the volumetric and STM results into one HDF5 file",
+            layout=ipw.Layout(width="200px"),
+        )
+        self.export_button.on_click(self._model.export_hdf5)
+        ipw.dlink((self._model, "exporting"), (self.export_button, "disabled"))
+        self.export_status = ipw.HTML("")
+        ipw.dlink((self._model, "export_status"), (self.export_status, "value"))
+
+        self.children = [
+            ipw.HBox([self.export_button, self.export_status]),
+            self.tabs,
+        ]
         self.tabs.selected_index = 0
         self.rendered = True
 
     def _on_tab_change(self, change):
         if (tab_index := change["new"]) is None:
             return
-        self.tabs.children[tab_index].render()  # type: ignore
+        tab = self.tabs.children[tab_index]
+        tab.render()  # type: ignore
+        if hasattr(tab, "attach_viewer"):
+            # Take back a viewer if another tab has been given this one's
+            tab.attach_viewer()
@@ -1,28 +1,23 @@
 from aiidalab_qe.common.mvc import Model
 import traitlets as tl
-import base64
 from ase.atoms import Atoms
-from IPython.display import Javascript
-from IPython.display import display
-import tempfile
-from pymatgen.io.common import VolumetricData
-import os
 from aiida.orm import StructureData
 from aiida.orm.nodes.process.workflow.workchain import WorkChainNode
 import numpy as np
-import threading
 
-from aiidalab_qe_pp.app.utils import download_remote_file
+from aiidalab_qe_pp.app.downloads import HasSourceDownload
+from aiidalab_qe_pp.app.utils import export_cube, trigger_download
+from aiidalab_qe_pp.cache import get_isovalue
 
 
-class CubeVisualModel(Model):
+class CubeVisualModel(Model, HasSourceDownload):
     node = tl.Instance(WorkChainNode, allow_none=True)
     input_structure = tl.Instance(Atoms, allow_none=True)
     aiida_structure = tl.Instance(StructureData, allow_none=True)
     cube_data = tl.Instance(np.ndarray, allow_none=True)
     plot_num = tl.Unicode("spin_dens")
     reduce_cube_files = tl.Bool(False)
-    error_message = tl.Unicode("")
+    compress_cube = tl.Bool(False)
 
     def fetch_data(self):
         self.input_structure = self.node.inputs.structure.get_ase()
@@ -31,63 +26,24 @@ class CubeVisualModel(Model):
             "reduce_cube_files", False
         )
 
-    def download_cube(self, _=None, filename="plot"):
-        # Create a temporary file, write to it, and initiate download
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".cube") as tmp:
-            # Write the cube data to a temporary file using pymatgen's VolumetricData
-            if self.aiida_structure.pbc != [True, True, True]:
-                structure_temp = self.aiida_structure.clone()
-                structure_temp.pbc = [True, True, True]
-                structure = structure_temp.get_pymatgen()
-            else:
-                structure = self.aiida_structure.get_pymatgen()
-
-            my_cube = VolumetricData(
-                structure=structure, data={"total": self.cube_data}
-            )
-            my_cube.to_cube(tmp.name)
-
-            # Move the file pointer back to the start for reading
-            tmp.seek(0)
-            raw_bytes = tmp.read()
-
-        # Encode the file content to base64
-        base64_payload = base64.b64encode(raw_bytes).decode()
+    def get_isovalue(self):
+        return get_isovalue(self.node.outputs[self.plot_num].output_data)
 
+    def download_cube(self, _=None, filename="plot"):
         # if filename is not provided, use plot_num
         if filename == "plot":
             filename = f"plot_{self.plot_num}"
 
-        # JavaScript to trigger download
-        filename = f"{filename}.cube"
-        js_download = Javascript(
-            f"""
-            var link = document.createElement('a');
-            link.href = "data:application/octet-stream;base64,{base64_payload}";
-            link.download = "{filename}";
-            document.body.appendChild(link);
-            link.click();
-            document.body.removeChild(link);
-            """
+        file_path = export_cube(
+            f"{filename}.cube",
+            self.input_structure,
+            self.cube_data,
+            compress=self.compress_cube,
         )
-        display(js_download)
-
-        # Clean up by removing the temporary file
-        os.unlink(tmp.name)
+        trigger_download(file_path)
 
     def download_source_files(self, _=None):
         remote_folder = self.node.outputs[f"{self.plot_num}"].remote_folder
-        if remote_folder.is_empty:
-            message = "Unfortunately the remote folder is empty."
-            self.error_message = (
-                f'<div style="color: red; font-weight: bold;">{message}</div>'
-            )
-            threading.Timer(10.0, self.clear_error_message).start()
-            return
-
-        download_remote_file(
-            remote_folder, f"plot_{self.plot_num}.cube", "aiida.fileout"
+        self.submit_source_download(
+            remote_folder, "aiida.fileout", f"plot_{self.plot_num}.cube"
         )
-
-    def clear_error_message(self):
-        self.error_message = ""
@@ -1,13 +1,21 @@
 import ipywidgets as ipw
-from weas_widget import WeasWidget
 from aiidalab_qe_pp.app.result.widgets.cubevisualmodel import CubeVisualModel
-import numpy as np
+from aiidalab_qe_pp.app.result.widgets.viewerpool import PooledViewerMixin
+from aiidalab_qe_pp.app.widgets import DownloadProgressWidget
 
 
-class CubeVisualWidget(ipw.VBox):
+class CubeVisualWidget(ipw.VBox, PooledViewerMixin):
     """Widget to visualize the output data from PPWorkChain."""
 
-    def __init__(self, model: CubeVisualModel, node, cube_data, plot_num, **kwargs):
+    def __init__(
+        self,
+        model: CubeVisualModel,
+        node,
+        cube_data,
+        plot_num,
+        viewer_pool=None,
+        **kwargs,
+    ):
         super().__init__(
             children=[ipw.HTML("Loading Cube data...")],
             **kwargs,
@@ -17,38 +25,13 @@ class CubeVisualWidget(ipw.VBox):
         self._model.cube_data = cube_data
         self._model.plot_num = plot_num
         self._model.fetch_data()
+        self._init_viewer_box(viewer_pool)
         self.rendered = False
 
     def render(self):
         if self.rendered:
             return
 
-        self.guiConfig = {
-            "components": {
-                "atomsControl": True,
-                "buttons": True,
-                "cameraControls": True,
-                "enabled": True,
-            },
-            "buttons": {
-                "fullscreen": True,
-                "download": True,
-                "measurement": True,
-                "enabled": True,
-            },
-        }
-        # WeasWidget Setting
-        self.viewer = WeasWidget(guiConfig=self.guiConfig)
-        self.viewer.from_ase(self._model.input_structure)
-        isovalue = 2 * np.std(self._model.cube_data) + np.mean(self._model.cube_data)
-        self.viewer.avr.iso.volumetric_data = {"values": self._model.cube_data}
-        self.viewer.avr.iso.settings = {
-            "positive": {"isovalue": isovalue},
-            "negative": {"isovalue": -isovalue, "color": "yellow"},
-        }
-        self.viewer.avr.color_type = "JMOL"
-        self.viewer.avr.model_style = 1
-
         # Download Cubefile Button
         self.download_button = ipw.Button(
             description="Cube file",
@@ -57,6 +40,13 @@ class CubeVisualWidget(ipw.VBox):
         )
 
         self.download_button.on_click(self._model.download_cube)
+        self.compress_cube = ipw.Checkbox(
+            description="gzip",
+            indent=False,
+            layout={"width": "fit-content"},
+        )
+        ipw.link((self._model, "compress_cube"), (self.compress_cube, "value"))
+        self.download_box = ipw.HBox([self.download_button, self.compress_cube])
 
         # Download original files from HPC source
 
@@ -74,20 +64,36 @@ class CubeVisualWidget(ipw.VBox):
         )
         self.download_source_button.on_click(self._model.download_source_files)
 
-        self.error_message = ipw.HTML("")
-        ipw.link((self._model, "error_message"), (self.error_message, "value"))
+        ipw.dlink(
+            (self._model, "downloading"), (self.download_source_button, "disabled")
+        )
+        self.download_progress = DownloadProgressWidget(self._model)
 
         self.download_source_box = ipw.VBox(
-            [self.info_original_files, self.download_source_button, self.error_message]
+            [
+                self.info_original_files,
+                self.download_source_button,
+                self.download_progress,
+            ]
         )
 
         if self._model.reduce_cube_files:
             self.children = [
-                self.viewer,
-                self.download_button,
+                self.viewer_box,
+                self.download_box,
                 self.download_source_box,
             ]
         else:
-            self.children = [self.viewer, self.download_button]
+            self.children = [self.viewer_box, self.download_box]
 
+        self.attach_viewer()
         self.rendered = True
+
+    def _update_plot(self):
+        isovalue = self._model.get_isovalue()
+        self.viewer.avr.iso.volumetric_data = {"values": self._model.cube_data}
+        self.viewer.avr.iso.settings = {
+            "positive": {"isovalue": isovalue},
+            "negative": {"isovalue": -isovalue, "color": "yellow"},
+        }
+        self.viewer.avr.draw()
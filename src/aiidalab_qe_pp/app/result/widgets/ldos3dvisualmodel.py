@@ -1,32 +1,46 @@
 from aiidalab_qe.common.mvc import Model
 import traitlets as tl
+from aiida import orm
 from aiida.orm import StructureData
 from aiida.orm.nodes.process.workflow.workchain import WorkChainNode
 import numpy as np
 from ase.atoms import Atoms
-from pymatgen.io.common import VolumetricData
-import base64
-from IPython.display import display, Javascript
-import tempfile
-import os
 import threading
 
-from aiidalab_qe_pp.app.utils import download_remote_file
+from aiidalab_qe_pp.app.downloads import HasSourceDownload
+from aiidalab_qe_pp.app.utils import export_cube, trigger_download
+from aiidalab_qe_pp.cache import (
+    array_cache,
+    disk_cache,
+    get_array,
+    get_array_slice,
+    get_isovalue,
+)
+from aiidalab_qe_pp.reader import parse_ldos_energies
 
+LDOS_INDEX_VERSION = 1
+LDOS_PREFETCH = 2  # Energies loaded ahead on each side of the current one
 
-class Ldos3DVisualModel(Model):
+
+class Ldos3DVisualModel(Model, HasSourceDownload):
     node = tl.Instance(WorkChainNode, allow_none=True)
     input_structure = tl.Instance(Atoms, allow_none=True)
     aiida_structure = tl.Instance(StructureData, allow_none=True)
     cube_data = tl.Instance(np.ndarray, allow_none=True)
     reduce_cube_files = tl.Bool(False)
-    error_message = tl.Unicode("")
+    compress_cube = tl.Bool(False)
 
     # calc_node_options = tl.List(trait=tl.List(tl.Union([tl.Unicode(), tl.Unicode()])), default_value=[])
     ldos_files_list_options = tl.List(
         trait=tl.List(tl.Union([tl.Unicode(), tl.Unicode()])), default_value=[]
     )  # tl.List()
     ldos_file = tl.Unicode()
+    energy_index = tl.Int(0)
+    energy_max_index = tl.Int(0)
+    archive_energy_range = tl.Tuple(tl.Int(), tl.Int(), default_value=(0, 0))
+
+    _ldos_lock = None
+    _prefetching = None
 
     def fetch_data(self):
         self.input_structure = self.node.inputs.structure.get_ase()
@@ -34,114 +48,168 @@ class Ldos3DVisualModel(Model):
         self.reduce_cube_files = self.node.inputs.parameters.get(
             "reduce_cube_files", False
         )
+        self._ldos_lock = threading.Lock()
+        self._prefetching = set()
         self.ldos_files_list_options = self.get_ldos_files_list_options()
+        self.energy_max_index = len(self.ldos_files_list_options) - 1
+        self.archive_energy_range = (0, self.energy_max_index)
         self.ldos_file = self.ldos_files_list_options[0][1]
-        if "output_data_multiple" in self.node.outputs.ldos_grid:
-            self.cube_data = self.node.outputs.ldos_grid.output_data_multiple[
-                self.ldos_file
-            ].get_array("data")
-        else:
-            self.cube_data = self.node.outputs.ldos_grid.output_data.get_array("data")
+        self.cube_data = self.get_ldos_data(self.ldos_file)
+
+    def get_energy_index(self):
+        """Return the energies, broadenings and keys of the LDOS files.
+
+        When the grids are stored one per energy, the energies are parsed from
+        the pp.x output once and kept in `disk_cache`, the node is not modified.
+        """
+        ldos_grid = self.node.outputs.ldos_grid
+        if "output_data_stack" in ldos_grid:
+            stack = ldos_grid.output_data_stack
+            return {
+                "energies": get_array(stack, "energies").tolist(),
+                "broadenings": stack.base.attributes.get("broadenings", []),
+                "keys": stack.base.attributes.get("labels"),
+            }
+
+        def compute():
+            energies, broadenings = parse_ldos_energies(
+                ldos_grid.retrieved.get_object_content("aiida.out"),
+                self.node.inputs.parameters.get("fermi", 0.0),
+            )
+            if "output_data_multiple" in ldos_grid:
+                keys = list(ldos_grid.output_data_multiple.keys())
+            else:
+                keys = ["output_data"]
+            return {
+                "energies": np.asarray(energies, dtype=float),
+                "broadenings": np.array(broadenings, dtype=str),
+                "keys": np.array(keys, dtype=str),
+            }
+
+        arrays = disk_cache.get_or_compute(
+            self.node.uuid, "ldos_index", LDOS_INDEX_VERSION, compute
+        )
+        return {name: array.tolist() for name, array in arrays.items()}
 
     def get_ldos_files_list_options(self):
-        import re
-
-        pattern = r"^\s*Energy\s*=.*"
-        aiida_out = self.node.outputs.ldos_grid.retrieved.get_object_content(
-            "aiida.out"
-        )
-        description_list = [
-            match.strip() for match in re.findall(pattern, aiida_out, re.MULTILINE)
+        energy_index = self.get_energy_index()
+        descriptions = [
+            f"Energy =  {energy:.5f} eV, broadening = {broadening}"
+            for energy, broadening in zip(
+                energy_index["energies"], energy_index["broadenings"]
+            )
         ]
-        fermi = self.node.inputs.parameters.get("fermi", 0.0)
-        updated_description_list = [
-            f"Energy =  {float(line.split('=')[1].split('eV')[0].strip()) - fermi:.5f} eV, broadening ={line.split('broadening =')[1]}"
-            for line in description_list
+        return list(zip(descriptions, energy_index["keys"]))
+
+    def _ldos_source(self, ldos_file, ldos_grid):
+        """Return the ArrayData holding the LDOS of `ldos_file`, and its index
+        in the stacked array (None if the grids are stored one per energy)."""
+        if "output_data_stack" in ldos_grid:
+            stack = ldos_grid.output_data_stack
+            return stack, stack.base.attributes.get("labels").index(ldos_file)
+        if "output_data_multiple" in ldos_grid:
+            return ldos_grid.output_data_multiple[ldos_file], None
+        return ldos_grid.output_data, None
+
+    def _read_ldos_data(self, ldos_file, ldos_grid):
+        array_node, index = self._ldos_source(ldos_file, ldos_grid)
+        if index is None:
+            return get_array(array_node)
+        # Only the slice of this energy is read from the repository
+        return get_array_slice(array_node, "data", index)
+
+    def _is_cached(self, ldos_file, ldos_grid):
+        array_node, index = self._ldos_source(ldos_file, ldos_grid)
+        key = (array_node.uuid, "data")
+        return key in array_cache or (
+            index is not None and (*key, index) in array_cache
+        )
+
+    def get_ldos_data(self, ldos_file):
+        """Return the LDOS grid of the energy file `ldos_file`, reusing the loaded ones."""
+        return self._read_ldos_data(ldos_file, self.node.outputs.ldos_grid)
+
+    def prefetch(self, index):
+        """Load the LDOS of the energies next to `index` in the background."""
+        keys = [key for _, key in self.ldos_files_list_options]
+        neighbours = [
+            keys[i]
+            for offset in range(1, LDOS_PREFETCH + 1)
+            for i in (index + offset, index - offset)
+            if 0 <= i < len(keys)
         ]
+        ldos_grid = self.node.outputs.ldos_grid
+        with self._ldos_lock:
+            neighbours = [
+                key
+                for key in neighbours
+                if key not in self._prefetching and not self._is_cached(key, ldos_grid)
+            ]
+            self._prefetching.update(neighbours)
+        if not neighbours:
+            return
+
+        def load(pk):
+            try:
+                # The node is loaded within this thread, which has its own storage session
+                ldos_grid = orm.load_node(pk).outputs.ldos_grid
+                for key in neighbours:
+                    self._read_ldos_data(key, ldos_grid)
+            except Exception:
+                pass  # The energy is simply loaded when it is shown
+            finally:
+                with self._ldos_lock:
+                    self._prefetching.difference_update(neighbours)
+
+        threading.Thread(target=load, args=(self.node.pk,), daemon=True).start()
 
-        if "output_data_multiple" in self.node.outputs.ldos_grid:
-            keys = list(self.node.outputs.ldos_grid.output_data_multiple.keys())
-        else:
-            keys = list("output_data")
-        return list(zip(updated_description_list, keys))
+    def on_energy_index_change(self):
+        self.ldos_file = self.ldos_files_list_options[self.energy_index][1]
+
+    def on_ldos_file_change(self):
+        keys = [key for _, key in self.ldos_files_list_options]
+        if self.ldos_file in keys:
+            self.energy_index = keys.index(self.ldos_file)
 
     def update_plot(self):
-        if "output_data_multiple" in self.node.outputs.ldos_grid:
-            self.cube_data = self.node.outputs.ldos_grid.output_data_multiple[
-                self.ldos_file
-            ].get_array("data")
-        else:
-            self.cube_data = self.node.outputs.ldos_grid.output_data.get_array("data")
-        isovalue = 2 * np.std(self.cube_data) + np.mean(self.cube_data)
+        self.cube_data = self.get_ldos_data(self.ldos_file)
+        self.prefetch(self.energy_index)
+        isovalue = get_isovalue(
+            *self._ldos_source(self.ldos_file, self.node.outputs.ldos_grid)
+        )
         return self.cube_data, isovalue
 
     def download_cube(self, _=None):
-        """Download the cube file with the current kpoint and band in the filename."""
-        filename = f"ldos_{self.ldos_file}"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".cube") as tmp:
-            # Write the cube data to a temporary file using pymatgen's VolumetricData
-            if self.aiida_structure.pbc != [True, True, True]:
-                structure_temp = self.aiida_structure.clone()
-                structure_temp.pbc = [True, True, True]
-                structure = structure_temp.get_pymatgen()
-            else:
-                structure = self.aiida_structure.get_pymatgen()
-
-            my_cube = VolumetricData(
-                structure=structure, data={"total": self.cube_data}
-            )
-            my_cube.to_cube(tmp.name)
-
-            # Move the file pointer back to the start for reading
-            tmp.seek(0)
-            raw_bytes = tmp.read()
-
-        # Encode the file content to base64
-        base64_payload = base64.b64encode(raw_bytes).decode()
-
-        # JavaScript to trigger download
-        filename = f"{filename}.cube"
-        js_download = Javascript(
-            f"""
-            var link = document.createElement('a');
-            link.href = "data:application/octet-stream;base64,{base64_payload}";
-            link.download = "{filename}";
-            document.body.appendChild(link);
-            link.click();
-            document.body.removeChild(link);
-            """
+        """Download the cube file with the current LDOS energy in the filename."""
+        file_path = export_cube(
+            f"ldos_{self.ldos_file}.cube",
+            self.input_structure,
+            self.cube_data,
+            compress=self.compress_cube,
         )
-        display(js_download)
+        trigger_download(file_path)
 
-        # Clean up by removing the temporary file
-        os.unlink(tmp.name)
+    @staticmethod
+    def _source_filenames(ldos_file):
+        """Return the name of the pp.x output of `ldos_file` and its local name."""
+        if ldos_file in ("aiida_fileout", "output_data"):
+            return "aiida.fileout", "plot_ldos.cube"
+        return f"aiida.filplot{ldos_file}aiida.fileout", f"plot_ldos_{ldos_file}.cube"
 
     def download_source_files(self, _=None):
         remote_folder = self.node.outputs.ldos_grid.remote_folder
-        if remote_folder.is_empty:
-            message = "Unfortunately the remote folder is empty."
-            self.error_message = (
-                f'<div style="color: red; font-weight: bold;">{message}</div>'
-            )
-            threading.Timer(10.0, self.clear_error_message).start()
-            return
+        filename_retrieved, filename = self._source_filenames(self.ldos_file)
+        self.submit_source_download(remote_folder, filename_retrieved, filename)
 
-        filename = (
-            f"plot_ldos_{self.ldos_file}.cube"
-            if "output_data_multiple" in self.node.outputs.ldos_grid
-            else "plot_ldos.cube"
-        )
-        filename_retrieved = (
-            f"aiida.filplot{self.ldos_file}aiida.fileout"
-            if "output_data_multiple" in self.node.outputs.ldos_grid
-            else "aiida.fileout"
-        )
-
-        download_remote_file(
-            remote_folder,
-            filename,
-            filename_retrieved,
+    def download_all_source_files(self, _=None):
+        """Download the source files of the energies in `archive_energy_range`
+        as one zip archive."""
+        remote_folder = self.node.outputs.ldos_grid.remote_folder
+        first, last = self.archive_energy_range
+        entries = [
+            (remote_folder, *self._source_filenames(ldos_file))
+            for _, ldos_file in self.ldos_files_list_options[first : last + 1]
+        ]
+        self.submit_archive_download(
+            entries, f"ldos_source_files_{self.node.pk}_{first}_{last}.zip"
         )
-
-    def clear_error_message(self):
-        self.error_message = ""
@@ -1,12 +1,13 @@
 import ipywidgets as ipw
-from weas_widget import WeasWidget
 from aiidalab_qe_pp.app.result.widgets.ldos3dvisualmodel import Ldos3DVisualModel
+from aiidalab_qe_pp.app.result.widgets.viewerpool import PooledViewerMixin
+from aiidalab_qe_pp.app.widgets import DownloadProgressWidget
 
 
-class Ldos3DVisualWidget(ipw.VBox):
+class Ldos3DVisualWidget(ipw.VBox, PooledViewerMixin):
     """Widget to visualize the output data from PPWorkChain."""
 
-    def __init__(self, model: Ldos3DVisualModel, node, **kwargs):
+    def __init__(self, model: Ldos3DVisualModel, node, viewer_pool=None, **kwargs):
         super().__init__(
             children=[ipw.HTML("Loading Ldos3D data...")],
             **kwargs,
@@ -14,27 +15,13 @@ class Ldos3DVisualWidget(ipw.VBox):
         self._model = model
         self._model.node = node
         self._model.fetch_data()
+        self._init_viewer_box(viewer_pool)
         self.rendered = False
 
     def render(self):
         if self.rendered:
             return
 
-        self.guiConfig = {
-            "components": {
-                "atomsControl": True,
-                "buttons": True,
-                "cameraControls": True,
-                "enabled": True,
-            },
-            "buttons": {
-                "fullscreen": True,
-                "download": True,
-                "measurement": True,
-                "enabled": True,
-            },
-        }
-
         self.ldos_files_list = ipw.Dropdown(
             description="Ldos files:",
             style={"description_width": "initial"},
@@ -47,12 +34,45 @@ class Ldos3DVisualWidget(ipw.VBox):
         ipw.link((self._model, "ldos_file"), (self.ldos_files_list, "value"))
         self.ldos_files_list.observe(self._on_ldos_file_change, "value")
 
+        self.energy_slider = ipw.IntSlider(
+            description="Energy:",
+            min=0,
+            readout=False,
+            continuous_update=True,
+            style={"description_width": "initial"},
+            layout={"width": "400px"},
+        )
+        ipw.dlink(
+            (self._model, "energy_max_index"),
+            (self.energy_slider, "max"),
+        )
+        ipw.link((self._model, "energy_index"), (self.energy_slider, "value"))
+        self.energy_slider.observe(self._on_energy_index_change, "value")
+        self.energy_play = ipw.Play(
+            interval=500,
+            min=0,
+            description="Sweep the energies",
+        )
+        ipw.dlink(
+            (self._model, "energy_max_index"),
+            (self.energy_play, "max"),
+        )
+        ipw.jslink((self.energy_play, "value"), (self.energy_slider, "value"))
+        self.energy_box = ipw.HBox([self.energy_play, self.energy_slider])
+
         self.download_button = ipw.Button(
             description="Cube file",
             button_style="primary",
             icon="download",
         )
         self.download_button.on_click(self._model.download_cube)
+        self.compress_cube = ipw.Checkbox(
+            description="gzip",
+            indent=False,
+            layout={"width": "fit-content"},
+        )
+        ipw.link((self._model, "compress_cube"), (self.compress_cube, "value"))
+        self.download_box = ipw.HBox([self.download_button, self.compress_cube])
 
         # Download original files from HPC source
         self.info_original_files = ipw.HTML(
@@ -68,37 +88,79 @@ class Ldos3DVisualWidget(ipw.VBox):
             icon="download",
         )
         self.download_source_button.on_click(self._model.download_source_files)
-        self.error_message = ipw.HTML("")
-        ipw.link((self._model, "error_message"), (self.error_message, "value"))
+        ipw.dlink(
+            (self._model, "downloading"), (self.download_source_button, "disabled")
+        )
+        self.download_all_source_button = ipw.Button(
+            description="All source files",
+            button_style="primary",
+            icon="file-archive-o",
+            tooltip="Download the source files of the energy range as one zip archive",
+            layout={"width": "fit-content"},
+        )
+        self.download_all_source_button.on_click(self._model.download_all_source_files)
+        ipw.dlink(
+            (self._model, "downloading"),
+            (self.download_all_source_button, "disabled"),
+        )
+        self.archive_energy_range = ipw.IntRangeSlider(
+            description="Energies:",
+            min=0,
+            continuous_update=False,
+            style={"description_width": "initial"},
+        )
+        ipw.dlink((self._model, "energy_max_index"), (self.archive_energy_range, "max"))
+        ipw.link(
+            (self._model, "archive_energy_range"),
+            (self.archive_energy_range, "value"),
+        )
+        self.download_progress = DownloadProgressWidget(self._model)
         self.download_source_box = ipw.VBox(
-            [self.info_original_files, self.download_source_button, self.error_message]
+            [
+                self.info_original_files,
+                ipw.HBox(
+                    [
+                        self.download_source_button,
+                        self.download_all_source_button,
+                        self.archive_energy_range,
+                    ]
+                ),
+                self.download_progress,
+            ]
         )
 
-        self.plot = WeasWidget(guiConfig=self.guiConfig)
-        self.plot.from_ase(self._model.input_structure)
-        self.plot.avr.color_type = "JMOL"
-        self.plot.avr.model_style = 1
-        self._update_plot()
-
         if self._model.reduce_cube_files:
             self.children = [
                 self.ldos_files_list,
-                self.plot,
-                self.download_button,
+                self.energy_box,
+                self.viewer_box,
+                self.download_box,
                 self.download_source_box,
             ]
         else:
-            self.children = [self.ldos_files_list, self.plot, self.download_button]
+            self.children = [
+                self.ldos_files_list,
+                self.energy_box,
+                self.viewer_box,
+                self.download_box,
+            ]
+        self.attach_viewer()
         self.rendered = True
 
     def _update_plot(self):
+        if self.viewer is None:
+            return
         cube_data, isovalue = self._model.update_plot()
-        self.plot.avr.iso.volumetric_data = {"values": cube_data}
-        self.plot.avr.iso.settings = {
+        self.viewer.avr.iso.volumetric_data = {"values": cube_data}
+        self.viewer.avr.iso.settings = {
             "positive": {"isovalue": isovalue},
             "negative": {"isovalue": -isovalue, "color": "yellow"},
         }
-        self.plot.avr.draw()
+        self.viewer.avr.draw()
 
     def _on_ldos_file_change(self, _):
+        self._model.on_ldos_file_change()
         self._update_plot()
+
+    def _on_energy_index_change(self, _):
+        self._model.on_energy_index_change()
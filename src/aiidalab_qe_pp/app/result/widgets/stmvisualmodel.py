@@ -8,6 +8,20 @@ from scipy.ndimage import gaussian_filter
 from IPython.display import display
 import base64
 import json
+import os
+import tempfile
+import threading
+import zipfile
+from tornado.ioloop import IOLoop
+
+from aiidalab_qe_pp.app.utils import (
+    DOWNLOADS_DIR,
+    JUPYTER_DIR,
+    cleanup_downloads,
+    get_jupyter_file_url,
+)
+from aiidalab_qe_pp.cache import disk_cache, get_array
+from aiidalab_qe_pp.reader import parse_stm_label
 
 SETTINGS = {
     "margin": {"l": 50, "r": 50, "b": 50, "t": 80},
@@ -18,6 +32,54 @@ SETTINGS = {
     "default_color_scale": "Hot",
 }
 
+# Increase when `process_stm_data` changes, to discard the grids cached on disk
+STM_PROCESSING_VERSION = 1
+STM_GRIDS = ("unique_x", "unique_y", "x_grid", "y_grid", "z_grid")
+
+
+def process_stm_data(x_cart, y_cart, f_stm):
+    """Interpolate the scattered STM points of critic2 on a regular grid.
+
+    Returns the unique x and y coordinates and the X, Y, Z grids.
+    """
+    valid_indices = ~np.isnan(x_cart) & ~np.isnan(y_cart) & ~np.isnan(f_stm)
+    x_valid = x_cart[valid_indices]
+    y_valid = y_cart[valid_indices]
+    z_valid = f_stm[valid_indices]
+
+    epsilon = 1e-6
+    unique_x = np.unique(np.where(np.abs(x_valid) < epsilon, 0, x_valid))
+    unique_y = np.unique(np.where(np.abs(y_valid) < epsilon, 0, y_valid))
+
+    X, Y = np.meshgrid(unique_x, unique_y)
+    Z = griddata((x_valid, y_valid), z_valid, (X, Y), method="cubic")
+
+    # **Check if NaNs exist**
+    if np.isnan(Z).any():
+        # Create mask of NaNs
+        nan_mask = np.isnan(Z)
+
+        # Use Gaussian smoothing (fills NaNs without changing shape)
+        Z_filled = gaussian_filter(Z, sigma=1)
+
+        # Replace NaN values only
+        Z[nan_mask] = Z_filled[nan_mask]
+
+    return unique_x, unique_y, X, Y, Z
+
+
+def write_images(figures, paths, image_format):
+    """Render several figures to image files."""
+    import plotly.io as pio
+
+    if hasattr(pio, "write_images"):
+        # plotly>=6.1 renders the whole batch within a single kaleido session
+        pio.write_images(figures, paths, format=image_format)
+    else:
+        # Older kaleido keeps its renderer process alive between calls
+        for fig, path in zip(figures, paths):
+            pio.write_image(fig, path, format=image_format)
+
 
 class STMVisualModel(Model):
     node = tl.Instance(AttributeDict, allow_none=True)
@@ -56,7 +118,19 @@ class STMVisualModel(Model):
     )
     image_format = tl.Unicode("png")
 
+    exporting = tl.Bool(False)
+    export_status = tl.Unicode("")
+
+    # Sweep mode
+    sweep_mode = tl.Bool(False)
+    sweep_axis_options = tl.List(
+        trait=tl.List(tl.Unicode()),
+        default_value=[("Sample bias", "stm_bias"), ("Height / current", "value")],
+    )
+    sweep_axis = tl.Unicode("stm_bias")
+
     def fetch_data(self):
+        self._processed_data = {}
         self.list_calcs = list(self.node.keys())
         self.dict_calcs = self.parse_strings_to_dicts(self.list_calcs)
         self.calc_node_options = self._get_calc_options()
@@ -67,21 +141,38 @@ class STMVisualModel(Model):
             self.stm_bias = self.dict_calcs[self.calc_node]["stm_bias"]
         self.mode = self.dict_calcs[self.calc_node]["mode"]
         self.value = self.dict_calcs[self.calc_node]["value"]
-        self.x_cart = self.node[self.list_calcs[self.calc_node]]["stm_data"].get_array(
-            "xcart"
-        )
-        self.y_cart = self.node[self.list_calcs[self.calc_node]]["stm_data"].get_array(
-            "ycart"
-        )
-        self.f_stm = self.node[self.list_calcs[self.calc_node]]["stm_data"].get_array(
-            "fstm"
-        )
+        self.x_cart, self.y_cart, self.f_stm = self.get_stm_arrays(self.calc_node)
         self._process_data()
         self.zmax = np.nanmax(self.z_grid)
         self.zmax_min = np.nanmin(self.z_grid)
         self.zmax_max = np.nanmax(self.z_grid)
         self.zmax_step = (np.nanmax(self.z_grid) - np.nanmin(self.z_grid)) / 100
 
+    def get_processed_data(self, index):
+        """Return the interpolated grids of the calculation at `index`, computed once
+        (they are also kept on disk for the next sessions)."""
+        if index not in self._processed_data:
+
+            def compute():
+                grids = process_stm_data(*self.get_stm_arrays(index))
+                return dict(zip(STM_GRIDS, grids))
+
+            stm_data = self.node[self.list_calcs[index]]["stm_data"]
+            arrays = disk_cache.get_or_compute(
+                stm_data.uuid, "stm_grids", STM_PROCESSING_VERSION, compute
+            )
+            self._processed_data[index] = tuple(arrays[name] for name in STM_GRIDS)
+        return self._processed_data[index]
+
+    def get_stm_arrays(self, index):
+        """Return the x, y and STM values of the calculation at `index`."""
+        stm_data = self.node[self.list_calcs[index]]["stm_data"]
+        return (
+            get_array(stm_data, "xcart"),
+            get_array(stm_data, "ycart"),
+            get_array(stm_data, "fstm"),
+        )
+
     def update_plot(self):
         self._on_change_calc_node()
         # Clear existing data
@@ -106,90 +197,188 @@ class STMVisualModel(Model):
         ]
 
     def parse_strings_to_dicts(self, strings):
-        def parse_float(parts):
-            if len(parts) == 1:
-                return float(parts[0])
-            elif len(parts) == 2:
-                return float(parts[0] + "." + parts[1])
-            return None
-
-        result = []
-
-        for s in strings:
-            # Determine mode and extract value
-            mode = next((m for m in ["height", "current"] if m in s), None)
-            if not mode:
-                continue
-
-            start_index = s.find(mode)
-            end_index = start_index + len(mode)
-            mode_value = s[end_index + 1 :].split("_")
-            value_float = parse_float(mode_value)
-            if value_float is None:
-                continue
-
-            # Determine bias if present
-            bias_value_float = None
-            if "stm_bias" in s:
-                bias_value = s[
-                    s.find("stm_bias") + len("stm_bias") + 1 : start_index - 1
-                ]
-                bias_sign = -1 if "neg_" in bias_value else 1
-                bias_to_split = bias_value.replace("neg_", "").split("_")
-                bias_value_float = parse_float(bias_to_split)
-                if bias_value_float is not None:
-                    bias_value_float *= bias_sign
-
-            # Construct result dictionary
-            entry = {"mode": mode, "value": value_float}
-            if bias_value_float is not None:
-                entry["stm_bias"] = bias_value_float
-
-            result.append(entry)
-
-        return result
+        entries = (parse_stm_label(s) for s in strings)
+        return [entry for entry in entries if entry is not None]
 
     def _process_data(self):
-        valid_indices = (
-            ~np.isnan(self.x_cart) & ~np.isnan(self.y_cart) & ~np.isnan(self.f_stm)
+        (
+            self.unique_x,
+            self.unique_y,
+            self.x_grid,
+            self.y_grid,
+            self.z_grid,
+        ) = self.get_processed_data(self.calc_node)
+
+    def _update_data(self):
+        return [self._heatmap(self.z_grid, self.unique_x, self.unique_y, self.mode)]
+
+    @staticmethod
+    def _heatmap(z_grid, unique_x, unique_y, mode):
+        return go.Heatmap(
+            z=z_grid,
+            x=unique_x,
+            y=unique_y,
+            colorscale=SETTINGS["default_color_scale"],
+            colorbar=dict(
+                title=f"{'Distance to the surface (Å)' if mode == 'current' else 'Electron density (a.u.)'}"
+            ),
         )
-        x_valid = self.x_cart[valid_indices]
-        y_valid = self.y_cart[valid_indices]
-        z_valid = self.f_stm[valid_indices]
 
-        epsilon = 1e-6
-        self.unique_x = np.unique(np.where(np.abs(x_valid) < epsilon, 0, x_valid))
-        self.unique_y = np.unique(np.where(np.abs(y_valid) < epsilon, 0, y_valid))
+    @staticmethod
+    def _base_layout(mode, value, unique_x, unique_y):
+        """Return the title, axes and size settings of a STM plot."""
+        return dict(
+            # Title settings
+            title=dict(
+                text=f"Constant {mode} plot, {value} {'Å' if mode == 'height' else '(au)'}",
+                x=0.5,  # Center the title
+                y=0.85,  # Adjust the vertical position of the title
+                xanchor="center",
+                yanchor="top",
+            ),
+            # X-axis settings
+            xaxis=dict(
+                title="x (Å)",
+                range=[np.min(unique_x), np.max(unique_x)],
+                tickmode="auto",
+                ticks="outside",
+                showline=True,
+                mirror=True,
+                showgrid=False,
+            ),
+            # Y-axis settings
+            yaxis=dict(
+                title="y (Å)",
+                range=[np.min(unique_y), np.max(unique_y)],
+                tickmode="auto",
+                ticks="outside",
+                showline=True,
+                mirror=True,
+                showgrid=False,
+            ),
+            # General layout settings
+            autosize=False,
+            width=SETTINGS["width"],
+            height=SETTINGS["height"],
+            margin=SETTINGS["margin"],
+        )
 
-        X, Y = np.meshgrid(self.unique_x, self.unique_y)
-        Z = griddata((x_valid, y_valid), z_valid, (X, Y), method="cubic")
+    def create_figure(self, index):
+        """Create a static figure of the calculation at `index`."""
+        entry = self.dict_calcs[index]
+        unique_x, unique_y, _, _, z_grid = self.get_processed_data(index)
+        fig = go.Figure(data=[self._heatmap(z_grid, unique_x, unique_y, entry["mode"])])
+        title = (
+            (f"STM Bias: {entry['stm_bias']} eV, " if "stm_bias" in entry else "")
+            + f"Constant {entry['mode']}, {entry['value']} {'Å' if entry['mode'] == 'height' else '(au)'}"
+        )
+        layout = self._base_layout(entry["mode"], entry["value"], unique_x, unique_y)
+        layout["title"]["text"] = title
+        fig.update_layout(**layout)
+        return fig
 
-        # **Check if NaNs exist**
-        if np.isnan(Z).any():
-            # Create mask of NaNs
-            nan_mask = np.isnan(Z)
+    def get_sweep_indices(self, axis):
+        """Return the calculations sweeping `axis` around the selected one, sorted along `axis`.
 
-            # Use Gaussian smoothing (fills NaNs without changing shape)
-            Z_filled = gaussian_filter(Z, sigma=1)
+        The other parameters (mode, and value or bias) are those of the selected calculation.
+        """
+        current = self.dict_calcs[self.calc_node]
+        fixed = "value" if axis == "stm_bias" else "stm_bias"
+        indices = [
+            index
+            for index, entry in enumerate(self.dict_calcs)
+            if entry["mode"] == current["mode"]
+            and entry.get(fixed) == current.get(fixed)
+            and axis in entry
+        ]
+        return sorted(indices, key=lambda index: self.dict_calcs[index][axis])
 
-            # Replace NaN values only
-            Z[nan_mask] = Z_filled[nan_mask]
+    def create_sweep_figure(self):
+        """Create an animated figure with one frame per map of the sweep.
 
-        self.x_grid = X
-        self.y_grid = Y
-        self.z_grid = Z
+        All maps are interpolated once here, playback runs in the browser.
+        """
+        current = self.dict_calcs[self.calc_node]
+        mode = current["mode"]
+        unit = "Å" if mode == "height" else "(au)"
+        indices = self.get_sweep_indices(self.sweep_axis) or [self.calc_node]
+
+        frames = []
+        for index in indices:
+            entry = self.dict_calcs[index]
+            unique_x, unique_y, _, _, z_grid = self.get_processed_data(index)
+            label = (
+                f"{entry['stm_bias']} eV"
+                if self.sweep_axis == "stm_bias"
+                else f"{entry['value']} {unit}"
+            )
+            frames.append(
+                go.Frame(
+                    data=[self._heatmap(z_grid, unique_x, unique_y, mode)],
+                    name=label,
+                )
+            )
 
-    def _update_data(self):
-        heatmap = go.Heatmap(
-            z=self.z_grid,
-            x=self.unique_x,
-            y=self.unique_y,
-            colorscale=SETTINGS["default_color_scale"],
-            colorbar=dict(
-                title=f"{'Distance to the surface (Å)' if self.mode == 'current' else 'Electron density (a.u.)'}"
-            ),
+        fig = go.Figure(data=frames[0].data, frames=frames)
+        layout = self._base_layout(mode, current["value"], unique_x, unique_y)
+        layout["title"]["text"] = (
+            f"Constant {mode} plot, {current['value']} {unit}"
+            if self.sweep_axis == "stm_bias"
+            else f"Constant {mode} plot"
+            + (f", STM Bias: {current['stm_bias']} eV" if "stm_bias" in current else "")
+        )
+        animation_args = {
+            "mode": "immediate",
+            "frame": {"duration": 500, "redraw": True},
+            "transition": {"duration": 0},
+        }
+        fig.update_layout(
+            **layout,
+            sliders=[
+                dict(
+                    active=0,
+                    currentvalue={
+                        "prefix": "Sample bias: "
+                        if self.sweep_axis == "stm_bias"
+                        else f"Constant {mode}: "
+                    },
+                    pad={"t": 50},
+                    steps=[
+                        dict(
+                            method="animate",
+                            label=frame.name,
+                            args=[[frame.name], animation_args],
+                        )
+                        for frame in frames
+                    ],
+                )
+            ],
+            updatemenus=[
+                dict(
+                    type="buttons",
+                    direction="left",
+                    showactive=False,
+                    x=0.1,
+                    xanchor="right",
+                    y=0,
+                    yanchor="top",
+                    pad={"r": 10, "t": 70},
+                    buttons=[
+                        dict(
+                            label="Play",
+                            method="animate",
+                            args=[None, {**animation_args, "fromcurrent": True}],
+                        ),
+                        dict(
+                            label="Pause",
+                            method="animate",
+                            args=[[None], animation_args],
+                        ),
+                    ],
+                )
+            ],
         )
-        return [heatmap]
+        return fig
 
     def create_plot(self):
         fig = go.Figure(data=self._update_data())
@@ -199,39 +388,9 @@ class STMVisualModel(Model):
     def update_layout(self, fig, color_scale=SETTINGS["default_color_scale"]):
         with fig.batch_update():
             fig.update_layout(
-                # Title settings
-                title=dict(
-                    text=f"Constant {self.mode} plot, {self.value} {'Å' if self.mode == 'height' else '(au)'}",
-                    x=0.5,  # Center the title
-                    y=0.85,  # Adjust the vertical position of the title
-                    xanchor="center",
-                    yanchor="top",
-                ),
-                # X-axis settings
-                xaxis=dict(
-                    title="x (Å)",
-                    range=[np.min(self.unique_x), np.max(self.unique_x)],
-                    tickmode="auto",
-                    ticks="outside",
-                    showline=True,
-                    mirror=True,
-                    showgrid=False,
-                ),
-                # Y-axis settings
-                yaxis=dict(
-                    title="y (Å)",
-                    range=[np.min(self.unique_y), np.max(self.unique_y)],
-                    tickmode="auto",
-                    ticks="outside",
-                    showline=True,
-                    mirror=True,
-                    showgrid=False,
+                **self._base_layout(
+                    self.mode, self.value, self.unique_x, self.unique_y
                 ),
-                # General layout settings
-                autosize=False,
-                width=SETTINGS["width"],
-                height=SETTINGS["height"],
-                margin=SETTINGS["margin"],
                 # Update menus for interactivity
                 updatemenus=[
                     dict(
@@ -333,6 +492,63 @@ class STMVisualModel(Model):
         )
         display(javas)
 
+    def export_all_images(self, _=None):
+        """Export the images of all the calculations as a zip file in the background."""
+        if self.exporting:
+            return
+        self.exporting = True
+        self.export_status = "Preparing the export..."
+        threading.Thread(
+            target=self._export_all_images,
+            args=(self.image_format, IOLoop.current()),
+            daemon=True,
+        ).start()
+
+    def _export_all_images(self, image_format, ioloop):
+        """Write the zip file (in the background thread), the traits are
+        updated on the kernel IOLoop."""
+
+        def update(**traits):
+            ioloop.add_callback(self.trait_set, **traits)
+
+        try:
+            figures = []
+            names = []
+            for index in range(len(self.dict_calcs)):
+                update(
+                    export_status=(
+                        f"Processing image {index + 1} of {len(self.dict_calcs)}..."
+                    )
+                )
+                figures.append(self.create_figure(index))
+                names.append(f"{self.list_calcs[index]}.{image_format}")
+
+            update(export_status=f"Rendering {len(figures)} images...")
+            cleanup_downloads()
+            with tempfile.TemporaryDirectory() as tmpdir:
+                paths = [os.path.join(tmpdir, name) for name in names]
+                write_images(figures, paths, image_format)
+
+                fd, zip_path = tempfile.mkstemp(
+                    prefix="stm_images_", suffix=".zip", dir=DOWNLOADS_DIR
+                )
+                os.close(fd)
+                with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                    for path, name in zip(paths, names):
+                        archive.write(path, name)
+
+            zip_name = os.path.basename(zip_path)
+            url = get_jupyter_file_url(os.path.relpath(zip_path, JUPYTER_DIR))
+            status = (
+                f'<a href="{url}" download="{zip_name}">'
+                f"<b>Download {len(names)} images ({zip_name})</b></a>"
+            )
+        except Exception as e:
+            status = (
+                f'<div style="color: red; font-weight: bold;">Export failed: {e}</div>'
+            )
+        update(export_status=status, exporting=False)
+
     def download_data(self, _=None):
         filename = "stm_calculation.json"
         my_dict = {
@@ -1,4 +1,5 @@
 import ipywidgets as ipw
+from IPython.display import display
 
 from aiidalab_qe_pp.app.result.widgets.stmvisualmodel import STMVisualModel
 
@@ -61,9 +62,48 @@ class STMVisualWidget(ipw.VBox):
         ipw.dlink((self._model, "zmax_step"), (self.zmax, "step"))
         self.zmax.observe(self._update_plot_zmax, "value")
 
-        self.download_buttons = ipw.HBox(
-            [self.download_raw_button, self.download_image, self.image_format]
+        self.export_all_button = ipw.Button(
+            description="Export all images",
+            button_style="primary",
+            icon="file-archive-o",
+            tooltip="Export the images of all calculations as a zip file",
         )
+        self.export_all_button.on_click(self._model.export_all_images)
+        ipw.dlink((self._model, "exporting"), (self.export_all_button, "disabled"))
+        self.export_status = ipw.HTML("")
+        ipw.dlink((self._model, "export_status"), (self.export_status, "value"))
+
+        self.download_buttons = ipw.VBox(
+            [
+                ipw.HBox(
+                    [
+                        self.download_raw_button,
+                        self.download_image,
+                        self.image_format,
+                        self.export_all_button,
+                    ]
+                ),
+                self.export_status,
+            ]
+        )
+        # Sweep mode
+        self.sweep_mode = ipw.Checkbox(
+            description="Sweep mode",
+            indent=False,
+            layout={"width": "fit-content"},
+        )
+        ipw.link((self._model, "sweep_mode"), (self.sweep_mode, "value"))
+        self.sweep_mode.observe(self._on_sweep_change, "value")
+        self.sweep_axis = ipw.Dropdown(
+            description="Sweep along:",
+            style={"description_width": "initial"},
+        )
+        ipw.dlink((self._model, "sweep_axis_options"), (self.sweep_axis, "options"))
+        ipw.link((self._model, "sweep_axis"), (self.sweep_axis, "value"))
+        self.sweep_axis.observe(self._on_sweep_change, "value")
+        self.sweep_controls = ipw.HBox([self.sweep_mode, self.sweep_axis])
+        self.sweep_output = ipw.Output()
+
         self.children = [self.calc_nodes, self.zmax, self.download_buttons]
         self.rendered = True
 
@@ -72,10 +112,56 @@ class STMVisualWidget(ipw.VBox):
     def _initial_plot(self):
         self._model.create_plot()
         self.plot = self._model.plot
-        self.children = [self.calc_nodes, self.plot, self.zmax, self.download_buttons]
+        self._update_children()
+
+    def _update_children(self):
+        if self._model.sweep_mode:
+            self.children = [
+                self.calc_nodes,
+                self.sweep_controls,
+                self.sweep_output,
+                self.download_buttons,
+            ]
+        else:
+            self.children = [
+                self.calc_nodes,
+                self.sweep_controls,
+                self.plot,
+                self.zmax,
+                self.download_buttons,
+            ]
+
+    def _on_sweep_change(self, _):
+        if self._model.sweep_mode:
+            self.sweep_output.clear_output()
+            with self.sweep_output:
+                display(self._model.create_sweep_figure())
+        self._update_children()
 
     def _update_plot(self, _):
         self._model.update_plot()
+        if self._model.sweep_mode:
+            self._on_sweep_change(None)
 
     def _update_plot_zmax(self, _):
         self._model.update_plot_zmax()
+
+
+class STMTabWidget(ipw.Tab):
+    """The STM images and the dI/dV (STS) maps, each in its own tab, rendered
+    when the tab is first shown."""
+
+    def __init__(self, tabs, **kwargs):
+        super().__init__(children=[widget for _, widget in tabs], **kwargs)
+        for index, (title, _) in enumerate(tabs):
+            self.set_title(index, title)
+        self.observe(self._on_tab_change, "selected_index")
+        self.rendered = False
+
+    def render(self):
+        self.rendered = True
+        self._on_tab_change(None)
+
+    def _on_tab_change(self, _):
+        if self.rendered and self.selected_index is not None:
+            self.children[self.selected_index].render()
@@ -0,0 +1,182 @@
+from aiidalab_qe.common.mvc import Model
+import traitlets as tl
+from aiida.common.extendeddicts import AttributeDict
+import numpy as np
+import plotly.graph_objects as go
+
+from aiidalab_qe_pp.app.result.widgets.stmvisualmodel import (
+    SETTINGS,
+    STM_GRIDS,
+    STM_PROCESSING_VERSION,
+    process_stm_data,
+)
+from aiidalab_qe_pp.cache import disk_cache, get_array
+from aiidalab_qe_pp.reader import parse_stm_label
+
+
+class STSVisualModel(Model):
+    """dI/dV (STS) maps and point spectra computed from the LDOS grid.
+
+    Each map holds the dI/dV at all the energies of the grid ("didv", with
+    the shape (energy, point of the map)), the energy shown is chosen with
+    `energy_index`.
+    """
+
+    node = tl.Instance(AttributeDict, allow_none=True)
+
+    map_options = tl.List(
+        trait=tl.List(tl.Union([tl.Unicode(), tl.Int()])), default_value=[]
+    )
+    map_index = tl.Int(0)
+    energy_index = tl.Int(0)
+    energy_index_max = tl.Int(0)
+    energy_label = tl.Unicode("")
+
+    def fetch_data(self):
+        self._processed_data = {}
+        self.map_labels = []
+        self.map_entries = []
+        self.point_labels = []
+        for label in self.node.keys():
+            entry = parse_stm_label(label)
+            if entry is not None:
+                self.map_labels.append(label)
+                self.map_entries.append(entry)
+            elif label.startswith("point_"):
+                self.point_labels.append(label)
+        self.map_options = [
+            (
+                f"Constant {entry['mode']}, {entry['value']} "
+                f"{'Å' if entry['mode'] == 'height' else '(au)'}",
+                index,
+            )
+            for index, entry in enumerate(self.map_entries)
+        ]
+        first = (self.map_labels or self.point_labels)[0]
+        self.energies = get_array(self.get_data(first), "energies")
+        self.energy_index_max = len(self.energies) - 1
+        # Start at the Fermi level
+        self.energy_index = int(np.argmin(np.abs(self.energies)))
+        self._on_change_energy()
+
+    def get_data(self, label):
+        return self.node[label]["sts_data"]
+
+    def _on_change_energy(self):
+        energy = self.energies[self.energy_index]
+        # The states at E are imaged at the sample bias -E (see `stm_energy_window`)
+        self.energy_label = (
+            f"E - E<sub>F</sub> = {energy:.3f} eV (sample bias {-energy:.3f} V)"
+        )
+
+    def get_processed_data(self, map_index, energy_index):
+        """Return the interpolated grids of the map at `map_index` at the energy
+        `energy_index`, computed once (they are also kept on disk)."""
+        key = (map_index, energy_index)
+        if key not in self._processed_data:
+            sts_data = self.get_data(self.map_labels[map_index])
+
+            def compute():
+                grids = process_stm_data(
+                    get_array(sts_data, "xcart"),
+                    get_array(sts_data, "ycart"),
+                    get_array(sts_data, "didv")[energy_index],
+                )
+                return dict(zip(STM_GRIDS, grids))
+
+            arrays = disk_cache.get_or_compute(
+                sts_data.uuid,
+                f"sts_grids_{energy_index}",
+                STM_PROCESSING_VERSION,
+                compute,
+            )
+            self._processed_data[key] = tuple(arrays[name] for name in STM_GRIDS)
+        return self._processed_data[key]
+
+    def _heatmap(self):
+        unique_x, unique_y, _, _, z_grid = self.get_processed_data(
+            self.map_index, self.energy_index
+        )
+        return go.Heatmap(
+            z=z_grid,
+            x=unique_x,
+            y=unique_y,
+            colorscale=SETTINGS["default_color_scale"],
+            colorbar=dict(title="dI/dV ∝ LDOS (states/eV/bohr³)"),
+        )
+
+    def _map_title(self):
+        entry = self.map_entries[self.map_index]
+        unit = "Å" if entry["mode"] == "height" else "(au)"
+        return f"dI/dV, constant {entry['mode']} {entry['value']} {unit}"
+
+    def create_map_plot(self):
+        fig = go.Figure(data=[self._heatmap()])
+        fig.update_layout(
+            title=dict(text=self._map_title(), x=0.5, xanchor="center"),
+            xaxis=dict(title="x (Å)", showline=True, mirror=True, showgrid=False),
+            yaxis=dict(title="y (Å)", showline=True, mirror=True, showgrid=False),
+            autosize=False,
+            width=SETTINGS["width"],
+            height=SETTINGS["height"],
+            margin=SETTINGS["margin"],
+        )
+        self.map_plot = go.FigureWidget(fig)
+
+    def update_map_plot(self):
+        self._on_change_energy()
+        heatmap = self._heatmap()
+        with self.map_plot.batch_update():
+            self.map_plot.data[0].update(z=heatmap.z, x=heatmap.x, y=heatmap.y)
+            self.map_plot.layout.title.text = self._map_title()
+        self.update_energy_marker()
+
+    def create_spectra_plot(self):
+        """Plot the point spectra and the average spectrum of each map."""
+        fig = go.Figure()
+        for label in self.point_labels:
+            sts_data = self.get_data(label)
+            position = get_array(sts_data, "position")
+            fig.add_trace(
+                go.Scatter(
+                    x=get_array(sts_data, "energies"),
+                    y=get_array(sts_data, "didv"),
+                    mode="lines",
+                    name="Point ({:g}, {:g}), {:g} Å".format(*position),
+                )
+            )
+        for label, (name, _) in zip(self.map_labels, self.map_options):
+            sts_data = self.get_data(label)
+            fig.add_trace(
+                go.Scatter(
+                    x=get_array(sts_data, "energies"),
+                    y=np.nanmean(get_array(sts_data, "didv"), axis=1),
+                    mode="lines",
+                    line=dict(dash="dot"),
+                    name=f"Average, {name.lower()}",
+                )
+            )
+        fig.update_layout(
+            xaxis=dict(title="E - E<sub>F</sub> (eV)"),
+            yaxis=dict(title="dI/dV ∝ LDOS (states/eV/bohr³)"),
+            width=SETTINGS["width"],
+            height=SETTINGS["height"] * 2 // 3,
+            margin=SETTINGS["margin"],
+        )
+        self.spectra_plot = go.FigureWidget(fig)
+        self.update_energy_marker()
+
+    def update_energy_marker(self):
+        """Mark the energy of the map on the spectra."""
+        energy = float(self.energies[self.energy_index])
+        self.spectra_plot.layout.shapes = [
+            dict(
+                type="line",
+                x0=energy,
+                x1=energy,
+                y0=0,
+                y1=1,
+                yref="paper",
+                line=dict(color="grey", dash="dash"),
+            )
+        ]
@@ -0,0 +1,59 @@
+import ipywidgets as ipw
+
+from aiidalab_qe_pp.app.result.widgets.stsvisualmodel import STSVisualModel
+
+
+class STSVisualWidget(ipw.VBox):
+    """Widget to visualize the dI/dV (STS) maps and spectra from PPWorkChain."""
+
+    def __init__(self, model: STSVisualModel, node, **kwargs):
+        super().__init__(
+            children=[ipw.HTML("Loading STS data...")],
+            **kwargs,
+        )
+        self._model = model
+        self._model.node = node
+        self._model.fetch_data()
+        self.rendered = False
+
+    def render(self):
+        if self.rendered:
+            return
+
+        self._model.create_spectra_plot()
+        children = []
+        if self._model.map_labels:
+            self.maps = ipw.Dropdown(
+                description="Map:",
+                style={"description_width": "initial"},
+                layout={"width": "600px"},
+            )
+            ipw.dlink((self._model, "map_options"), (self.maps, "options"))
+            ipw.link((self._model, "map_index"), (self.maps, "value"))
+            self.maps.observe(self._update_map_plot, "value")
+
+            self.energy = ipw.IntSlider(
+                description="Energy:",
+                min=0,
+                readout=False,
+                continuous_update=False,
+                layout={"width": "500px"},
+            )
+            ipw.dlink((self._model, "energy_index_max"), (self.energy, "max"))
+            ipw.link((self._model, "energy_index"), (self.energy, "value"))
+            self.energy.observe(self._update_map_plot, "value")
+            self.energy_label = ipw.HTML()
+            ipw.dlink((self._model, "energy_label"), (self.energy_label, "value"))
+
+            self._model.create_map_plot()
+            children = [
+                self.maps,
+                ipw.HBox([self.energy, self.energy_label]),
+                self._model.map_plot,
+            ]
+
+        self.children = [*children, self._model.spectra_plot]
+        self.rendered = True
+
+    def _update_map_plot(self, _):
+        self._model.update_map_plot()
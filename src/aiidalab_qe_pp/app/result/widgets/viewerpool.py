@@ -0,0 +1,88 @@
+import ipywidgets as ipw
+from collections import OrderedDict
+from weas_widget import WeasWidget
+
+GUI_CONFIG = {
+    "components": {
+        "atomsControl": True,
+        "buttons": True,
+        "cameraControls": True,
+        "enabled": True,
+    },
+    "buttons": {
+        "fullscreen": True,
+        "download": True,
+        "measurement": True,
+        "enabled": True,
+    },
+}
+
+
+class WeasViewerPool:
+    """A few `WeasWidget` viewers shared by the result tabs.
+
+    At most `keep` viewers are created. When another tab needs one, the viewer
+    of the least recently shown tab is taken from it, and its volumetric data
+    is replaced by the one of the new tab. The structure is only sent again to
+    the viewer if it is a different one.
+    """
+
+    def __init__(self, keep=1):
+        self.keep = max(1, keep)
+        self._owners = OrderedDict()  # id(owner) -> (owner, viewer)
+        self._structures = {}  # id(viewer) -> uuid of the structure shown
+
+    def acquire(self, owner, atoms, structure_uuid):
+        key = id(owner)
+        if key in self._owners:
+            self._owners.move_to_end(key)
+            return self._owners[key][1]
+
+        if len(self._owners) < self.keep:
+            viewer = WeasWidget(guiConfig=GUI_CONFIG)
+            viewer.avr.color_type = "JMOL"
+            viewer.avr.model_style = 1
+        else:
+            _, (previous, viewer) = self._owners.popitem(last=False)
+            previous.release_viewer()
+
+        if self._structures.get(id(viewer)) != structure_uuid:
+            viewer.from_ase(atoms)
+            self._structures[id(viewer)] = structure_uuid
+        self._owners[key] = (owner, viewer)
+        return viewer
+
+
+class PooledViewerMixin:
+    """Result tab showing its volumetric data in a viewer of a `WeasViewerPool`.
+
+    The tab puts `viewer_box` in its children and implements `_update_plot`,
+    which sends the current data to `self.viewer`.
+    """
+
+    viewer = None
+    _viewer_pool = None
+
+    def _init_viewer_box(self, viewer_pool=None):
+        # A tab used on its own keeps its own viewer
+        self._viewer_pool = viewer_pool or WeasViewerPool(keep=1)
+        self.viewer_box = ipw.Box()
+
+    def attach_viewer(self):
+        """Take a viewer from the pool (if it is not already held) and show the data in it."""
+        viewer = self._viewer_pool.acquire(
+            self,
+            self._model.input_structure,
+            self._model.aiida_structure.uuid,
+        )
+        if viewer is not self.viewer:
+            self.viewer = viewer
+            self._update_plot()
+        self.viewer_box.children = [viewer]
+
+    def release_viewer(self):
+        """Give back the viewer, which is now used by another tab."""
+        self.viewer = None
+        self.viewer_box.children = [
+            ipw.HTML("<i>The 3D viewer is shown again when this tab is selected.</i>")
+        ]
@@ -4,24 +4,39 @@ from aiida.orm import StructureData
 from aiida.orm.nodes.process.workflow.workchain import WorkChainNode
 import numpy as np
 from ase.atoms import Atoms
-from pymatgen.io.common import VolumetricData
 import re
-import base64
-from IPython.display import Javascript
-from IPython.display import display
-import tempfile
-import os
-import threading
-from aiidalab_qe_pp.app.utils import download_remote_file
+from aiidalab_qe_pp.app.downloads import HasSourceDownload
+from aiidalab_qe_pp.cache import get_array, get_isovalue
+from aiidalab_qe_pp.reader import expand_kpoint_band_label
+from aiidalab_qe_pp.app.utils import export_cube, trigger_download
 
 
-class WfnVisualModel(Model):
+def band_file_selector(band):
+    """Return a function selecting the pp.x output of `band` among the files
+    of a remote folder."""
+
+    def select_file(files):
+        filtered_files = [file for file in files if file.endswith("aiida.fileout")]
+        if "aiida.fileout" in filtered_files:
+            return "aiida.fileout"
+        # To take the numbers between B and aiida.fileout
+        pattern = re.compile(r"B(\d+)aiida\.fileout$")
+        for file in filtered_files:
+            match = pattern.search(file)
+            if match and int(match.group(1)) == band:
+                return file
+        return None
+
+    return select_file
+
+
+class WfnVisualModel(Model, HasSourceDownload):
     node = tl.Instance(WorkChainNode, allow_none=True)
     input_structure = tl.Instance(Atoms, allow_none=True)
     aiida_structure = tl.Instance(StructureData, allow_none=True)
     cube_data = tl.Instance(np.ndarray, allow_none=True)
     reduce_cube_files = tl.Bool(False)
-    error_message = tl.Unicode("")
+    compress_cube = tl.Bool(False)
 
     kpoint_band_data = tl.List(
         trait=tl.Dict(),
@@ -47,6 +62,14 @@ class WfnVisualModel(Model):
     band = tl.Int(1)
 
     lsda = tl.Bool(False)
+    archive_scope_options = tl.List(
+        trait=tl.List(tl.Unicode()),
+        default_value=[
+            ("Bands of the selected k-point", "kpoint"),
+            ("All orbitals", "all"),
+        ],
+    )
+    archive_scope = tl.Unicode("kpoint")
     number_of_k_points = tl.Int(0)
 
     def fetch_data(self):
@@ -84,17 +107,7 @@ class WfnVisualModel(Model):
         self.bands_dropdown_options = bands
 
     def expand_kpoint_band_string(self, s):
-        match = re.match(r"kp_(\d+)_kb_(\d+)_(\d+)", s)
-        if match:
-            kpoint = match.group(1)
-            start_band = int(match.group(2))
-            end_band = int(match.group(3))
-
-            return [
-                f"kp_{kpoint}_kb_{band}" for band in range(start_band, end_band + 1)
-            ]
-        else:
-            raise ValueError("String format is not correct")
+        return expand_kpoint_band_label(s)
 
     def on_kpoints_change(self):
         self._update_bands_options(self.kpoint)
@@ -121,8 +134,9 @@ class WfnVisualModel(Model):
             kpoint += self.number_of_k_points
 
         key = f"kp_{kpoint}_kb_{self.band}"
-        self.cube_data = self.cube_data_dict.get(key).get_array("data")
-        isovalue = 2 * np.std(self.cube_data) + np.mean(self.cube_data)
+        array_node = self.cube_data_dict.get(key)
+        self.cube_data = get_array(array_node)
+        isovalue = get_isovalue(array_node)
         return self.cube_data, isovalue
 
     def process_orbitals(self, data):
@@ -157,49 +171,13 @@ class WfnVisualModel(Model):
         if self.lsda and self.spin == "down":
             kpoint += self.number_of_k_points
 
-        filename = f"plot_wfn_kp_{kpoint}_kb_{band}"
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".cube") as tmp:
-            # Write the cube data to a temporary file using pymatgen's VolumetricData
-            if self.aiida_structure.pbc != [True, True, True]:
-                structure_temp = self.aiida_structure.clone()
-                structure_temp.pbc = [True, True, True]
-                structure = structure_temp.get_pymatgen()
-            else:
-                structure = self.aiida_structure.get_pymatgen()
-
-            my_cube = VolumetricData(
-                structure=structure, data={"total": self.cube_data}
-            )
-            my_cube.to_cube(tmp.name)
-
-            # Move the file pointer back to the start for reading
-            tmp.seek(0)
-            raw_bytes = tmp.read()
-
-        # Encode the file content to base64
-        base64_payload = base64.b64encode(raw_bytes).decode()
-
-        # if filename is not provided, use plot_num
-        if filename == "plot":
-            filename = f"plot_{self.plot_num}"
-
-        # JavaScript to trigger download
-        filename = f"{filename}.cube"
-        js_download = Javascript(
-            f"""
-            var link = document.createElement('a');
-            link.href = "data:application/octet-stream;base64,{base64_payload}";
-            link.download = "{filename}";
-            document.body.appendChild(link);
-            link.click();
-            document.body.removeChild(link);
-            """
+        file_path = export_cube(
+            f"plot_wfn_kp_{kpoint}_kb_{band}.cube",
+            self.input_structure,
+            self.cube_data,
+            compress=self.compress_cube,
         )
-        display(js_download)
-
-        # Clean up by removing the temporary file
-        os.unlink(tmp.name)
+        trigger_download(file_path)
 
     def get_key_remote_folder(self, outputs, kpoint, band):
         result = ""
@@ -226,48 +204,47 @@ class WfnVisualModel(Model):
         key_dict = self.get_key_remote_folder(self.node.outputs.wfn, kpoint, band)
 
         if key_dict == "":
-            message = "Unfortunately there is no access to this file."
-            self.error_message = (
-                f'<div style="color: red; font-weight: bold;">{message}</div>'
-            )
-            threading.Timer(3.0, self.clear_error_message).start()
+            self.set_download_error("Unfortunately there is no access to this file.")
             return
 
         remote_folder = self.node.outputs.wfn[key_dict].remote_folder
+        self.submit_source_download(
+            remote_folder,
+            band_file_selector(band),
+            f"plot_wfn_kp_{kpoint}_kb_{band}.cube",
+        )
 
-        if remote_folder.is_empty:
-            message = "Unfortunately the remote folder is empty."
-            self.error_message = (
-                f'<div style="color: red; font-weight: bold;">{message}</div>'
-            )
-            threading.Timer(10.0, self.clear_error_message).start()
-            return
-
-        filtered_files = [
-            file for file in remote_folder.listdir() if file.endswith("aiida.fileout")
-        ]
+    def download_all_source_files(self, _=None):
+        """Download the source files of all the bands of the selected k-point
+        (or of all the orbitals) as one zip archive."""
+        kpoint = self.kpoint
+        if self.lsda and self.spin == "down":
+            kpoint += self.number_of_k_points
 
-        file_download = None
-        if "aiida.fileout" in filtered_files:
-            file_download = "aiida.fileout"
-        else:
-            # To take the numbers between B and aiida.fileout
-            pattern = re.compile(r"B(\d+)aiida\.fileout$")
-            for file in filtered_files:
-                match = pattern.search(file)
-                if match:
-                    band_number = int(match.group(1))
-                    if band_number == band:
-                        file_download = file
-                        break
-        if file_download is None:
-            self.error_message = "Unfortunately there is a problem with the file."
-            threading.Timer(3.0, self.clear_error_message).start()
+        entries = []
+        for key in self.node.outputs.wfn.keys():
+            if "remote_folder" not in self.node.outputs.wfn[key]:
+                continue
+            remote_folder = self.node.outputs.wfn[key].remote_folder
+            labels = [key]
+            if len(key.split("_")) == 5:
+                labels = self.expand_kpoint_band_string(key)
+            for label in labels:
+                _, label_kpoint, _, band = label.split("_")
+                if self.archive_scope == "kpoint" and int(label_kpoint) != kpoint:
+                    continue
+                entries.append(
+                    (
+                        remote_folder,
+                        band_file_selector(int(band)),
+                        f"plot_wfn_{label}.cube",
+                    )
+                )
+
+        if not entries:
+            self.set_download_error("Unfortunately there is no access to these files.")
             return
-
-        download_remote_file(
-            remote_folder, f"plot_wfn_kp_{kpoint}_kb_{band}.cube", file_download
+        suffix = f"kp_{kpoint}" if self.archive_scope == "kpoint" else "all"
+        self.submit_archive_download(
+            entries, f"wfn_source_files_{self.node.pk}_{suffix}.zip"
         )
-
-    def clear_error_message(self):
-        self.error_message = ""
@@ -1,11 +1,12 @@
 import ipywidgets as ipw
 
 from aiidalab_qe_pp.app.result.widgets.wfnvisualmodel import WfnVisualModel
-from weas_widget import WeasWidget
+from aiidalab_qe_pp.app.result.widgets.viewerpool import PooledViewerMixin
+from aiidalab_qe_pp.app.widgets import DownloadProgressWidget
 
 
-class WfnVisualWidget(ipw.VBox):
-    def __init__(self, model: WfnVisualModel, node, **kwargs):
+class WfnVisualWidget(ipw.VBox, PooledViewerMixin):
+    def __init__(self, model: WfnVisualModel, node, viewer_pool=None, **kwargs):
         super().__init__(
             children=[ipw.HTML("Loading wfn data...")],
             **kwargs,
@@ -13,27 +14,13 @@ class WfnVisualWidget(ipw.VBox):
         self._model = model
         self._model.node = node
         self._model.fetch_data()
+        self._init_viewer_box(viewer_pool)
         self.rendered = False
 
     def render(self):
         if self.rendered:
             return
 
-        self.guiConfig = {
-            "components": {
-                "atomsControl": True,
-                "buttons": True,
-                "cameraControls": True,
-                "enabled": True,
-            },
-            "buttons": {
-                "fullscreen": True,
-                "download": True,
-                "measurement": True,
-                "enabled": True,
-            },
-        }
-
         self.kpoints_dropdown = ipw.Dropdown(
             description="Kpoint:",
             style={"description_width": "initial"},
@@ -80,6 +67,13 @@ class WfnVisualWidget(ipw.VBox):
             icon="download",
         )
         self.download_button.on_click(self._model.download_cube)
+        self.compress_cube = ipw.Checkbox(
+            description="gzip",
+            indent=False,
+            layout={"width": "fit-content"},
+        )
+        ipw.link((self._model, "compress_cube"), (self.compress_cube, "value"))
+        self.download_box = ipw.HBox([self.download_button, self.compress_cube])
 
         # Download original files from HPC source
         self.info_original_files = ipw.HTML(
@@ -95,37 +89,63 @@ class WfnVisualWidget(ipw.VBox):
             icon="download",
         )
         self.download_source_button.on_click(self._model.download_source_files)
-        self.error_message = ipw.HTML("")
-        ipw.link((self._model, "error_message"), (self.error_message, "value"))
+        ipw.dlink(
+            (self._model, "downloading"), (self.download_source_button, "disabled")
+        )
+        self.download_all_source_button = ipw.Button(
+            description="All source files",
+            button_style="primary",
+            icon="file-archive-o",
+            tooltip="Download the source files of several orbitals as one zip archive",
+            layout={"width": "fit-content"},
+        )
+        self.download_all_source_button.on_click(self._model.download_all_source_files)
+        ipw.dlink(
+            (self._model, "downloading"),
+            (self.download_all_source_button, "disabled"),
+        )
+        self.archive_scope = ipw.Dropdown(layout={"width": "fit-content"})
+        ipw.dlink(
+            (self._model, "archive_scope_options"), (self.archive_scope, "options")
+        )
+        ipw.link((self._model, "archive_scope"), (self.archive_scope, "value"))
+        self.download_progress = DownloadProgressWidget(self._model)
         self.download_source_box = ipw.VBox(
-            [self.info_original_files, self.download_source_button, self.error_message]
+            [
+                self.info_original_files,
+                ipw.HBox(
+                    [
+                        self.download_source_button,
+                        self.download_all_source_button,
+                        self.archive_scope,
+                    ]
+                ),
+                self.download_progress,
+            ]
         )
 
-        self.plot = WeasWidget(guiConfig=self.guiConfig)
-        self.plot.from_ase(self._model.input_structure)
-        self.plot.avr.color_type = "JMOL"
-        self.plot.avr.model_style = 1
-        self._update_plot()
-
         if self._model.reduce_cube_files:
             self.children = [
                 self.controls,
-                self.plot,
-                self.download_button,
+                self.viewer_box,
+                self.download_box,
                 self.download_source_box,
             ]
         else:
-            self.children = [self.controls, self.plot, self.download_button]
+            self.children = [self.controls, self.viewer_box, self.download_box]
+        self.attach_viewer()
         self.rendered = True
 
     def _update_plot(self):
+        if self.viewer is None:
+            return
         cube_data, isovalue = self._model.update_plot()
-        self.plot.avr.iso.volumetric_data = {"values": cube_data}
-        self.plot.avr.iso.settings = {
+        self.viewer.avr.iso.volumetric_data = {"values": cube_data}
+        self.viewer.avr.iso.settings = {
             "positive": {"isovalue": isovalue},
             "negative": {"isovalue": -isovalue, "color": "yellow"},
         }
-        self.plot.avr.draw()
+        self.viewer.avr.draw()
 
     def _on_kpoints_change(self, _):
         self._model.on_kpoints_change()
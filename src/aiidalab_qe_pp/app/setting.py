@@ -22,6 +22,35 @@ class PpConfigurationSettingPanel(
             self._on_input_structure_change,
             "structure_uuid",
         )
+        self._model.observe(
+            self._on_cost_dependency_change,
+            self._model.cost_dependencies,
+        )
+        self._model.observe(
+            self._on_stm_ldos_change,
+            [
+                "calc_stm",
+                "stm_source",
+                "stm_sample_bias",
+                "calc_ldos_grid",
+                "ldos_emin",
+                "ldos_emax",
+            ],
+        )
+        self._model.observe(
+            self._on_sts_change,
+            [
+                "calc_sts",
+                "sts_heights",
+                "sts_currents",
+                "sts_setpoint_bias",
+                "sts_points",
+                "calc_ldos_grid",
+                "ldos_emin",
+                "ldos_emax",
+                "ldos_delta_e",
+            ],
+        )
 
     def render(self):
         if self.rendered:
@@ -180,6 +209,13 @@ class PpConfigurationSettingPanel(
             "value",
         )
 
+        # Discovery of the calculations in progress
+        self.discovery_message = ipw.HTML()
+        ipw.dlink(
+            (self._model, "discovery_message"),
+            (self.discovery_message, "value"),
+        )
+
         # No available calculations HTML
         self.no_avail_cals = ipw.HTML()
         ipw.link(
@@ -329,13 +365,57 @@ class PpConfigurationSettingPanel(
             (self._model, "kpoints_table"),
             (self.kpoints_table, "value"),
         )
-        self.kpoints_table_box = ipw.Box(
-            children=[self.kpoints_table],
-            layout=ipw.Layout(
-                overflow="auto",
-                height="300px",
-                width="300px",
-            ),
+        self.kpoints_search = ipw.Text(
+            description="Search:",
+            placeholder="Index or coordinates, e.g. 12 or 0.5 0 0",
+            continuous_update=False,
+            style={"description_width": "initial"},
+            layout=ipw.Layout(width="300px"),
+        )
+        ipw.link(
+            (self._model, "kpoints_search"),
+            (self.kpoints_search, "value"),
+        )
+        self.kpoints_search.observe(
+            self._on_kpoints_search_change,
+            "value",
+        )
+        self.kpoints_page = ipw.BoundedIntText(
+            description="Page:",
+            min=1,
+            style={"description_width": "initial"},
+            layout=ipw.Layout(width="150px"),
+        )
+        ipw.dlink(
+            (self._model, "kpoints_pages"),
+            (self.kpoints_page, "max"),
+        )
+        ipw.link(
+            (self._model, "kpoints_page"),
+            (self.kpoints_page, "value"),
+        )
+        self.kpoints_page.observe(
+            self._on_kpoints_page_change,
+            "value",
+        )
+        self.kpoints_page_info = ipw.HTML()
+        ipw.dlink(
+            (self._model, "kpoints_page_info"),
+            (self.kpoints_page_info, "value"),
+        )
+        self.kpoints_table_box = ipw.VBox(
+            children=[
+                self.kpoints_search,
+                ipw.HBox([self.kpoints_page, self.kpoints_page_info]),
+                ipw.Box(
+                    children=[self.kpoints_table],
+                    layout=ipw.Layout(
+                        overflow="auto",
+                        height="300px",
+                        width="300px",
+                    ),
+                ),
+            ]
         )
 
         self.sel_orbital = OrbitalListWidget(
@@ -429,6 +509,72 @@ class PpConfigurationSettingPanel(
             (self.ldos_parameters.layout, "display"),
         )
 
+        # Calc STS Options
+        self.calc_sts = ipw.Checkbox(
+            description="dI/dV (STS) maps and spectra from the LDOS grid",
+            indent=False,
+            style={"description_width": "initial"},
+        )
+        ipw.link((self._model, "calc_sts"), (self.calc_sts, "value"))
+        ipw.dlink((self._model, "disable_calc_ldos_grid"), (self.calc_sts, "disabled"))
+        self.calc_sts.observe(
+            self._on_change_calc_sts,
+            "value",
+        )
+        self.calc_sts_help = ipw.HTML(
+            """<div style="line-height: 140%; padding-top: 0px; padding-bottom: 5px">
+            The dI/dV maps are the LDOS at all the energies of the grid, on the planes at the given heights (Å) and on the constant current surfaces of the given currents (a.u.), set at the setpoint bias. The point spectra are computed at the positions "a b height" (crystal coordinates in the plane and height in Å) separated by ";", for example: 0.5 0.5 2.0; 0 0 2.5
+            </div>"""
+        )
+        self.sts_heights = ipw.Text(
+            description="Heights list (Å): ",
+            style={"description_width": "initial"},
+        )
+        ipw.link((self._model, "sts_heights"), (self.sts_heights, "value"))
+        self.sts_currents = ipw.Text(
+            description="Currents list (a.u): ",
+            style={"description_width": "initial"},
+            placeholder="arbitrary units",
+        )
+        ipw.link((self._model, "sts_currents"), (self.sts_currents, "value"))
+        self.sts_setpoint_bias = ipw.FloatText(
+            description="Setpoint bias (eV):",
+            style={"description_width": "initial"},
+            layout=ipw.Layout(width="fit-content"),
+        )
+        ipw.link((self._model, "sts_setpoint_bias"), (self.sts_setpoint_bias, "value"))
+        self.sts_points = ipw.Text(
+            description="Point spectra at:",
+            style={"description_width": "initial"},
+            placeholder="a b height; a b height",
+        )
+        ipw.link((self._model, "sts_points"), (self.sts_points, "value"))
+        self.sts_broadening = ipw.BoundedFloatText(
+            min=0.0,
+            step=0.01,
+            description="Extra Gaussian broadening (eV):",
+            style={"description_width": "initial"},
+            layout=ipw.Layout(width="fit-content"),
+        )
+        ipw.link((self._model, "sts_broadening"), (self.sts_broadening, "value"))
+        self.sts_warning = ipw.HTML()
+        ipw.dlink(
+            (self._model, "sts_warning"),
+            (self.sts_warning, "value"),
+        )
+        self.sts_parameters = ipw.VBox(
+            [
+                self.calc_sts_help,
+                ipw.HBox([self.sts_heights, self.sts_currents, self.sts_setpoint_bias]),
+                ipw.HBox([self.sts_points, self.sts_broadening]),
+                self.sts_warning,
+            ]
+        )
+        ipw.link(
+            (self._model, "sts_options_displayed"),
+            (self.sts_parameters.layout, "display"),
+        )
+
         # Calc ILDOS Options
         self.ildos_emin = ipw.FloatText(
             description="Emin (eV):",
@@ -493,6 +639,15 @@ class PpConfigurationSettingPanel(
             (self._model, "ildos_stm_currents"), (self.ildos_stm_currents, "value")
         )
 
+        self.ildos_stm_engine = ipw.Dropdown(
+            description="STM maps with:",
+            style={"description_width": "initial"},
+        )
+        ipw.dlink(
+            (self._model, "stm_engine_options"), (self.ildos_stm_engine, "options")
+        )
+        ipw.link((self._model, "stm_engine"), (self.ildos_stm_engine, "value"))
+
         self.ildos_stm_parameters = ipw.VBox(
             [
                 self.calc_ildos_stm_help,
@@ -502,6 +657,7 @@ class PpConfigurationSettingPanel(
                         self.ildos_stm_currents,
                     ]
                 ),
+                self.ildos_stm_engine,
             ]
         )
         ipw.link(
@@ -548,6 +704,63 @@ class PpConfigurationSettingPanel(
             placeholder="arbitrary units",
         )
         ipw.link((self._model, "stm_currents"), (self.stm_currents, "value"))
+        self.stm_engine = ipw.Dropdown(
+            description="STM maps with:",
+            style={"description_width": "initial"},
+        )
+        ipw.dlink((self._model, "stm_engine_options"), (self.stm_engine, "options"))
+        ipw.link((self._model, "stm_engine"), (self.stm_engine, "value"))
+        self.stm_source = ipw.Dropdown(
+            description="ILDOS of each bias from:",
+            style={"description_width": "initial"},
+        )
+        ipw.dlink((self._model, "stm_source_options"), (self.stm_source, "options"))
+        ipw.link((self._model, "stm_source"), (self.stm_source, "value"))
+        self.stm_source.observe(
+            self._on_change_stm_source,
+            "value",
+        )
+        self.stm_ldos_help = ipw.HTML(
+            """<div style="line-height: 140%; padding-top: 0px; padding-bottom: 5px">
+            The ILDOS of all the biases is integrated from the LDOS grid, which is computed by a single pp.x run. The maps are computed with NumPy.
+            </div>"""
+        )
+        self.stm_ldos_weighting = ipw.Dropdown(
+            description="Integration:",
+            style={"description_width": "initial"},
+        )
+        ipw.dlink(
+            (self._model, "stm_ldos_weighting_options"),
+            (self.stm_ldos_weighting, "options"),
+        )
+        ipw.link(
+            (self._model, "stm_ldos_weighting"), (self.stm_ldos_weighting, "value")
+        )
+        self.stm_ldos_broadening = ipw.BoundedFloatText(
+            min=0.0,
+            step=0.01,
+            description="Gaussian width (eV, 0 for the grid spacing):",
+            style={"description_width": "initial"},
+        )
+        ipw.link(
+            (self._model, "stm_ldos_broadening"), (self.stm_ldos_broadening, "value")
+        )
+        self.stm_ldos_warning = ipw.HTML()
+        ipw.dlink(
+            (self._model, "stm_ldos_warning"),
+            (self.stm_ldos_warning, "value"),
+        )
+        self.stm_ldos_options = ipw.VBox(
+            [
+                self.stm_ldos_help,
+                ipw.HBox([self.stm_ldos_weighting, self.stm_ldos_broadening]),
+                self.stm_ldos_warning,
+            ]
+        )
+        ipw.link(
+            (self._model, "stm_ldos_options_displayed"),
+            (self.stm_ldos_options.layout, "display"),
+        )
         self.stm_parameters = ipw.VBox(
             [
                 self.calc_stm_help,
@@ -558,6 +771,9 @@ class PpConfigurationSettingPanel(
                         self.stm_currents,
                     ]
                 ),
+                self.stm_engine,
+                self.stm_source,
+                self.stm_ldos_options,
             ]
         )
 
@@ -566,11 +782,18 @@ class PpConfigurationSettingPanel(
             (self.stm_parameters.layout, "display"),
         )
 
+        self.cost_plan = ipw.HTML()
+        ipw.dlink(
+            (self._model, "cost_plan"),
+            (self.cost_plan, "value"),
+        )
+
         self.children = [
             self.structure_selected,
             self.pwcalc_description,
             self.comp_description,
             self.pwcalc_type,
+            self.discovery_message,
             self.no_avail_cals,
             self.pwcalc_avail,
             self.reduce_cube_files_help,
@@ -582,26 +805,30 @@ class PpConfigurationSettingPanel(
             self.calc_potential,
             self.calc_ldos_grid,
             self.ldos_parameters,
+            self.calc_sts,
+            self.sts_parameters,
             self.calc_wfn,
             self.wfn_options,
             self.calc_ildos,
             self.ildos_parameters,
             self.calc_stm,
             self.stm_parameters,
+            self.cost_plan,
         ]
         self.rendered = True
         self._initial_view()
 
     def _initial_view(self):
         self._get_data()
-        self._model.update_pwcalc_avail_options()
 
     def _on_input_structure_change(self, _):
         self.refresh(specific="structure")
         self._model.on_input_structure_change()
+        if self.rendered:
+            self._get_data()
 
     def _get_data(self):
-        self._model.fetch_data()
+        self._model.fetch_data_in_background()
 
     def _update_pwcalc_avail_options(self, _):
         self._model.update_pwcalc_avail_options()
@@ -615,6 +842,13 @@ class PpConfigurationSettingPanel(
     def _on_change_calc_stm(self, _):
         self._model.on_change_calc_stm()
 
+    def _on_change_stm_source(self, _):
+        self._model.on_change_stm_source()
+        self._model.select_ldos_grid_for_stm()
+
+    def _on_stm_ldos_change(self, _):
+        self._model.update_stm_ldos_warning()
+
     def _on_change_calc_ildos(self, _):
         self._model.on_change_calc_ildos()
 
@@ -624,5 +858,22 @@ class PpConfigurationSettingPanel(
     def _on_change_calc_ldos_grid(self, _):
         self._model.on_change_calc_ldos_grid()
 
+    def _on_change_calc_sts(self, _):
+        self._model.on_change_calc_sts()
+        self._model.select_ldos_grid_for_sts()
+
+    def _on_sts_change(self, _):
+        self._model.update_sts_warning()
+
     def _on_change_calc_ildos_stm(self, _):
         self._model.on_change_calc_ildos_stm()
+
+    def _on_kpoints_search_change(self, _):
+        self._model.kpoints_page = 1
+        self._model.update_kpoints_table()
+
+    def _on_kpoints_page_change(self, _):
+        self._model.update_kpoints_table()
+
+    def _on_cost_dependency_change(self, _):
+        self._model.update_cost_plan()
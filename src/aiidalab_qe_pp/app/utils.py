@@ -1,4 +1,4 @@
-def resized_cube_files(folder: str = "parent_folder"):
+def resized_cube_files(folder: str = "parent_folder", common_factor: bool = False):
     import os
     from pymatgen.io.common import VolumetricData
     from skimage.transform import resize
@@ -46,31 +46,432 @@ def resized_cube_files(folder: str = "parent_folder"):
 
         return high
 
+    filenames = [
+        filename for filename in os.listdir(folder) if filename.endswith(".fileout")
+    ]
+
+    def read_cube(filename):
+        return VolumetricData.from_cube(os.path.join(folder, filename)).data["total"]
+
+    def cube_files():
+        """Yield the (filename, data, scaling factor) of the cube files."""
+        if not common_factor:
+            for filename in filenames:
+                data = read_cube(filename)
+                yield filename, data, optimal_scaling_factor(data)
+            return
+        # The files (e.g. the energies of an LDOS grid) are resized with the
+        # same factor, the largest one they need, so that they can be stacked.
+        # They are parsed once and kept until then.
+        cube_data = {filename: read_cube(filename) for filename in filenames}
+        scaling_factor = max(
+            map(optimal_scaling_factor, cube_data.values()), default=1.0
+        )
+        for filename, data in cube_data.items():
+            yield filename, data, scaling_factor
+
     results = {}
-    for filename in os.listdir(folder):
-        if filename.endswith(".fileout"):
-            filepath = os.path.join(folder, filename)
-            volumetric_data = VolumetricData.from_cube(filepath)
-            data = volumetric_data.data["total"]
-            scaling_factor = optimal_scaling_factor(data)
-            new_shape = tuple(int(dim * scaling_factor) for dim in data.shape)
-            resized_data = resize(data, new_shape, anti_aliasing=True).tolist()
-
-            if "aiida.fileout" == filename:
-                results["aiida_fileout"] = resized_data
-            else:
-                filename_prefix = "aiida.filplot"
-                filename_suffix = "aiida.fileout"
-                pattern = (
-                    rf"{re.escape(filename_prefix)}_?(.*?){re.escape(filename_suffix)}"
-                )
-                matches = re.search(pattern, filename)
-                label = matches.group(1).rstrip("_")
-                results[label] = resized_data
+    for filename, data, scaling_factor in cube_files():
+        new_shape = tuple(int(dim * scaling_factor) for dim in data.shape)
+        resized_data = resize(data, new_shape, anti_aliasing=True).tolist()
+
+        if "aiida.fileout" == filename:
+            results["aiida_fileout"] = resized_data
+        else:
+            filename_prefix = "aiida.filplot"
+            filename_suffix = "aiida.fileout"
+            pattern = (
+                rf"{re.escape(filename_prefix)}_?(.*?){re.escape(filename_suffix)}"
+            )
+            matches = re.search(pattern, filename)
+            label = matches.group(1).rstrip("_")
+            results[label] = resized_data
+
+    return results
+
+
+def stm_images(
+    heights: dict = None,
+    currents: dict = None,
+    folder: str = "parent_folder",
+    filename: str = "aiida.fileout",
+    method: str = "linear",
+):
+    """Constant height and constant current STM images of the cube file
+    `filename` of `folder`, see `volume_stm_images`."""
+    import os
+    from pymatgen.io.common import VolumetricData
+
+    volumetric_data = VolumetricData.from_cube(os.path.join(folder, filename))
+    return volume_stm_images(
+        volumetric_data.data["total"],
+        volumetric_data.structure,
+        heights,
+        currents,
+        method,
+    )
+
+
+def volume_stm_images(data, structure, heights=None, currents=None, method="linear"):
+    """Constant height and constant current STM images of the volume `data`,
+    sampled on the unit cell of the pymatgen `structure`, on its (a, b) grid.
+
+    `heights` maps a label to a height (Å) along the c-axis, as given to
+    critic2: the volume is interpolated along c (periodic, "linear" or
+    "cubic") at all the heights at once. `currents` maps a label to a value
+    of the density: for every column of the grid, the height (Å) where the
+    density first reaches each value, coming from the vacuum above the
+    topmost atom, is found for all the values at once.
+    Returns {"height": {label: arrays}, "current": {label: arrays}}, with the
+    arrays of a critic2 STM output ("xcryst", "ycryst", "xcart", "ycart",
+    "fstm").
+    """
+    import numpy as np
+
+    lattice = structure.lattice.matrix
+    nx, ny, nz = data.shape
+    c_length = np.linalg.norm(lattice[2])
+
+    def interpolate_planes(fractions):
+        """Values at the fractional coordinates `fractions` along c, (nx, ny, n)."""
+        position = np.asarray(fractions) % 1.0 * nz
+        lower = np.floor(position).astype(int)
+        t = position - lower
+        if method == "cubic":
+            # Catmull-Rom spline through the 4 closest planes
+            p0, p1, p2, p3 = (
+                data[:, :, (lower + shift) % nz] for shift in (-1, 0, 1, 2)
+            )
+            return p1 + 0.5 * t * (
+                p2
+                - p0
+                + t * (2 * p0 - 5 * p1 + 4 * p2 - p3 + t * (3 * (p1 - p2) + p3 - p0))
+            )
+        return data[:, :, lower % nz] * (1 - t) + data[:, :, (lower + 1) % nz] * t
+
+    def topography(values):
+        """Heights (Å) where each column first reaches `values`, (nx, ny, n)."""
+        # Scan down from the middle of the vacuum to the topmost atom
+        atoms_z = np.sort(structure.frac_coords[:, 2] % 1.0)
+        gaps = np.diff(np.append(atoms_z, atoms_z[0] + 1.0))
+        top = atoms_z[np.argmax(gaps)]
+        start = top + gaps.max() / 2
+        first = int(np.floor(start * nz))
+        steps = max(int(np.ceil(gaps.max() / 2 * nz)), 1)
+        planes = first - np.arange(steps + 1)
+        columns = data[:, :, planes % nz]  # (nx, ny, steps + 1), from the vacuum down
+
+        values = np.asarray(values)
+        reached = columns[..., None] >= values  # (nx, ny, steps + 1, n)
+        found = reached.any(axis=2)
+        below = np.argmax(reached, axis=2)  # First plane reaching the value
+        above = np.maximum(below - 1, 0)
+        v_below = np.take_along_axis(columns, below, axis=2)
+        v_above = np.take_along_axis(columns, above, axis=2)
+        # Linear interpolation between the two planes bracketing the value
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(v_below > v_above, (values - v_above) / (v_below - v_above), 0)
+        z = (planes[above] - np.clip(t, 0, 1) * (below - above)) % nz
+        return np.where(found, z / nz * c_length, np.nan)
 
+    # Map points: the grid points of the cube in the (a, b) plane
+    xcryst, ycryst = (
+        axis.ravel()
+        for axis in np.meshgrid(np.arange(nx) / nx, np.arange(ny) / ny, indexing="ij")
+    )
+    cartesian = np.outer(xcryst, lattice[0]) + np.outer(ycryst, lattice[1])
+
+    def images(labels, maps):
+        return {
+            label: {
+                "xcryst": xcryst.tolist(),
+                "ycryst": ycryst.tolist(),
+                "xcart": cartesian[:, 0].tolist(),
+                "ycart": cartesian[:, 1].tolist(),
+                "fstm": maps[:, :, index].ravel().tolist(),
+            }
+            for index, label in enumerate(labels)
+        }
+
+    results = {"height": {}, "current": {}}
+    if heights:
+        labels = list(heights)
+        results["height"] = images(
+            labels,
+            interpolate_planes([heights[label] / c_length for label in labels]),
+        )
+    if currents:
+        labels = list(currents)
+        results["current"] = images(
+            labels, topography([currents[label] for label in labels])
+        )
+    return results
+
+
+def ldos_integration_weights(energies, windows, weighting="trapezoid", broadening=0):
+    """Weights (window, energy) integrating a function sampled at the sorted
+    `energies` (eV) over each (lower, upper) window of `windows`.
+
+    With "trapezoid" the sampled function is integrated exactly as a piecewise
+    linear one, the windows being clipped to the range of `energies`. With
+    "gaussian" the edges of the windows are smoothed by a Gaussian of width
+    `broadening` (eV, the spacing of `energies` if 0).
+    """
+    import math
+    import numpy as np
+
+    energies = np.asarray(energies, dtype=float)
+    windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+    lower = windows[:, :1]
+    upper = windows[:, 1:]
+    weights = np.zeros((len(windows), len(energies)))
+    if len(energies) < 2:
+        return weights
+
+    left, right = energies[:-1], energies[1:]
+    if weighting == "gaussian":
+        # Trapezoidal weights of each energy on the whole grid, times a
+        # smoothed step in and out of the window
+        cells = np.zeros(len(energies))
+        cells[:-1] += (right - left) / 2
+        cells[1:] += (right - left) / 2
+        width = broadening if broadening > 0 else float(np.median(right - left))
+        erf = np.vectorize(math.erf)
+        scale = math.sqrt(2) * width
+        return (
+            cells
+            * 0.5
+            * (erf((upper - energies) / scale) - erf((lower - energies) / scale))
+        )
+
+    # Part of each interval [left, right] inside each window, (window, interval)
+    start = np.clip(lower, left, right)
+    end = np.clip(upper, left, right)
+    length = np.maximum(end - start, 0)
+    # A linear function integrates to the length times its value at the middle
+    t = ((start + end) / 2 - left) / (right - left)
+    weights[:, :-1] += length * (1 - t)
+    weights[:, 1:] += length * t
+    return weights
+
+
+def ldos_stm_images(
+    biases: dict,
+    energies: list,
+    heights: dict = None,
+    currents: dict = None,
+    weighting: str = "trapezoid",
+    broadening: float = 0,
+    folder: str = "parent_folder",
+    method: str = "linear",
+):
+    """STM images at several sample biases from the LDOS grid of `folder`.
+
+    `biases` maps a label to the (lower, upper) window of energies (eV,
+    relative to the Fermi level) of the states imaged at that bias, and
+    `energies` are the energies of the cube files of the grid, in the order
+    of their index. The ILDOS of all the biases is integrated in a single pass
+    over the cube files (see `ldos_integration_weights`), then the images are
+    computed as in `volume_stm_images`.
+    Returns {bias label: {"height": {...}, "current": {...}}}.
+    """
+    import os
+    import re
+    import numpy as np
+    from pymatgen.io.common import VolumetricData
+
+    filenames = sorted(
+        (filename for filename in os.listdir(folder) if filename.endswith(".fileout")),
+        key=lambda filename: int(re.sub(r"\D", "", filename) or 0),
+    )[: len(energies)]
+    labels = list(biases)
+    weights = ldos_integration_weights(
+        energies[: len(filenames)],
+        [biases[label] for label in labels],
+        weighting,
+        broadening,
+    )
+
+    ildos = None
+    structure = None
+    for index, filename in enumerate(filenames):
+        if not weights[:, index].any():
+            continue
+        volumetric_data = VolumetricData.from_cube(os.path.join(folder, filename))
+        data = volumetric_data.data["total"]
+        if ildos is None:
+            ildos = np.zeros((len(labels), *data.shape))
+            structure = volumetric_data.structure
+        ildos += weights[:, index, None, None, None] * data
+
+    results = {}
+    for index, label in enumerate(labels):
+        if ildos is None:
+            results[label] = {"height": {}, "current": {}}
+        else:
+            results[label] = volume_stm_images(
+                ildos[index], structure, heights, currents, method
+            )
     return results
 
 
+def sts_maps(
+    energies: list,
+    heights: dict = None,
+    currents: dict = None,
+    setpoint: list = None,
+    points: dict = None,
+    broadening: float = 0,
+    folder: str = "parent_folder",
+):
+    """dI/dV (STS) maps and point spectra from the LDOS grid of `folder`.
+
+    In the Tersoff-Hamann picture dI/dV is proportional to the LDOS at the
+    tip, which is read at all the energies of the grid (`energies`, eV,
+    relative to the Fermi level, in the order of the index of the cube files)
+    and all the positions at once, one cube file at a time:
+
+    - `heights` maps a label to a height (Å) along the c-axis, the constant
+      height maps are taken on the plane at that height.
+    - `currents` maps a label to a value of the ILDOS of the `setpoint`
+      window of energies (lower, upper), the constant current maps are taken
+      on the surface where the ILDOS reaches the value (see
+      `volume_stm_images`), which is returned as "topography".
+    - `points` maps a label to a position (a, b, height): the crystal
+      coordinates in the plane and the height (Å) along c.
+
+    With `broadening` (eV) the spectra are further smoothed by a Gaussian
+    along the energies. Returns {"height": {...}, "current": {...},
+    "point": {...}}, each map with the energies and the "didv" array
+    (energy, point of the map).
+    """
+    import os
+    import re
+    import numpy as np
+    from pymatgen.io.common import VolumetricData
+
+    heights = heights or {}
+    currents = currents or {}
+    points = points or {}
+    filenames = sorted(
+        (filename for filename in os.listdir(folder) if filename.endswith(".fileout")),
+        key=lambda filename: int(re.sub(r"\D", "", filename) or 0),
+    )[: len(energies)]
+    energies = np.asarray(energies[: len(filenames)], dtype=float)
+
+    def read(filename):
+        volumetric_data = VolumetricData.from_cube(os.path.join(folder, filename))
+        return volumetric_data.data["total"], volumetric_data.structure
+
+    data, structure = read(filenames[0])
+    lattice = structure.lattice.matrix
+    nx, ny, nz = data.shape
+    c_length = np.linalg.norm(lattice[2])
+
+    # Fractional height along c of the tip above each column, (nx, ny, map)
+    height_labels = list(heights)
+    current_labels = list(currents)
+    fractions = np.empty((nx, ny, len(height_labels) + len(current_labels)))
+    for index, label in enumerate(height_labels):
+        fractions[:, :, index] = heights[label] / c_length
+    surfaces = {}
+    if current_labels:
+        weights = ldos_integration_weights(energies, [setpoint])[0]
+        ildos = np.zeros(data.shape)
+        for index, filename in enumerate(filenames):
+            if weights[index]:
+                ildos += weights[index] * read(filename)[0]
+        images = volume_stm_images(ildos, structure, currents=currents)["current"]
+        for index, label in enumerate(current_labels):
+            surfaces[label] = np.reshape(images[label]["fstm"], (nx, ny))
+            fractions[:, :, len(height_labels) + index] = surfaces[label] / c_length
+    missing = np.isnan(fractions)
+    position = np.where(missing, 0, fractions) % 1.0 * nz
+    lower = np.floor(position).astype(int)
+    t = position - lower
+
+    point_labels = list(points)
+    corners = []
+    if point_labels:
+        crystal = np.array([points[label] for label in point_labels], dtype=float)
+        crystal[:, 2] /= c_length
+        shape = np.array([nx, ny, nz])
+        grid = crystal % 1.0 * shape
+        start = np.floor(grid).astype(int)
+        offset = grid - start
+        # Trilinear interpolation between the 8 grid points around each point
+        for shift in np.ndindex(2, 2, 2):
+            weight = np.prod(np.where(shift, offset, 1 - offset), axis=1)
+            corners.append((weight, tuple(((start + shift) % shape).T)))
+
+    maps = np.empty((len(energies), nx, ny, fractions.shape[2]))
+    spectra = np.empty((len(energies), len(point_labels)))
+    for index, filename in enumerate(filenames):
+        if index > 0:
+            data = read(filename)[0]
+        below = np.take_along_axis(data, lower % nz, axis=2)
+        above = np.take_along_axis(data, (lower + 1) % nz, axis=2)
+        maps[index] = below * (1 - t) + above * t
+        spectra[index] = sum(weight * data[corner] for weight, corner in corners)
+    maps[:, missing] = np.nan
+
+    if broadening > 0 and len(energies) > 1:
+        # Each energy becomes a Gaussian weighted average of its neighbours
+        smoothing = np.exp(
+            -0.5 * ((energies[:, None] - energies[None, :]) / broadening) ** 2
+        )
+        smoothing /= smoothing.sum(axis=1, keepdims=True)
+        maps = np.tensordot(smoothing, maps, axes=1)
+        spectra = smoothing @ spectra
+
+    xcryst, ycryst = (
+        axis.ravel()
+        for axis in np.meshgrid(np.arange(nx) / nx, np.arange(ny) / ny, indexing="ij")
+    )
+    cartesian = np.outer(xcryst, lattice[0]) + np.outer(ycryst, lattice[1])
+
+    def map_arrays(index):
+        return {
+            "xcryst": xcryst.tolist(),
+            "ycryst": ycryst.tolist(),
+            "xcart": cartesian[:, 0].tolist(),
+            "ycart": cartesian[:, 1].tolist(),
+            "energies": energies.tolist(),
+            "didv": maps[:, :, :, index].reshape(len(energies), -1).tolist(),
+        }
+
+    results = {"height": {}, "current": {}, "point": {}}
+    for index, label in enumerate(height_labels):
+        results["height"][label] = map_arrays(index)
+    for index, label in enumerate(current_labels):
+        results["current"][label] = {
+            **map_arrays(len(height_labels) + index),
+            "topography": surfaces[label].ravel().tolist(),
+        }
+    for index, label in enumerate(point_labels):
+        results["point"][label] = {
+            "position": list(points[label]),
+            "energies": energies.tolist(),
+            "didv": spectra[:, index].tolist(),
+        }
+    return results
+
+
+JUPYTER_DIR = "/home/jovyan"
+DOWNLOADS_DIR = f"{JUPYTER_DIR}/pp_downloads"
+DOWNLOADS_QUOTA = 5 * 1024**3  # Bytes kept in DOWNLOADS_DIR
+DOWNLOADS_LIFETIME = 3600  # Seconds a downloadable file is kept
+
+
+def format_size(size):
+    """Return a human readable file size."""
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
 def get_jupyter_base_url():
     from notebook import notebookapp
 
@@ -85,62 +486,112 @@ def get_jupyter_base_url():
     return ""
 
 
-def download_remote_file(remote_folder, temp_file_name, file_download):
+def get_jupyter_file_url(file_name):
+    """Return the URL of a file of the Jupyter root directory (served under `/files`)."""
+    return f"{get_jupyter_base_url()}/files/{file_name}"
+
+
+def write_cube(file, atoms, data, comment="Cube file generated by aiidalab-qe-pp"):
+    """Write volumetric data on the cell of `atoms` (ASE) to an open text file in cube format.
+
+    The grid is formatted one (x, y) column at a time, so the text of the whole
+    file is never held in memory.
+    """
+    import numpy as np
+
+    bohr = 0.52917721067
+    data = np.asarray(data)
+    cell = np.asarray(atoms.cell) / bohr
+    positions = atoms.positions / bohr
+
+    lines = [
+        comment,
+        "OUTER LOOP: X, MIDDLE LOOP: Y, INNER LOOP: Z",
+        f"{len(atoms):5d}{0.0:12.6f}{0.0:12.6f}{0.0:12.6f}",
+    ]
+    for npoints, vector in zip(data.shape, cell):
+        voxel = vector / npoints
+        lines.append(f"{npoints:5d}{voxel[0]:12.6f}{voxel[1]:12.6f}{voxel[2]:12.6f}")
+    for number, position in zip(atoms.numbers, positions):
+        lines.append(
+            f"{number:5d}{float(number):12.6f}{position[0]:12.6f}{position[1]:12.6f}{position[2]:12.6f}"
+        )
+    file.write("\n".join(lines) + "\n")
+
+    # Six values per line, a new line after each z column
+    nz = data.shape[2]
+    column_format = ("%13.5E" * 6 + "\n") * (nz // 6)
+    if nz % 6:
+        column_format += "%13.5E" * (nz % 6) + "\n"
+    for plane in data:
+        file.write("".join(column_format % tuple(column) for column in plane))
+
+
+def export_cube(file_name, atoms, data, compress=False):
+    """Write a cube file (gzipped if `compress`) in the downloads folder and return its path."""
+    import gzip
+    import os
+
+    cleanup_downloads(reserve=data.nbytes)
+    if compress:
+        file_path = os.path.join(DOWNLOADS_DIR, f"{file_name}.gz")
+        file = gzip.open(file_path, "wt", compresslevel=6)
+    else:
+        file_path = os.path.join(DOWNLOADS_DIR, file_name)
+        file = open(file_path, "w")
+
+    with file:
+        write_cube(file, atoms, data)
+    return file_path
+
+
+def cleanup_downloads(reserve=0, quota=DOWNLOADS_QUOTA, lifetime=DOWNLOADS_LIFETIME):
+    """Remove the expired files of DOWNLOADS_DIR, then the oldest ones until
+    `reserve` more bytes fit in the quota. Partial (`.part`) files are left alone."""
     import os
-    import threading
     import time
-    from IPython.display import display, Javascript
 
-    jupyter_dir = "/home/jovyan"
-    os.makedirs(jupyter_dir, exist_ok=True)
+    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+    now = time.time()
+    files = []
+    for entry in os.scandir(DOWNLOADS_DIR):
+        if not entry.is_file() or entry.name.endswith(".part"):
+            continue
+        stat = entry.stat()
+        if now - stat.st_mtime > lifetime:
+            os.remove(entry.path)
+        else:
+            files.append((stat.st_mtime, stat.st_size, entry.path))
 
-    temp_file_path = os.path.join(jupyter_dir, temp_file_name)
+    files.sort()
+    used = sum(size for _, size, _ in files)
+    for _, size, path in files:
+        if used + reserve <= quota:
+            break
+        os.remove(path)
+        used -= size
 
-    try:
-        remote_folder.getfile(file_download, temp_file_path)
 
-        # Ensure file exists and is not empty
-        if not os.path.exists(temp_file_path) or os.path.getsize(temp_file_path) == 0:
-            print("ERROR: Downloaded file is empty.")
-            return
+def trigger_download(file_path):
+    """Make the browser download a file of the Jupyter root directory.
 
-        base_url = get_jupyter_base_url()
-        jupyter_path = f"{base_url}/files/{temp_file_name}"
+    Only the link travels to the browser, the file itself is served through the
+    Jupyter `/files` route and removed later by `cleanup_downloads`.
+    """
+    import os
+    from IPython.display import display, Javascript
 
-        js_download = Javascript(
+    file_name = os.path.basename(file_path)
+    jupyter_path = get_jupyter_file_url(os.path.relpath(file_path, JUPYTER_DIR))
+    display(
+        Javascript(
             f"""
             var link = document.createElement('a');
             link.href = "{jupyter_path}";
-            link.download = "{temp_file_name}";
+            link.download = "{file_name}";
             document.body.appendChild(link);
             link.click();
             document.body.removeChild(link);
-
-            setTimeout(function() {{
-                fetch("{jupyter_path}", {{ method: 'HEAD' }})
-                .then(response => {{
-                    if (response.status === 404) {{
-                        console.log("File already deleted.");
-                    }} else {{
-                        fetch('/delete_file', {{
-                            method: 'POST',
-                            headers: {{ 'Content-Type': 'application/json' }},
-                            body: JSON.stringify({{'file_path': '{temp_file_path}'}})
-                        }})
-                        .then(response => console.log("File deletion request sent."));
-                    }}
-                }});
-            }}, 90000);
             """
         )
-        display(js_download)
-
-        def delete_file():
-            time.sleep(120)
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
-
-        threading.Thread(target=delete_file, daemon=True).start()
-
-    except Exception as e:
-        print(f"Error: {e}")
+    )
@@ -137,3 +137,33 @@ class OrbitalListWidget(VerticalStackWidget, tl.HasTraits):
     def _update_orbitals(self, *_):
         """Update the orbitals trait when items change."""
         self.orbitals = [(item.kbands.value, item.kpoint.value) for item in self.items]
+
+
+class DownloadProgressWidget(ipw.VBox):
+    """Progress, status and cancel button of a background source file download."""
+
+    def __init__(self, model, **kwargs):
+        self.progress = ipw.FloatProgress(
+            min=0.0,
+            max=1.0,
+            bar_style="info",
+            layout={"width": "300px"},
+        )
+        ipw.dlink((model, "download_progress"), (self.progress, "value"))
+        self.cancel_button = ipw.Button(
+            description="Cancel",
+            button_style="warning",
+            icon="times",
+            layout={"width": "fit-content"},
+        )
+        self.cancel_button.on_click(model.cancel_download)
+        self.status = ipw.HTML("")
+        ipw.dlink((model, "download_status"), (self.status, "value"))
+
+        self.progress_box = ipw.HBox([self.progress, self.cancel_button])
+        ipw.dlink(
+            (model, "downloading"),
+            (self.progress_box.layout, "display"),
+            lambda downloading: "flex" if downloading else "none",
+        )
+        super().__init__(children=[self.progress_box, self.status], **kwargs)
@@ -2,6 +2,7 @@ from aiida.plugins import WorkflowFactory
 from aiida import orm
 from aiidalab_widgets_base.utils import string_range_to_list
 from aiidalab_qe.utils import set_component_resources
+from aiidalab_qe_pp.parameters import DEFAULT_STS_SETPOINT_BIAS
 
 
 PPWorkChain = WorkflowFactory("pp_app.pp")
@@ -74,7 +75,7 @@ def update_resources(builder, codes):
 
 def get_builder(codes, structure, parameters):
     pp_code = codes.get("pp")["code"]
-    critic2_code = codes.get("critic2")["code"]
+    critic2_code = codes.get("critic2", {}).get("code")
     python_code = codes.get("python")["code"]
     # Filter the dictionary to include only keys that start with 'calc_'
     calc_parameters = {
@@ -122,6 +123,18 @@ def get_builder(codes, structure, parameters):
             "sample_bias": parameters["pp"]["stm_sample_bias"],
             "heights": parameters["pp"]["stm_heights"],
             "currents": parameters["pp"]["stm_currents"],
+            "source": parameters["pp"].get("stm_source", "pp"),
+            "ldos_weighting": parameters["pp"].get("stm_ldos_weighting", "trapezoid"),
+            "ldos_broadening": parameters["pp"].get("stm_ldos_broadening", 0.0),
+        },
+        "sts": {
+            "heights": parameters["pp"].get("sts_heights", ""),
+            "currents": parameters["pp"].get("sts_currents", ""),
+            "setpoint_bias": parameters["pp"].get(
+                "sts_setpoint_bias", DEFAULT_STS_SETPOINT_BIAS
+            ),
+            "points": parameters["pp"].get("sts_points", ""),
+            "broadening": parameters["pp"].get("sts_broadening", 0.0),
         },
         "wfn": {
             "orbitals": parse_list_of_tuples(
@@ -132,6 +145,7 @@ def get_builder(codes, structure, parameters):
             "lsign": lsign,
         },
         "reduce_cube_files": parameters["pp"]["reduce_cube_files"],
+        "stm_engine": parameters["pp"].get("stm_engine", "critic2"),
         "ildos_stm": {
             "heights": parameters["pp"]["ildos_stm_heights"],
             "currents": parameters["pp"]["ildos_stm_currents"],
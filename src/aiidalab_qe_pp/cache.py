@@ -0,0 +1,249 @@
+"""Caches of the arrays loaded from `ArrayData` nodes and of the data derived
+from them.
+
+`array_cache` keeps the loaded arrays in memory for the whole process. The
+arrays are keyed by the UUID of the node and the name of the array (and the
+index of the slice for partial reads), so that opening the same results
+twice, or coming back to a tab, does not read the repository again. The
+least recently used arrays are evicted once the memory budget is exceeded.
+The budget (bytes) can be set with the `AIIDALAB_QE_PP_CACHE_BYTES`
+environment variable or `array_cache.set_max_bytes`. Cached arrays are
+shared, they are returned read-only.
+
+`disk_cache` keeps the data computed from the arrays for the visualization
+(interpolated STM and STS grids, LDOS energies) on disk, so that they are
+not computed again in the next sessions. The nodes are immutable, the entries
+are keyed by the UUID of the node, a name and the version of the processing
+that produced them. It lives in `AIIDALAB_QE_PP_DISK_CACHE_DIR` (by default
+``~/.cache/aiidalab-qe-pp``) and is limited to `AIIDALAB_QE_PP_DISK_CACHE_BYTES`.
+"""
+
+import glob
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 1024**3
+DEFAULT_DISK_MAX_BYTES = 512 * 1024**2
+
+
+class ArrayCache:
+    """LRU cache of NumPy arrays under a memory budget of `max_bytes`."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._arrays
+
+    def _get(self, key, load):
+        with self._lock:
+            if key in self._arrays:
+                self.hits += 1
+                self._arrays.move_to_end(key)
+                return self._arrays[key]
+            self.misses += 1
+
+        # Read outside of the lock, other threads can use the cache meanwhile
+        array = load()
+        array.setflags(write=False)
+        with self._lock:
+            if key not in self._arrays and array.nbytes <= self.max_bytes:
+                self._arrays[key] = array
+                self._size += array.nbytes
+                self._evict()
+        return array
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._arrays:
+            _, array = self._arrays.popitem(last=False)
+            self._size -= array.nbytes
+
+    def get(self, array_node, name="data"):
+        """Return the array `name` of `array_node`."""
+        return self._get((array_node.uuid, name), lambda: array_node.get_array(name))
+
+    def get_slice(self, array_node, name, index):
+        """Return `array[index]` of the array `name` of `array_node`, reading
+        only that slice (see `read_array_slice`) if the array is not cached."""
+        from aiidalab_qe_pp.reader import read_array_slice
+
+        with self._lock:
+            array = self._arrays.get((array_node.uuid, name))
+        if array is not None:
+            return array[index]
+        return self._get(
+            (array_node.uuid, name, index),
+            lambda: read_array_slice(array_node, name, index),
+        )
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return the hits, misses, number of arrays and bytes in the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "arrays": len(self._arrays),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+array_cache = ArrayCache(
+    int(os.environ.get("AIIDALAB_QE_PP_CACHE_BYTES", DEFAULT_MAX_BYTES))
+)
+
+
+def get_array(array_node, name="data"):
+    """Return the array `name` of `array_node` through the process-wide cache."""
+    return array_cache.get(array_node, name)
+
+
+def get_array_slice(array_node, name, index):
+    """Return `array[index]` of `array_node` through the process-wide cache."""
+    return array_cache.get_slice(array_node, name, index)
+
+
+def default_disk_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "aiidalab-qe-pp")
+
+
+class DiskCache:
+    """Arrays derived from immutable nodes, stored as one `.npz` file per entry
+    in `directory`. The least recently used files are removed once the files
+    take more than `max_bytes` (0 disables the cache)."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_DISK_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, uuid, name, version):
+        return os.path.join(self.directory, f"{uuid}_{name}_v{version}.npz")
+
+    def get(self, uuid, name, version):
+        """Return the dict of arrays stored for the entry, or None."""
+        if self.max_bytes <= 0:
+            return None
+        path = self._path(uuid, name, version)
+        try:
+            with np.load(path) as file:
+                arrays = {key: file[key] for key in file.files}
+            # The modification time orders the entries for the eviction
+            os.utime(path)
+        except Exception:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return arrays
+
+    def put(self, uuid, name, version, arrays):
+        """Store the dict of arrays `arrays` for the entry."""
+        if self.max_bytes <= 0:
+            return
+        path = self._path(uuid, name, version)
+        part = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(part, "wb") as handle:
+                np.savez(handle, **arrays)
+            os.replace(part, path)
+            # Entries written by older versions of the processing are stale
+            for stale in glob.glob(self._path(uuid, name, "*")):
+                if stale != path:
+                    os.remove(stale)
+            self._evict()
+        except OSError:
+            # The cache is only an optimization (e.g. read-only home directory)
+            if os.path.exists(part):
+                os.remove(part)
+
+    def get_or_compute(self, uuid, name, version, compute):
+        """Return the entry, calling `compute()` (returning a dict of arrays)
+        and storing its result if it is not cached yet."""
+        arrays = self.get(uuid, name, version)
+        if arrays is None:
+            arrays = compute()
+            self.put(uuid, name, version, arrays)
+        return arrays
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".npz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            size = sum(entry[1] for entry in entries)
+            for _, file_size, path in sorted(entries):
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= file_size
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, "*.npz")):
+            os.remove(path)
+
+    def stats(self):
+        """Return the hits, misses, number of entries and bytes on disk."""
+        paths = glob.glob(os.path.join(self.directory, "*.npz"))
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "entries": len(paths),
+            "bytes": sum(os.path.getsize(path) for path in paths),
+            "max_bytes": self.max_bytes,
+        }
+
+
+disk_cache = DiskCache(
+    os.environ.get("AIIDALAB_QE_PP_DISK_CACHE_DIR") or default_disk_cache_dir(),
+    int(os.environ.get("AIIDALAB_QE_PP_DISK_CACHE_BYTES", DEFAULT_DISK_MAX_BYTES)),
+)
+
+
+def compute_isovalue(data):
+    return 2 * np.std(data) + np.mean(data)
+
+
+def get_isovalue(array_node, index=None):
+    """Return the isovalue shown for the array `data` of `array_node` (or its
+    slice `index`). Only the data are cached, the isovalue is cheap to compute
+    once they are loaded."""
+    data = (
+        get_array(array_node)
+        if index is None
+        else get_array_slice(array_node, "data", index)
+    )
+    return float(compute_isovalue(data))
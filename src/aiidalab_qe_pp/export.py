@@ -0,0 +1,201 @@
+"""Export all the results of a `PPWorkChain` into a single HDF5 file.
+
+The export requires `h5py` (``pip install aiidalab-qe-pp[hdf5]``). The file
+is written one dataset at a time, so that at most one array is held in
+memory (when a PK or node is given). Layout of the file::
+
+    /                 provenance (attributes)
+    /structure        cell, positions, numbers (+ pbc, symbols)
+    /volumes/<name>   charge_dens, spin_dens, potential, ildos
+    /orbitals/<label> kp_<kpoint>_kb_<band>
+    /ldos/energies    energies of the LDOS grid (eV, relative to the Fermi level)
+    /ldos/<index>     LDOS at each energy
+    /stm/<label>      x, y and values of each STM map (same for /ildos_stm)
+    /sts/<label>      energies, x, y and didv of each dI/dV map (+ topography
+                      for constant current), or energies, position and didv
+                      of each point spectrum
+"""
+
+import json
+
+import numpy as np
+
+from aiidalab_qe_pp.reader import STM_PROPERTIES, UNITS, PpResults
+
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+
+
+def _require_h5py():
+    try:
+        import h5py
+    except ImportError as exception:
+        raise ImportError(
+            "The HDF5 export requires h5py, install it with "
+            "`pip install aiidalab-qe-pp[hdf5]`."
+        ) from exception
+    return h5py
+
+
+def _write_dataset(group, name, data, **attributes):
+    data = np.asarray(data)
+    options = {}
+    if data.ndim > 0 and data.size > 1:
+        options = {
+            "chunks": True,
+            "compression": COMPRESSION,
+            "compression_opts": COMPRESSION_LEVEL,
+            "shuffle": True,
+        }
+    dataset = group.create_dataset(name, data=data, **options)
+    for key, value in attributes.items():
+        if value is not None:
+            dataset.attrs[key] = value
+    return dataset
+
+
+def _write_volume(group, volume, source):
+    _write_dataset(
+        group,
+        volume.label,
+        volume.data,
+        units=volume.units,
+        source_uuid=source,
+    )
+
+
+def export_hdf5(node, file_path, on_progress=None):
+    """Write all the volumetric, STM and STS outputs of `node` (a `PPWorkChain`,
+    its PK or a `PpResults`) into the HDF5 file `file_path`.
+
+    `on_progress(done, total)` is called after each dataset.
+    """
+    h5py = _require_h5py()
+    # Without the cache only the dataset being written is held in memory
+    results = node if isinstance(node, PpResults) else PpResults(node, use_cache=False)
+
+    orbitals = results.orbitals
+    energies = results.ldos_energies
+    stm_maps = {name: results.stm_maps(name) for name in STM_PROPERTIES}
+    sts_maps = results.sts_maps()
+    sts_spectra = results.sts_spectra()
+    total = (
+        len(results.volumes)
+        + len(orbitals)
+        + len(energies)
+        + sum(len(labels) for labels in stm_maps.values())
+        + len(sts_maps)
+        + len(sts_spectra)
+    )
+    done = 0
+
+    def progress():
+        nonlocal done
+        done += 1
+        if on_progress:
+            on_progress(done, total)
+
+    with h5py.File(file_path, "w") as file:
+        workchain = results.node
+        file.attrs["workchain_uuid"] = workchain.uuid
+        file.attrs["workchain_pk"] = workchain.pk
+        file.attrs["ctime"] = workchain.ctime.isoformat()
+        file.attrs["parameters"] = json.dumps(results.parameters)
+        file.attrs["fermi_energy"] = results.fermi
+        if "parent_folder" in workchain.inputs:
+            parent_folder = workchain.inputs.parent_folder
+            file.attrs["parent_folder_uuid"] = parent_folder.uuid
+            creator = parent_folder.creator
+            if creator is not None:
+                file.attrs["parent_calculation_uuid"] = creator.uuid
+
+        atoms = results.get_atoms()
+        structure = file.create_group("structure")
+        structure.attrs["uuid"] = results.structure.uuid
+        structure.attrs["pbc"] = atoms.pbc
+        structure.attrs["symbols"] = json.dumps(atoms.get_chemical_symbols())
+        _write_dataset(structure, "cell", atoms.cell.array, units="Angstrom")
+        _write_dataset(structure, "positions", atoms.positions, units="Angstrom")
+        _write_dataset(structure, "numbers", atoms.numbers)
+
+        group = file.create_group("volumes")
+        group.attrs["description"] = "Values on a regular grid of the unit cell"
+        for name in results.volumes:
+            volume = results.get_volume(name)
+            source = workchain.outputs[name].output_data.uuid
+            _write_volume(group, volume, source)
+            progress()
+
+        if orbitals:
+            group = file.create_group("orbitals")
+            for volume in results.iter_orbitals():
+                _write_volume(group, volume, None)
+                progress()
+
+        if len(energies):
+            group = file.create_group("ldos")
+            _write_dataset(group, "energies", energies, units="eV")
+            for index in range(len(energies)):
+                volume = results.get_ldos(index)
+                _write_dataset(
+                    group,
+                    str(index),
+                    volume.data,
+                    units=volume.units,
+                    energy=energies[index],
+                    label=volume.label,
+                )
+                progress()
+
+        for name, labels in stm_maps.items():
+            if not labels:
+                continue
+            group = file.create_group(name)
+            for label in labels:
+                stm_map = results.get_stm_map(label, name)
+                subgroup = group.create_group(label)
+                subgroup.attrs["mode"] = stm_map.mode
+                subgroup.attrs["value"] = stm_map.value
+                subgroup.attrs["value_units"] = (
+                    "Angstrom" if stm_map.mode == "height" else "a.u."
+                )
+                if stm_map.bias is not None:
+                    subgroup.attrs["bias"] = stm_map.bias
+                    subgroup.attrs["bias_units"] = "eV"
+                _write_dataset(subgroup, "x", stm_map.x, units="Angstrom")
+                _write_dataset(subgroup, "y", stm_map.y, units="Angstrom")
+                _write_dataset(subgroup, "values", stm_map.values)
+                progress()
+
+        if sts_maps or sts_spectra:
+            group = file.create_group("sts")
+            group.attrs["didv_units"] = UNITS["ldos_grid"]
+            for sts_map in results.iter_sts_maps():
+                subgroup = group.create_group(sts_map.name)
+                subgroup.attrs["mode"] = sts_map.mode
+                subgroup.attrs["value"] = sts_map.value
+                subgroup.attrs["value_units"] = (
+                    "Angstrom" if sts_map.mode == "height" else "a.u."
+                )
+                _write_dataset(subgroup, "energies", sts_map.energies, units="eV")
+                _write_dataset(subgroup, "x", sts_map.x, units="Angstrom")
+                _write_dataset(subgroup, "y", sts_map.y, units="Angstrom")
+                _write_dataset(subgroup, "didv", sts_map.didv)
+                if sts_map.topography is not None:
+                    _write_dataset(
+                        subgroup, "topography", sts_map.topography, units="Angstrom"
+                    )
+                progress()
+            for spectrum in results.iter_sts_spectra():
+                subgroup = group.create_group(spectrum.name)
+                _write_dataset(subgroup, "energies", spectrum.energies, units="eV")
+                _write_dataset(
+                    subgroup,
+                    "position",
+                    spectrum.position,
+                    units="crystal, crystal, Angstrom",
+                )
+                _write_dataset(subgroup, "didv", spectrum.didv)
+                progress()
+
+    return file_path
@@ -0,0 +1,64 @@
+"""Parsing of the STM and STS parameters of the app.
+
+These are shared by the settings of the app and by the `PPWorkChain`, and are
+kept apart from the workflow so that the app can use them without importing
+the AiiDA engine and plugins.
+"""
+
+# The constant current STS maps are set at the current of this bias (eV)
+DEFAULT_STS_SETPOINT_BIAS = -1.0
+
+
+def text2floatlist(input_string):
+    # Split the input string into substrings
+    string_list = input_string.split()
+    float_list = [float(num) for num in string_list]
+    return float_list
+
+
+def stm_energy_window(bias):
+    """Return the (lower, upper) energies (eV, relative to the Fermi level) of
+    the states imaged at the sample bias `bias` (eV). pp.x is given the bias
+    with the opposite sign (see `ppworkchain.parse_stm_parameters`) and integrates the
+    states between the Fermi level and the Fermi level plus its bias."""
+    return (min(0.0, -bias), max(0.0, -bias))
+
+
+def parse_sts_points(text):
+    """Parse the positions of the STS point spectra, "a b height" separated by
+    ";" (crystal coordinates in the plane and height in Å), into
+    {"1": [a, b, height], ...}."""
+    points = {}
+    for position in filter(str.strip, (text or "").split(";")):
+        try:
+            values = text2floatlist(position)
+        except ValueError:
+            values = []
+        if len(values) != 3:
+            raise ValueError(f"Invalid STS point: {position.strip()}")
+        points[str(len(points) + 1)] = values
+    return points
+
+
+def parse_sts_parameters(settings: dict) -> dict:
+    """Parse the STS parameters from settings, raising a `ValueError` with a
+    message for the user if they are not valid. The setpoint is returned as
+    the energy window of its bias (see `stm_energy_window`)."""
+    try:
+        heights = text2floatlist(settings.get("heights", ""))
+        currents = text2floatlist(settings.get("currents", ""))
+    except ValueError:
+        raise ValueError("Invalid STS heights or currents")
+    points = parse_sts_points(settings.get("points", ""))
+    if not (heights or currents or points):
+        raise ValueError("No STS map nor point spectrum is requested")
+    setpoint_bias = settings.get("setpoint_bias", DEFAULT_STS_SETPOINT_BIAS)
+    if currents and setpoint_bias == 0:
+        raise ValueError("The setpoint bias of the constant current maps can not be 0")
+    return {
+        "heights": heights,
+        "currents": currents,
+        "points": points,
+        "setpoint": stm_energy_window(setpoint_bias),
+        "broadening": settings.get("broadening", 0.0),
+    }
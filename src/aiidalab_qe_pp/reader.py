@@ -0,0 +1,387 @@
+"""Read the results of a `PPWorkChain` as NumPy arrays, without any widget.
+
+Example::
+
+    from aiidalab_qe_pp.reader import PpResults
+
+    results = PpResults(1234)
+    density = results.get_volume("charge_dens").data
+    for ldos in results.iter_ldos():
+        print(ldos.label, ldos.data.max())
+"""
+
+import re
+from collections import namedtuple
+
+import numpy as np
+from aiida import orm
+
+from aiidalab_qe_pp.cache import array_cache
+
+VOLUME_PROPERTIES = ("charge_dens", "spin_dens", "potential", "ildos")
+STM_PROPERTIES = ("stm", "ildos_stm")
+
+# Units of the values written by pp.x for each property
+UNITS = {
+    "charge_dens": "e/bohr^3",
+    "spin_dens": "e/bohr^3",
+    "potential": "Ry",
+    "ildos": "e/bohr^3",
+    "wfn": "|psi|^2 (1/bohr^3)",
+    "ldos_grid": "states/eV/bohr^3",
+}
+
+# `data` is sampled on the full unit cell `cell` (Angstrom, one vector per row)
+Volume = namedtuple("Volume", ["name", "label", "data", "cell", "units"])
+# `x` and `y` are cartesian coordinates (Angstrom), `bias` is in eV (None for ILDOS)
+STMMap = namedtuple("STMMap", ["name", "mode", "value", "bias", "x", "y", "values"])
+# `didv` has the shape (energy, point of the map), `topography` is the height
+# (Angstrom) of the constant current surface (None for a constant height map)
+STSMap = namedtuple(
+    "STSMap", ["name", "mode", "value", "energies", "x", "y", "didv", "topography"]
+)
+# `position` is (a, b, height): crystal coordinates in the plane and height (Angstrom)
+STSSpectrum = namedtuple("STSSpectrum", ["name", "position", "energies", "didv"])
+
+
+def expand_kpoint_band_label(label):
+    """Return the labels of each band of a wavefunction output label,
+    e.g. "kp_1_kb_3_5" -> ["kp_1_kb_3", "kp_1_kb_4", "kp_1_kb_5"]."""
+    match = re.match(r"kp_(\d+)_kb_(\d+)_(\d+)", label)
+    if not match:
+        raise ValueError("String format is not correct")
+    kpoint = match.group(1)
+    start_band = int(match.group(2))
+    end_band = int(match.group(3))
+    return [f"kp_{kpoint}_kb_{band}" for band in range(start_band, end_band + 1)]
+
+
+def parse_stm_label(label):
+    """Return the mode, value and bias (if any) encoded in the output label
+    of a critic2 calculation, e.g. "stm_bias_neg_1_0_height_2_0", or None."""
+
+    def parse_float(parts):
+        if len(parts) == 1:
+            return float(parts[0])
+        elif len(parts) == 2:
+            return float(parts[0] + "." + parts[1])
+        return None
+
+    mode = next((m for m in ["height", "current"] if m in label), None)
+    if not mode:
+        return None
+
+    start_index = label.find(mode)
+    value = parse_float(label[start_index + len(mode) + 1 :].split("_"))
+    if value is None:
+        return None
+
+    entry = {"mode": mode, "value": value}
+    if "stm_bias" in label:
+        bias_value = label[
+            label.find("stm_bias") + len("stm_bias") + 1 : start_index - 1
+        ]
+        bias_sign = -1 if "neg_" in bias_value else 1
+        bias = parse_float(bias_value.replace("neg_", "").split("_"))
+        if bias is not None:
+            entry["stm_bias"] = bias * bias_sign
+    return entry
+
+
+def parse_ldos_energies(aiida_out, fermi=0.0):
+    """Return the energies (eV, relative to `fermi`) and broadenings of the
+    LDOS grid, read from the pp.x output."""
+    energies = []
+    broadenings = []
+    for line in re.findall(r"^\s*Energy\s*=.*", aiida_out, re.MULTILINE):
+        energies.append(float(line.split("=")[1].split("eV")[0].strip()) - fermi)
+        broadenings.append(line.split("broadening =")[1].strip())
+    return np.array(energies), broadenings
+
+
+def _read_npy_header(handle):
+    """Return the shape, order, dtype and data offset of an open `.npy` file."""
+    version = np.lib.format.read_magic(handle)
+    if version == (1, 0):
+        header = np.lib.format.read_array_header_1_0(handle)
+    else:
+        header = np.lib.format.read_array_header_2_0(handle)
+    shape, fortran_order, dtype = header
+    return shape, fortran_order, dtype, handle.tell()
+
+
+def read_array_slice(array_node, name, index):
+    """Return `array[index]` of the array `name` of `array_node`, reading only
+    that slice from the repository."""
+    with array_node.base.repository.open(f"{name}.npy", mode="rb") as handle:
+        shape, fortran_order, dtype, offset = _read_npy_header(handle)
+        if fortran_order or not handle.seekable():
+            return array_node.get_array(name)[index]
+        count = int(np.prod(shape[1:]))
+        handle.seek(offset + index * count * dtype.itemsize)
+        data = np.frombuffer(handle.read(count * dtype.itemsize), dtype=dtype)
+    return data.reshape(shape[1:])
+
+
+def read_array_line(array_node, name, point):
+    """Return `array[:, *point]` of the array `name` of `array_node`, e.g. the
+    spectrum at one voxel of an (energy, x, y, z) array, reading one value
+    per slice from the repository."""
+    with array_node.base.repository.open(f"{name}.npy", mode="rb") as handle:
+        shape, fortran_order, dtype, offset = _read_npy_header(handle)
+        if fortran_order or not handle.seekable():
+            return array_node.get_array(name)[(slice(None), *point)]
+        count = int(np.prod(shape[1:]))
+        position = int(np.ravel_multi_index(point, shape[1:]))
+        values = np.empty(shape[0], dtype=dtype)
+        for index in range(shape[0]):
+            handle.seek(offset + (index * count + position) * dtype.itemsize)
+            values[index] = np.frombuffer(handle.read(dtype.itemsize), dtype=dtype)[0]
+    return values
+
+
+class PpResults:
+    """The outputs of a finished `PPWorkChain`.
+
+    The arrays are only read from the repository when they are accessed. With
+    `use_cache` they go through the process-wide `aiidalab_qe_pp.cache`,
+    otherwise nothing is kept in memory.
+    """
+
+    def __init__(self, node, use_cache=True):
+        if not isinstance(node, orm.Node):
+            node = orm.load_node(node)
+        self.node = node
+        self.parameters = (
+            node.inputs.parameters.get_dict() if "parameters" in node.inputs else {}
+        )
+        self.use_cache = use_cache
+        self._structure = None
+        self._ldos = None
+
+    @property
+    def fermi(self):
+        """Fermi energy (eV) of the parent calculation."""
+        return self.parameters.get("fermi", 0.0)
+
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = self.node.inputs.structure
+        return self._structure
+
+    @property
+    def cell(self):
+        return np.array(self.structure.cell)
+
+    def get_atoms(self):
+        """Return the structure as ASE `Atoms`."""
+        return self.structure.get_ase()
+
+    def get_array(self, array_node, name="data"):
+        """Return the array `name` of `array_node`."""
+        if self.use_cache:
+            return array_cache.get(array_node, name)
+        return array_node.get_array(name)
+
+    def get_array_slice(self, array_node, name, index):
+        """Return `array[index]` of the array `name` of `array_node`."""
+        if self.use_cache:
+            return array_cache.get_slice(array_node, name, index)
+        return read_array_slice(array_node, name, index)
+
+    def _volume(self, name, label, array_node, units):
+        return Volume(name, label, self.get_array(array_node), self.cell, units)
+
+    # Volumetric data
+
+    @property
+    def volumes(self):
+        """Names of the volumetric outputs, e.g. ["charge_dens", "ildos"]."""
+        return [name for name in VOLUME_PROPERTIES if name in self.node.outputs]
+
+    def get_volume(self, name):
+        if name not in self.volumes:
+            raise KeyError(f"The workchain has no `{name}` output.")
+        output = self.node.outputs[name]
+        return self._volume(name, name, output.output_data, UNITS[name])
+
+    def iter_volumes(self):
+        for name in self.volumes:
+            yield self.get_volume(name)
+
+    # Orbitals
+
+    def _orbital_nodes(self):
+        nodes = {}
+        if "wfn" not in self.node.outputs:
+            return nodes
+        wfn = self.node.outputs.wfn
+        for key in wfn.keys():
+            if "output_data_multiple" in wfn[key]:
+                labels = expand_kpoint_band_label(key)
+                multiple = wfn[key].output_data_multiple
+                for label, output_key in zip(labels, multiple.keys()):
+                    nodes[label] = multiple[output_key]
+            elif "output_data" in wfn[key]:
+                nodes[key] = wfn[key].output_data
+        return nodes
+
+    @property
+    def orbitals(self):
+        """The (kpoint, band) pairs of the computed orbitals. With LSDA the
+        k-points of the spin down channel are shifted by the number of k-points."""
+        pairs = []
+        for label in self._orbital_nodes():
+            _, kpoint, _, band = label.split("_")
+            pairs.append((int(kpoint), int(band)))
+        return sorted(pairs)
+
+    def get_orbital(self, kpoint, band, spin="up"):
+        wfn = self.parameters.get("wfn", {})
+        if wfn.get("lsda") and spin == "down":
+            kpoint += wfn.get("number_of_k_points", 0)
+        label = f"kp_{kpoint}_kb_{band}"
+        nodes = self._orbital_nodes()
+        if label not in nodes:
+            raise KeyError(f"No orbital for k-point {kpoint} and band {band}.")
+        return self._volume("wfn", label, nodes[label], UNITS["wfn"])
+
+    def iter_orbitals(self):
+        nodes = self._orbital_nodes()
+        for label, array_node in nodes.items():
+            yield self._volume("wfn", label, array_node, UNITS["wfn"])
+
+    # LDOS on a grid of energies
+
+    def _ldos_outputs(self):
+        """Return the energies and broadenings of the LDOS grid, and either the
+        stacked `ArrayData` (reduced cube files) or the list of `ArrayData` of
+        each energy (stored by the PpCalculation, or older runs)."""
+        if self._ldos is None:
+            ldos = self.node.outputs.ldos_grid
+            if "output_data_stack" in ldos:
+                stack = ldos.output_data_stack
+                self._ldos = (
+                    stack.get_array("energies"),
+                    stack.base.attributes.get("broadenings", []),
+                    stack,
+                )
+            else:
+                energies, broadenings = parse_ldos_energies(
+                    ldos.retrieved.get_object_content("aiida.out"), self.fermi
+                )
+                if "output_data_multiple" in ldos:
+                    multiple = ldos.output_data_multiple
+                    nodes = [multiple[key] for key in multiple.keys()]
+                else:
+                    nodes = [ldos.output_data]
+                self._ldos = (energies[: len(nodes)], broadenings, nodes)
+        return self._ldos
+
+    @property
+    def ldos_energies(self):
+        """Energies (eV, relative to the Fermi level) of the LDOS grid."""
+        if "ldos_grid" not in self.node.outputs:
+            return np.array([])
+        return self._ldos_outputs()[0]
+
+    def get_ldos(self, index):
+        energies, broadenings, nodes = self._ldos_outputs()
+        label = f"E = {energies[index]:.5f} eV"
+        if index < len(broadenings):
+            label += f", broadening = {broadenings[index]}"
+        if isinstance(nodes, list):
+            data = self.get_array(nodes[index])
+        else:
+            data = self.get_array_slice(nodes, "data", index)
+        return Volume("ldos_grid", label, data, self.cell, UNITS["ldos_grid"])
+
+    def get_ldos_spectrum(self, point):
+        """Return the LDOS at the grid point `point` (i, j, k) for all the energies."""
+        energies, _, nodes = self._ldos_outputs()
+        if isinstance(nodes, list):
+            return np.array([self.get_array(node)[tuple(point)] for node in nodes])
+        return read_array_line(nodes, "data", tuple(point))
+
+    def iter_ldos(self):
+        for index in range(len(self.ldos_energies)):
+            yield self.get_ldos(index)
+
+    # STM maps
+
+    def stm_maps(self, name="stm"):
+        """Labels of the STM maps of `name` ("stm" or "ildos_stm")."""
+        if name not in self.node.outputs:
+            return []
+        return [
+            label
+            for label in self.node.outputs[name].keys()
+            if parse_stm_label(label) is not None
+        ]
+
+    def get_stm_map(self, label, name="stm"):
+        stm_data = self.node.outputs[name][label]["stm_data"]
+        entry = parse_stm_label(label)
+        return STMMap(
+            label,
+            entry["mode"],
+            entry["value"],
+            entry.get("stm_bias"),
+            self.get_array(stm_data, "xcart"),
+            self.get_array(stm_data, "ycart"),
+            self.get_array(stm_data, "fstm"),
+        )
+
+    def iter_stm_maps(self, name="stm"):
+        for label in self.stm_maps(name):
+            yield self.get_stm_map(label, name)
+
+    # dI/dV (STS) maps and point spectra
+
+    def _sts_labels(self):
+        if "sts" not in self.node.outputs:
+            return []
+        return list(self.node.outputs.sts.keys())
+
+    def sts_maps(self):
+        """Labels of the dI/dV maps."""
+        return [label for label in self._sts_labels() if parse_stm_label(label)]
+
+    def get_sts_map(self, label):
+        sts_data = self.node.outputs.sts[label]["sts_data"]
+        entry = parse_stm_label(label)
+        topography = None
+        if "topography" in sts_data.get_arraynames():
+            topography = self.get_array(sts_data, "topography")
+        return STSMap(
+            label,
+            entry["mode"],
+            entry["value"],
+            self.get_array(sts_data, "energies"),
+            self.get_array(sts_data, "xcart"),
+            self.get_array(sts_data, "ycart"),
+            self.get_array(sts_data, "didv"),
+            topography,
+        )
+
+    def iter_sts_maps(self):
+        for label in self.sts_maps():
+            yield self.get_sts_map(label)
+
+    def sts_spectra(self):
+        """Labels of the dI/dV point spectra."""
+        return [label for label in self._sts_labels() if label.startswith("point_")]
+
+    def get_sts_spectrum(self, label):
+        sts_data = self.node.outputs.sts[label]["sts_data"]
+        return STSSpectrum(
+            label,
+            self.get_array(sts_data, "position"),
+            self.get_array(sts_data, "energies"),
+            self.get_array(sts_data, "didv"),
+        )
+
+    def iter_sts_spectra(self):
+        for label in self.sts_spectra():
+            yield self.get_sts_spectrum(label)
@@ -5,7 +5,21 @@ from aiida.common import AttributeDict
 from aiida_pythonjob.launch import prepare_pythonjob_inputs
 from aiida_pythonjob import PythonJob
 import numpy as np
-from aiidalab_qe_pp.app.utils import resized_cube_files
+import os
+import re
+import tempfile
+from aiidalab_qe_pp.app.utils import (
+    ldos_stm_images,
+    resized_cube_files,
+    stm_images,
+    sts_maps,
+)
+from aiidalab_qe_pp.parameters import (
+    parse_sts_parameters,
+    stm_energy_window,
+    text2floatlist,
+)
+from aiidalab_qe_pp.reader import parse_ldos_energies
 
 PpCalculation = CalculationFactory("quantumespresso.pp")
 Critic2Calculation = CalculationFactory("critic2")
@@ -101,13 +115,6 @@ def parse_stm_parameters(settings: dict) -> dict:
     }
 
 
-def text2floatlist(input_string):
-    # Split the input string into substrings
-    string_list = input_string.split()
-    float_list = [float(num) for num in string_list]
-    return float_list
-
-
 def create_valid_link_label(value):
     """
     This function creates a valid link label in AiiDA by:
@@ -131,6 +138,62 @@ def create_valid_link_label(value):
     return valid_label
 
 
+def create_ldos_stack(grids, energies, broadenings):
+    """Return a stored `ArrayData` with the LDOS at all the energies.
+
+    `grids` maps the label of each energy file to a callable returning its
+    (x, y, z) grid. The array `data` has the shape (energy, x, y, z) and
+    `energies` holds the energies (eV, relative to the Fermi level). The grids
+    are copied one at a time through a memory-mapped file, so that the whole
+    stack is never held in memory.
+    """
+
+    def label_index(label):
+        digits = re.sub(r"\D", "", label)
+        return int(digits) if digits else 0
+
+    labels = sorted(grids, key=label_index)
+    energy_axis = np.full(len(labels), np.nan)
+    energy_axis[: len(energies)] = energies[: len(labels)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stack = None
+        for index, label in enumerate(labels):
+            grid = np.asarray(grids[label](), dtype=np.float64)
+            if stack is None:
+                stack = np.lib.format.open_memmap(
+                    os.path.join(tmpdir, "data.npy"),
+                    mode="w+",
+                    dtype=np.float64,
+                    shape=(len(labels), *grid.shape),
+                )
+            stack[index] = grid
+        stack.flush()
+
+        array = orm.ArrayData()
+        array.set_array("energies", energy_axis)
+        array.set_array("data", stack)
+        array.base.attributes.set("labels", labels)
+        array.base.attributes.set("broadenings", list(broadenings[: len(labels)]))
+        array.store()
+        del stack
+    return array
+
+
+def create_stm_outputs(prefix, mode, results, key="stm_data"):
+    """Return the STM outputs {label: {key: ArrayData}} of the maps `results`
+    ({value label: {array name: values}}) computed in Python, with the same
+    labels and arrays as the critic2 ones."""
+    outputs = {}
+    for value_label, arrays in results.items():
+        array_data = orm.ArrayData()
+        for name, values in arrays.items():
+            array_data.set_array(name, np.array(values))
+        array_data.store()
+        outputs[f"{prefix}{mode}_{value_label}"] = {key: array_data}
+    return outputs
+
+
 class PPWorkChain(WorkChain):
     "WorkChain to compute vibrational property of a crystal."
 
@@ -172,6 +235,7 @@ class PPWorkChain(WorkChain):
             exclude=["parent_folder", "parameters"],
         )
         spec.outline(
+            cls.setup,
             if_(cls.should_run_charge_dens)(
                 cls.run_charge_dens,
                 cls.inspect_charge_dens,
@@ -200,6 +264,10 @@ class PPWorkChain(WorkChain):
                     cls.reduce_ldos_grid,
                 ),
             ),
+            if_(cls.should_run_sts)(
+                cls.run_sts,
+                cls.inspect_sts,
+            ),
             if_(cls.should_run_wfn)(
                 cls.run_wfn,
                 cls.inspect_wfn,
@@ -268,6 +336,7 @@ class PPWorkChain(WorkChain):
         spec.output_namespace("wfn", dynamic=True)
         spec.output_namespace("ldos_grid", dynamic=True)
         spec.output_namespace("ildos_stm", dynamic=True)
+        spec.output_namespace("sts", dynamic=True)
 
         spec.exit_code(
             201,
@@ -299,6 +368,11 @@ class PPWorkChain(WorkChain):
             "ERROR_LDOS_GRID_FAILED",
             message="The LDOS Grid calculation failed.",
         )
+        spec.exit_code(
+            209,
+            "ERROR_STS_FAILED",
+            message="The STS calculation failed.",
+        )
 
     @classmethod
     def get_builder_from_protocol(
@@ -323,7 +397,9 @@ class PPWorkChain(WorkChain):
         builder.parent_folder = parent_folder
         builder.properties = properties
         builder.pp_calc.code = pp_code
-        builder.critic2_calc.code = critic2_code
+        # critic2 is only needed for the STM maps it computes (see `stm_engine`)
+        if critic2_code is not None:
+            builder.critic2_calc.code = critic2_code
         builder.python = python
 
         builder.critic2_calc.metadata.options = {
@@ -357,10 +433,15 @@ class PPWorkChain(WorkChain):
         self.report(f"launching {calc_type} PpCalculation<{running.pk}>")
         return running
 
-    def submission_pythonjob_calc(self, workchain):
-        """Submit a PythonJob calculation based on the calculation type."""
+    def submission_pythonjob_calc(self, workchain, common_factor=False):
+        """Submit a PythonJob calculation based on the calculation type.
+
+        With `common_factor` all the cube files are resized with the same
+        factor, so that they can be stacked.
+        """
         inputs = prepare_pythonjob_inputs(
             function=resized_cube_files,
+            function_inputs={"common_factor": common_factor},
             code=self.inputs.python,
             output_ports=[{"name": "results"}],
             parent_folder=workchain.outputs.remote_folder,
@@ -371,6 +452,81 @@ class PPWorkChain(WorkChain):
         self.report(f"launching PythonJob<{node.pk}> to reduce cube files")
         return node
 
+    def use_stm_engine(self):
+        """Whether the STM maps are computed in Python instead of critic2."""
+        return self.inputs.parameters.get("stm_engine", "critic2") == "numpy"
+
+    def submit_stm_maps(self, remote_folder, heights, currents, prefix):
+        """Submit a PythonJob computing the constant height maps `heights`
+        ({label: height}) and constant current maps `currents` ({label: value})
+        of the cube of `remote_folder`. The maps are output with the labels
+        `{prefix}height_{label}` and `{prefix}current_{label}`."""
+        inputs = prepare_pythonjob_inputs(
+            function=stm_images,
+            function_inputs={"heights": heights, "currents": currents},
+            code=self.inputs.python,
+            output_ports=[{"name": "results"}],
+            parent_folder=remote_folder,
+            computer=self.inputs.python.computer,
+            register_pickle_by_value=True,
+        )
+        node = self.submit(PythonJob, **inputs)
+        self.report(f"launching PythonJob<{node.pk}> for the {prefix}STM maps")
+        self.to_context(**{f"python_maps_{prefix}": node})
+
+    def use_ldos_stm(self):
+        """Whether the STM images are computed from the LDOS grid instead of
+        one pp.x run per sample bias."""
+        return self.inputs.parameters["stm"].get("source", "pp") == "ldos_grid"
+
+    def submit_ldos_stm_maps(self):
+        """Submit a PythonJob computing the STM images at all the sample biases
+        from the LDOS grid. The maps are output with the same labels as the
+        ones of the pp.x runs."""
+        stm = self.inputs.parameters["stm"]
+        stm_parameters = parse_stm_parameters(stm)
+        calculation = self.ctx.calc_ldos_grid
+        energies, _ = parse_ldos_energies(
+            calculation.outputs.retrieved.get_object_content("aiida.out"),
+            self.inputs.parameters.get("fermi", 0.0),
+        )
+
+        biases = {
+            create_valid_link_label(bias): list(stm_energy_window(bias))
+            for bias in text2floatlist(stm["sample_bias"])
+        }
+        heights = {
+            str(height).replace(".", "_"): height
+            for height in stm_parameters["heights"]
+        }
+        currents = {
+            create_valid_link_label(current): current
+            for current in stm_parameters["currents"]
+        }
+
+        inputs = prepare_pythonjob_inputs(
+            function=ldos_stm_images,
+            function_inputs={
+                "biases": biases,
+                "energies": energies.tolist(),
+                "heights": heights,
+                "currents": currents,
+                "weighting": stm.get("ldos_weighting", "trapezoid"),
+                "broadening": stm.get("ldos_broadening", 0.0),
+            },
+            code=self.inputs.python,
+            output_ports=[{"name": "results"}],
+            parent_folder=calculation.outputs.remote_folder,
+            computer=self.inputs.python.computer,
+            register_pickle_by_value=True,
+        )
+        node = self.submit(PythonJob, **inputs)
+        self.report(
+            f"launching PythonJob<{node.pk}> for the STM maps of {len(biases)} "
+            "biases from the LDOS grid"
+        )
+        self.to_context(ldos_maps_stm=node)
+
     def submit_critic2_calculation(self, remote_folder, calc_type, mode, value, label):
         inputs = AttributeDict(
             self.exposed_inputs(Critic2Calculation, namespace="critic2_calc")
@@ -385,6 +541,56 @@ class PPWorkChain(WorkChain):
         )
         self.to_context(**{f"{calc_type}_{mode}_{label}": running})
 
+    def ldos_grid_window(self):
+        """Return the (lower, upper) energies (eV, relative to the Fermi level)
+        of the LDOS grid, from its parameters."""
+        ldos_grid = self.inputs.parameters["ldos_grid"]
+        fermi = self.inputs.parameters.get("fermi", 0.0)
+        return (
+            round(ldos_grid.get("emin", 0) - fermi, 6),
+            round(ldos_grid.get("emax", 0) - fermi, 6),
+        )
+
+    def setup(self):
+        """Check the inputs of the properties that would otherwise only fail
+        once the calculations they depend on have run."""
+        if "calc_stm" in self.inputs.properties and self.use_ldos_stm():
+            if "calc_ldos_grid" not in self.inputs.properties:
+                self.report("the STM images from the LDOS grid need `calc_ldos_grid`")
+                return self.exit_codes.ERROR_STM_FAILED
+            emin, emax = self.ldos_grid_window()
+            for bias in text2floatlist(self.inputs.parameters["stm"]["sample_bias"]):
+                lower, upper = stm_energy_window(bias)
+                if lower < emin or upper > emax:
+                    self.report(
+                        f"the LDOS grid ({emin} to {emax} eV) does not cover the "
+                        f"states of the bias {bias} eV, only the states inside the "
+                        "grid are integrated"
+                    )
+        if "calc_sts" in self.inputs.properties:
+            if "calc_ldos_grid" not in self.inputs.properties:
+                self.report("the STS maps need `calc_ldos_grid`")
+                return self.exit_codes.ERROR_STS_FAILED
+            try:
+                self.ctx.sts = parse_sts_parameters(self.inputs.parameters["sts"])
+            except ValueError as e:
+                self.report(f"invalid STS parameters: {e}")
+                return self.exit_codes.ERROR_STS_FAILED
+            emin, emax = self.ldos_grid_window()
+            delta_e = self.inputs.parameters["ldos_grid"].get("delta_e", 0.1)
+            if emax - emin < delta_e - 1e-6:
+                self.report(
+                    "the STS spectra need at least two energies in the LDOS grid"
+                )
+                return self.exit_codes.ERROR_STS_FAILED
+            lower, upper = self.ctx.sts["setpoint"]
+            if self.ctx.sts["currents"] and (lower < emin or upper > emax):
+                self.report(
+                    f"the LDOS grid ({emin} to {emax} eV) does not cover the states "
+                    f"of the STS setpoint ({lower} to {upper} eV)"
+                )
+                return self.exit_codes.ERROR_STS_FAILED
+
     def should_run_charge_dens(self):
         return "calc_charge_dens" in self.inputs.properties
 
@@ -487,9 +693,59 @@ class PPWorkChain(WorkChain):
 
     def reduce_ldos_grid(self):
         workchain = self.ctx.calc_ldos_grid
-        node = self.submission_pythonjob_calc(workchain)
+        node = self.submission_pythonjob_calc(workchain, common_factor=True)
         return ToContext(reduce_calc_ldos_grid=node)
 
+    def should_run_sts(self):
+        return "calc_sts" in self.inputs.properties
+
+    def run_sts(self):
+        """Submit a PythonJob computing the dI/dV maps and point spectra from
+        the LDOS grid."""
+        sts = self.ctx.sts
+        calculation = self.ctx.calc_ldos_grid
+        energies, _ = parse_ldos_energies(
+            calculation.outputs.retrieved.get_object_content("aiida.out"),
+            self.inputs.parameters.get("fermi", 0.0),
+        )
+        if len(energies) < 2:
+            self.report("the STS spectra need at least two energies in the LDOS grid")
+            return self.exit_codes.ERROR_STS_FAILED
+        inputs = prepare_pythonjob_inputs(
+            function=sts_maps,
+            function_inputs={
+                "energies": energies.tolist(),
+                "heights": {
+                    str(height).replace(".", "_"): height for height in sts["heights"]
+                },
+                "currents": {
+                    create_valid_link_label(current): current
+                    for current in sts["currents"]
+                },
+                "setpoint": list(sts["setpoint"]),
+                "points": sts["points"],
+                "broadening": sts["broadening"],
+            },
+            code=self.inputs.python,
+            output_ports=[{"name": "results"}],
+            parent_folder=calculation.outputs.remote_folder,
+            computer=self.inputs.python.computer,
+            register_pickle_by_value=True,
+        )
+        node = self.submit(PythonJob, **inputs)
+        self.report(f"launching PythonJob<{node.pk}> for the STS maps")
+        return ToContext(calc_sts=node)
+
+    def inspect_sts(self):
+        """Inspect the results of the STS calculation."""
+        calculation = self.ctx.calc_sts
+
+        if not calculation.is_finished_ok:
+            self.report(
+                f"STS PythonJob failed with exit status {calculation.exit_status}"
+            )
+            return self.exit_codes.ERROR_STS_FAILED
+
     def should_run_wfn(self):
         return "calc_wfn" in self.inputs.properties
 
@@ -587,6 +843,18 @@ class PPWorkChain(WorkChain):
         stm_parameters = parse_stm_parameters(ildos_stm)
 
         remote_folder = self.ctx.calc_ildos.outputs.remote_folder
+        if self.use_stm_engine():
+            if stm_parameters["heights"] or stm_parameters["currents"]:
+                heights = {
+                    str(height).replace(".", "_"): height
+                    for height in stm_parameters["heights"]
+                }
+                currents = {
+                    create_valid_link_label(current): current
+                    for current in stm_parameters["currents"]
+                }
+                self.submit_stm_maps(remote_folder, heights, currents, "ildos_stm_")
+            return
         if stm_parameters["heights"]:
             for height in stm_parameters.get("heights", []):
                 height_label = str(height).replace(".", "_")
@@ -605,10 +873,10 @@ class PPWorkChain(WorkChain):
         """Inspect the results of the ILDOS STM calculations."""
         failed_runs = []
         for label, workchain in self.ctx.items():
-            if label.startswith("ildos_stm"):
+            if label.startswith(("ildos_stm", "python_maps_ildos_stm_")):
                 if not workchain.is_finished_ok:
                     self.report(
-                        f"ILDOS STM Critic2Calculation {label} failed with exit status {workchain.exit_status}"
+                        f"ILDOS STM calculation {label} failed with exit status {workchain.exit_status}"
                     )
                     failed_runs.append(label)
         if failed_runs:
@@ -619,6 +887,10 @@ class PPWorkChain(WorkChain):
         return "calc_stm" in self.inputs.properties
 
     def run_stm(self):
+        if self.use_ldos_stm():
+            # The LDOS grid was already computed, nothing to run per bias
+            return
+
         stm_parameters = parse_stm_parameters(self.inputs.parameters["stm"])
 
         for bias_index, bias in enumerate(stm_parameters["sample_bias"]):
@@ -653,6 +925,10 @@ class PPWorkChain(WorkChain):
             return self.exit_codes.ERROR_STM_FAILED
 
     def run_critic2(self):
+        if self.use_ldos_stm():
+            self.submit_ldos_stm_maps()
+            return
+
         stm_parameters = parse_stm_parameters(self.inputs.parameters["stm"])
 
         for bias_index, bias in enumerate(stm_parameters["sample_bias"]):
@@ -661,6 +937,24 @@ class PPWorkChain(WorkChain):
             ]
             bias_label = create_valid_link_label(bias_ev)
 
+            if self.use_stm_engine():
+                if stm_parameters["heights"] or stm_parameters["currents"]:
+                    heights = {
+                        str(height).replace(".", "_"): height
+                        for height in stm_parameters["heights"]
+                    }
+                    currents = {
+                        create_valid_link_label(current): current
+                        for current in stm_parameters["currents"]
+                    }
+                    self.submit_stm_maps(
+                        self.ctx[f"bias_{bias_label}"].outputs.remote_folder,
+                        heights,
+                        currents,
+                        f"stm_bias_{bias_label}_",
+                    )
+                continue
+
             if stm_parameters["heights"]:
                 for height_index, height in enumerate(stm_parameters["heights"]):
                     z_axis = self.inputs.structure.cell_lengths[2]
@@ -732,10 +1026,10 @@ class PPWorkChain(WorkChain):
         """Inspect the results of the STM calculations."""
         failed_runs = []
         for label, workchain in self.ctx.items():
-            if label.startswith("stm_"):
+            if label.startswith(("stm_", "python_maps_stm_", "ldos_maps_stm")):
                 if not workchain.is_finished_ok:
                     self.report(
-                        f"STM Critic2Calculation {label} failed with exit status {workchain.exit_status}"
+                        f"STM calculation {label} failed with exit status {workchain.exit_status}"
                     )
                     failed_runs.append(label)
         if failed_runs:
@@ -746,7 +1040,13 @@ class PPWorkChain(WorkChain):
         """Attach the results of the PPWorkChain to the outputs."""
         failed = False
         for prop in self.inputs.properties:
-            if prop not in ["calc_wfn", "calc_stm", "calc_ldos_grid", "calc_ildos_stm"]:
+            if prop not in [
+                "calc_wfn",
+                "calc_stm",
+                "calc_ldos_grid",
+                "calc_ildos_stm",
+                "calc_sts",
+            ]:
                 if self.ctx[f"{prop}"].is_finished_ok:
                     if self.inputs.parameters.get("reduce_cube_files"):
                         volumetric_data = self.ctx[
@@ -778,56 +1078,54 @@ class PPWorkChain(WorkChain):
                     failed = True
 
             elif prop == "calc_ldos_grid":
-                if self.ctx.calc_ldos_grid.is_finished_ok:
+                calculation = self.ctx.calc_ldos_grid
+                if calculation.is_finished_ok:
                     if self.inputs.parameters.get("reduce_cube_files"):
                         volumetric_data = self.ctx[
                             "reduce_calc_ldos_grid"
                         ].outputs.results
-
-                        if "aiida_fileout" in volumetric_data:
-                            array = orm.ArrayData()
-                            array.set_array(
-                                "data", np.array(volumetric_data["aiida_fileout"])
-                            )
-                            array.store()
-                            output = {}
-                            output["output_data"] = array
-                            output["remote_folder"] = (
-                                self.ctx.calc_ldos_grid.outputs.remote_folder
-                            )
-                            output["retrieved"] = (
-                                self.ctx.calc_ldos_grid.outputs.retrieved
-                            )
-                            output["output_parameters"] = (
-                                self.ctx.calc_ldos_grid.outputs.output_parameters
-                            )
-                            self.out("ldos_grid", output)
-
-                        else:
-                            output = {}
-                            output["output_data_multiple"] = {}
-                            output["retrieved"] = (
-                                self.ctx.calc_ldos_grid.outputs.retrieved
-                            )
-                            output["output_parameters"] = (
-                                self.ctx.calc_ldos_grid.outputs.output_parameters
-                            )
-                            output["remote_folder"] = (
-                                self.ctx.calc_ldos_grid.outputs.remote_folder
-                            )
-                            for key, value in volumetric_data.items():
-                                array = orm.ArrayData()
-                                array.set_array("data", np.array(value))
-                                array.store()
-                                output["output_data_multiple"][key] = array
-
-                            self.out("ldos_grid", output)
+                        grids = {
+                            key: lambda value=value: np.array(value)
+                            for key, value in volumetric_data.items()
+                        }
+                        energies, broadenings = parse_ldos_energies(
+                            calculation.outputs.retrieved.get_object_content(
+                                "aiida.out"
+                            ),
+                            self.inputs.parameters.get("fermi", 0.0),
+                        )
+                        output = {}
+                        output["output_data_stack"] = create_ldos_stack(
+                            grids, energies, broadenings
+                        )
+                        output["retrieved"] = calculation.outputs.retrieved
+                        output["output_parameters"] = (
+                            calculation.outputs.output_parameters
+                        )
+                        output["remote_folder"] = calculation.outputs.remote_folder
+                        self.out("ldos_grid", output)
                     else:
-                        self.out("ldos_grid", self.ctx.calc_ldos_grid.outputs)
+                        # The grids were parsed and stored by the PpCalculation,
+                        # they are not stored a second time as a stack
+                        self.out("ldos_grid", calculation.outputs)
                 else:
                     self.report("LDOS Grid calculation failed")
                     failed = True
 
+            elif prop == "calc_sts":
+                calculation = self.ctx.calc_sts
+                if calculation.is_finished_ok:
+                    results = calculation.outputs.results
+                    outputs = {}
+                    for mode in ("height", "current", "point"):
+                        outputs.update(
+                            create_stm_outputs("", mode, results[mode], "sts_data")
+                        )
+                    self.out("sts", outputs)
+                else:
+                    self.report("STS calculation failed")
+                    failed = True
+
             elif prop == "calc_wfn":
                 wfn_found = False
                 wfn_outputs = {}
@@ -901,6 +1199,36 @@ class PPWorkChain(WorkChain):
                         else:
                             self.report(f"{label} calculation failed")
                             failed = True
+                    elif label.startswith(f"python_maps_{prefix}"):
+                        found = True
+                        if workchain.is_finished_ok:
+                            results = workchain.outputs.results
+                            for mode in ("height", "current"):
+                                outputs.update(
+                                    create_stm_outputs(
+                                        label[len("python_maps_") :],
+                                        mode,
+                                        results[mode],
+                                    )
+                                )
+                        else:
+                            self.report(f"{label} calculation failed")
+                            failed = True
+                    elif label == f"ldos_maps_{output_label}":
+                        found = True
+                        if workchain.is_finished_ok:
+                            for bias_label, maps in workchain.outputs.results.items():
+                                for mode in ("height", "current"):
+                                    outputs.update(
+                                        create_stm_outputs(
+                                            f"{prefix}bias_{bias_label}_",
+                                            mode,
+                                            maps[mode],
+                                        )
+                                    )
+                        else:
+                            self.report(f"{label} calculation failed")
+                            failed = True
 
                 self.out(output_label, outputs)
 